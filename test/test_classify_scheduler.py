@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org, https://github.com/cloudedbats
+# Copyright (c) 2020-present Arnold Andreasson
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import asyncio
+import types
+import numpy as np
+import wurb_rec
+from wurb_rec.sound_stream_manager import SoundBufferQueue
+
+
+class Logging:
+    """ """
+
+    def __init__(self):
+        self.messages = []
+
+    def info(self, message, short_message=None):
+        self.messages.append(message)
+
+    debug = warning = error = info
+
+
+class Settings:
+    """ """
+
+    def get_setting(self, key):
+        return {"classification_algorithm": "classification-batclassify"}.get(key, "")
+
+
+def create_scheduler(from_source_queue, detector_idle=False):
+    """ Scheduler with a minimal manager, no tasks are started. """
+
+    async def is_detector_idle():
+        return detector_idle
+
+    wurb_manager = types.SimpleNamespace(
+        wurb_logging=Logging(),
+        wurb_settings=Settings(),
+        wurb_scheduler=types.SimpleNamespace(is_detector_idle=is_detector_idle),
+        wurb_recorder=types.SimpleNamespace(from_source_queue=from_source_queue),
+    )
+    scheduler = wurb_rec.WurbClassifyScheduler(wurb_manager)
+    scheduler.change_event = asyncio.Event()
+    scheduler.max_load_percent = 101.0
+    scheduler.max_temp_c = 1000.0
+    return scheduler
+
+
+def sound_item(seconds, sampling_freq_hz=384000):
+    """ """
+    return {
+        "status": "data",
+        "data": np.zeros(int(seconds * sampling_freq_hz), dtype=np.int16),
+    }
+
+
+def test_buffer_fill_uses_byte_budget():
+    """ A queue with a byte budget is filled long before max number of items. """
+
+    async def run():
+        queue = SoundBufferQueue(maxsize=1200, max_bytes=10 * 384000 * 2)
+        scheduler = create_scheduler(queue)
+        for _ in range(6):
+            queue.put_nowait(sound_item(0.5))
+        assert abs(scheduler.get_buffer_fill() - 0.3) < 1e-6
+        assert queue.qsize() / queue.maxsize < 0.01
+
+    asyncio.run(run())
+
+
+def test_filled_queue_pauses_classification():
+    """ """
+
+    async def run():
+        queue = SoundBufferQueue(maxsize=1200, max_bytes=10 * 384000 * 2)
+        scheduler = create_scheduler(queue)
+        await scheduler.update_throttle()
+        assert scheduler.allowed_workers == min(
+            scheduler.rec_workers, scheduler.number_of_workers
+        )
+        for _ in range(8):
+            queue.put_nowait(sound_item(0.5))
+        await scheduler.update_throttle()
+        assert scheduler.allowed_workers == 0
+        assert scheduler.classify_state == "Paused, sound buffers queued."
+        # Resumed when the queue is emptied.
+        while not queue.empty():
+            queue.get_nowait()
+            queue.task_done()
+        await scheduler.update_throttle()
+        assert scheduler.allowed_workers > 0
+
+    asyncio.run(run())
@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org, https://github.com/cloudedbats
+# Copyright (c) 2020-present Arnold Andreasson
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import asyncio
+import sqlite3
+import types
+import wurb_rec
+
+
+class Logging:
+    """ """
+
+    def __init__(self):
+        self.messages = []
+
+    def info(self, message, short_message=None):
+        self.messages.append(message)
+
+    debug = warning = error = info
+
+
+def create_retention(conn, policy="oldest", quota_mb=0):
+    """ Retention with a minimal manager and an in-memory database. """
+    removed = []
+
+    async def get_db():
+        return conn
+
+    async def remove(filepaths):
+        removed.extend(filepaths)
+
+    async def delete_filepaths(filepaths):
+        pass
+
+    wurb_manager = types.SimpleNamespace(
+        wurb_logging=Logging(),
+        wurb_database=types.SimpleNamespace(
+            get_db=get_db, delete_filepaths=delete_filepaths
+        ),
+        wurb_classify_queue=types.SimpleNamespace(remove=remove),
+        wurb_classify_scheduler=types.SimpleNamespace(
+            pop_sound_data=lambda filepath: None
+        ),
+    )
+    retention = wurb_rec.WurbRetention(wurb_manager)
+    retention.policy = policy
+    retention.quota_mb = quota_mb
+    return retention, removed
+
+
+def create_files(directory, names, size_bytes=2 ** 20):
+    """ """
+    filepaths = []
+    for name in names:
+        filepath = directory / name
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        filepath.write_bytes(b"\0" * size_bytes)
+        filepaths.append(filepath)
+    return filepaths
+
+
+def test_quota_removes_oldest_first(tmp_path):
+    """ """
+
+    async def run():
+        retention, removed = create_retention(sqlite3.connect(":memory:"), quota_mb=3)
+        await retention.startup()
+        filepaths = create_files(tmp_path, ["a.wav", "b.wav", "c.wav", "d.wav", "e.wav"])
+        for index, filepath in enumerate(filepaths):
+            datetime_str = "2026-01-01T00:00:0" + str(index) + "Z"
+            await retention.add_file(filepath, datetime_str, 2 ** 20)
+        assert retention.total_bytes == 3 * 2 ** 20
+        assert removed == [str(filepaths[0]), str(filepaths[1])]
+        assert [path.exists() for path in filepaths] == [False, False, True, True, True]
+
+    asyncio.run(run())
+
+
+def test_priority_policy_keeps_classified_files(tmp_path):
+    """ """
+
+    async def run():
+        retention, removed = create_retention(sqlite3.connect(":memory:"), "priority")
+        await retention.startup()
+        filepaths = create_files(tmp_path, ["a.wav", "b.wav", "c.wav"])
+        for index, filepath in enumerate(filepaths):
+            datetime_str = "2026-01-01T00:00:0" + str(index) + "Z"
+            await retention.add_file(filepath, datetime_str, 2 ** 20)
+        await retention.update_file(filepaths[0], filepaths[0], "Pipistrellus")
+        await retention.remove_oldest(2 ** 20)
+        assert removed == [str(filepaths[1])]
+
+    asyncio.run(run())
+
+
+def test_concurrent_removal_counts_files_once(tmp_path):
+    """ """
+
+    async def run():
+        retention, removed = create_retention(sqlite3.connect(":memory:"))
+        await retention.startup()
+        filepaths = create_files(tmp_path, ["a.wav", "b.wav"])
+        for index, filepath in enumerate(filepaths):
+            datetime_str = "2026-01-01T00:00:0" + str(index) + "Z"
+            await retention.add_file(filepath, datetime_str, 2 ** 20)
+        await asyncio.gather(
+            retention.remove_oldest(2 ** 20), retention.remove_oldest(2 ** 20)
+        )
+        assert retention.total_bytes == 0
+        assert sorted(removed) == sorted([str(path) for path in filepaths])
+
+    asyncio.run(run())
+
+
+def test_path_prefix_wildcards_are_escaped(tmp_path):
+    """ Only files below the prefix are removed, "_" is not a wildcard. """
+
+    async def run():
+        retention, removed = create_retention(sqlite3.connect(":memory:"))
+        await retention.startup()
+        kept = create_files(tmp_path / "usbX1", ["a.wav"])[0]
+        target = create_files(tmp_path / "usb_1", ["b.wav"])[0]
+        await retention.add_file(kept, "2026-01-01T00:00:00Z", 2 ** 20)
+        await retention.add_file(target, "2026-01-01T00:00:01Z", 2 ** 20)
+        await retention.remove_oldest(
+            2 ** 30, max_files=None, path_prefix=str(tmp_path / "usb_1")
+        )
+        assert removed == [str(target)]
+        assert kept.exists()
+        recordings = await retention.get_recordings(str(tmp_path / "usb_1"))
+        assert recordings == []
+
+    asyncio.run(run())
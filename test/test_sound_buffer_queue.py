@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org, https://github.com/cloudedbats
+# Copyright (c) 2020-present Arnold Andreasson
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import numpy as np
+from wurb_rec.sound_stream_manager import SoundBufferQueue
+from wurb_rec.sound_spill_buffer import SoundSpillBuffer
+
+
+def sound_item(number, length=1000, status="data"):
+    """ Sound data is filled with the item number. """
+    return {"status": status, "data": np.full(length, number, dtype=np.int16)}
+
+
+def sound_file(first_number, number_of_items, length=1000):
+    """ Items for one sound file. """
+    items = [sound_item(first_number + index, length) for index in range(number_of_items)]
+    items[0]["status"] = "new_file"
+    items[-1]["status"] = "close_file"
+    return items
+
+
+def get_numbers(queue):
+    """ Empties the queue. Item numbers for sound data, or the control item. """
+    numbers = []
+    while not queue.empty():
+        item = queue.get_nowait()
+        queue.task_done()
+        if isinstance(item, dict) and (item.get("data", None) is not None):
+            numbers.append(int(item["data"][0]))
+        else:
+            numbers.append(item)
+    return numbers
+
+
+def test_bytes_are_counted():
+    """ """
+    queue = SoundBufferQueue(max_bytes=10000)
+    queue.put_nowait(sound_item(1))
+    queue.put_nowait(sound_item(2))
+    queue.put_nowait(False)
+    assert queue.queued_bytes == 4000
+    queue.get_nowait()
+    assert queue.queued_bytes == 2000
+    assert get_numbers(queue) == [2, False]
+    assert queue.queued_bytes == 0
+
+
+def test_drop_oldest_keeps_control_items():
+    """ """
+    queue = SoundBufferQueue(max_bytes=6000, drop_policy="drop-oldest")
+    queue.put_nowait(None)
+    for number in range(1, 6):
+        queue.put_nowait(sound_item(number))
+    assert queue.queued_bytes == 6000
+    assert queue.dropped_items == 2
+    assert queue.dropped_bytes == 4000
+    assert get_numbers(queue) == [None, 3, 4, 5]
+
+
+def test_drop_newest():
+    """ """
+    queue = SoundBufferQueue(max_bytes=6000, drop_policy="drop-newest")
+    for number in range(1, 6):
+        queue.put_nowait(sound_item(number))
+    assert queue.dropped_items == 2
+    assert get_numbers(queue) == [1, 2, 3]
+
+
+def test_files_are_dropped_as_a_whole():
+    """ Items before the first "new_file" are part of a file that is
+        already read from the queue, and are kept. """
+    queue = SoundBufferQueue(max_bytes=14000, drop_policy="drop-oldest")
+    queue.put_nowait(sound_item(1, status="close_file"))
+    queue.put_file_nowait(sound_file(10, 3))
+    queue.put_file_nowait(sound_file(20, 3))
+    queue.put_file_nowait(sound_file(30, 3))
+    assert queue.dropped_files == 1
+    assert queue.dropped_items == 3
+    assert get_numbers(queue) == [1, 20, 21, 22, 30, 31, 32]
+
+
+def test_large_file_is_accepted_by_empty_queue():
+    """ """
+    queue = SoundBufferQueue(max_bytes=2000, drop_policy="drop-newest")
+    queue.put_file_nowait(sound_file(10, 3))
+    queue.put_file_nowait(sound_file(20, 3))
+    assert queue.dropped_files == 1
+    assert get_numbers(queue) == [10, 11, 12]
+
+
+def test_spilled_items_keep_order(tmp_path):
+    """ New items are spilled as long as the spill buffer is not empty,
+        and are moved back to the queue when there is room. """
+    spill_buffer = SoundSpillBuffer(dir_path=str(tmp_path), size_mb=1)
+    queue = SoundBufferQueue(max_bytes=4000, drop_policy="spill")
+    queue.spill_target = spill_buffer
+    try:
+        for number in range(1, 4):
+            queue.put_nowait(sound_item(number))
+        queue.put_nowait(False)
+        queue.put_file_nowait(sound_file(10, 2))
+        assert queue.spilled_items == 3
+        assert queue.dropped_items == 0
+        assert get_numbers(queue) == [1, 2, 3, False, 10, 11]
+        assert spill_buffer.is_empty()
+    finally:
+        spill_buffer.close()
+
+
+def test_spill_buffer_wraps_around(tmp_path):
+    """ """
+    spill_buffer = SoundSpillBuffer(dir_path=str(tmp_path), size_mb=1)
+    try:
+        item_length = 2 ** 20 // 2 // 4  # Four items fill the scratch file.
+        for number in range(1, 5):
+            assert spill_buffer.spill(sound_item(number, item_length))
+        assert not spill_buffer.spill(sound_item(5, item_length))
+        assert int(spill_buffer.restore()["data"][0]) == 1
+        assert spill_buffer.spill(sound_item(5, item_length))
+        numbers = []
+        while not spill_buffer.is_empty():
+            numbers.append(int(spill_buffer.restore()["data"][-1]))
+        assert numbers == [2, 3, 4, 5]
+    finally:
+        spill_buffer.close()
+
+
+def test_spill_file_is_all_or_nothing(tmp_path):
+    """ """
+    spill_buffer = SoundSpillBuffer(dir_path=str(tmp_path), size_mb=1)
+    try:
+        item_length = 2 ** 20 // 2 // 4
+        assert spill_buffer.spill(sound_item(1, item_length))
+        assert not spill_buffer.spill_file(sound_file(10, 4, item_length))
+        assert len(spill_buffer.pending) == 1
+        assert spill_buffer.spill_file(sound_file(10, 3, item_length))
+        assert len(spill_buffer.pending) == 4
+    finally:
+        spill_buffer.close()
@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org, https://github.com/cloudedbats
+# Copyright (c) 2020-present Arnold Andreasson
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import numpy as np
+from wurb_rec.wurb_sound_detection import create_detection
+
+SAMPLING_FREQ_HZ = 384000
+BUFFER_LENGTH = SAMPLING_FREQ_HZ // 2
+
+
+def create(algorithm, threshold_dbfs=-50):
+    """ """
+    return create_detection(
+        {
+            "detection_algorithm": algorithm,
+            "sampling_freq_hz": SAMPLING_FREQ_HZ,
+            "detection_limit_khz": "17",
+            "detection_sensitivity_dbfs": str(threshold_dbfs),
+        }
+    )
+
+
+def add_call(signal, position, freq_hz, amplitude, length=2000):
+    """ Short tone, like a CF call. """
+    time_s = np.arange(length) / SAMPLING_FREQ_HZ
+    window = np.hanning(length)
+    signal[position : position + length] += (
+        amplitude * window * np.sin(2 * np.pi * freq_hz * time_s)
+    )
+
+
+def detect_all(detection, signal):
+    """ Results and active ranges for each buffer. """
+    results = []
+    for start in range(0, len(signal), BUFFER_LENGTH):
+        result = detection.detect_sound(signal[start : start + BUFFER_LENGTH])
+        results.append((result, detection.active_ranges))
+    return results
+
+
+def test_cascade_equals_simple():
+    """ Same result when the gate is open, also for calls that are split
+        between two buffers or close to the threshold. """
+    rng = np.random.default_rng(1)
+    detected_signals = 0
+    for trial in range(20):
+        signal = rng.standard_normal(3 * BUFFER_LENGTH) * 3
+        position = BUFFER_LENGTH - int(rng.integers(0, 6000))
+        freq_hz = float(rng.uniform(20000, 120000))
+        amplitude = 32768 * 10 ** (float(rng.uniform(-50, -30)) / 20)
+        add_call(signal, position, freq_hz, amplitude, length=6000)
+        signal = signal.astype(np.int16)
+        simple_results = detect_all(create("detection-simple"), signal)
+        cascade_results = detect_all(create("detection-cascade"), signal)
+        assert simple_results == cascade_results
+        if any(result[0] for result, _active_ranges in simple_results):
+            detected_signals += 1
+    # Both detected and missed calls are compared.
+    assert 0 < detected_signals < 20
+
+
+def test_cascade_skips_noise():
+    """ Broadband noise below the threshold does not open the gate. """
+    rng = np.random.default_rng(2)
+    detection = create("detection-cascade")
+    for _ in range(10):
+        noise = rng.standard_normal(BUFFER_LENGTH) * 10  # About -70 dBFS.
+        assert detection.detect_sound(noise.astype(np.int16)) == (False, None, None)
+    assert detection.get_statistics() == {"buffers_checked": 10, "buffers_skipped": 10}
+
+
+def test_cascade_ignores_low_frequencies():
+    """ Sound below the detection limit does not open the gate. """
+    signal = np.zeros(BUFFER_LENGTH)
+    add_call(signal, 10000, 5000, 10000)
+    detection = create("detection-cascade")
+    assert not detection.detect_sound(signal.astype(np.int16))[0]
+    assert detection.buffers_skipped == 1
+
+
+def test_peak_frequency():
+    """ """
+    signal = np.zeros(BUFFER_LENGTH)
+    add_call(signal, 10000, 45000, 10000, length=20000)
+    for algorithm in ["detection-simple", "detection-cascade"]:
+        detection = create(algorithm)
+        sound_detected, peak_freq_hz, peak_dbfs = detection.detect_sound(
+            signal.astype(np.int16)
+        )
+        assert sound_detected
+        assert abs(peak_freq_hz - 45000) <= SAMPLING_FREQ_HZ / 2048
+        assert -20 < peak_dbfs < -5
+        start, end = detection.active_ranges[0]
+        assert (start <= 10000 + 5000) and (end >= 30000 - 5000)
@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org, https://github.com/cloudedbats
+# Copyright (c) 2020-present Arnold Andreasson
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import numpy as np
+import pytest
+from wurb_rec.sound_ring_buffer import SoundRingBuffer
+
+
+def block(number, block_size=100):
+    """ """
+    return np.full(block_size, number, dtype=np.int16)
+
+
+def test_write_returns_absolute_index():
+    """ """
+    ring_buffer = SoundRingBuffer(block_size=100, capacity_blocks=4)
+    indexes = [ring_buffer.write(block(number)) for number in range(10)]
+    assert indexes == [number * 100 for number in range(10)]
+
+
+def test_wraparound():
+    """ Old data is overwritten, the last blocks are still available. """
+    ring_buffer = SoundRingBuffer(block_size=100, capacity_blocks=4)
+    indexes = [ring_buffer.write(block(number)) for number in range(10)]
+    for number in range(6, 10):
+        data = ring_buffer.get_data(indexes[number], 100)
+        assert len(data) == 100
+        assert (data == number).all()
+    # Views, not copies.
+    view = ring_buffer.get_data(indexes[9], 100)
+    ring_buffer.write(block(10))
+    ring_buffer.write(block(11))
+    ring_buffer.write(block(12))
+    ring_buffer.write(block(13))
+    assert (view == 13).all()
+
+
+def test_is_available():
+    """ """
+    ring_buffer = SoundRingBuffer(block_size=100, capacity_blocks=4)
+    indexes = [ring_buffer.write(block(number)) for number in range(10)]
+    # Overwritten.
+    assert not ring_buffer.is_available(indexes[5], margin_blocks=0)
+    # Oldest block, overwritten by the next write.
+    assert ring_buffer.is_available(indexes[6], margin_blocks=0)
+    assert not ring_buffer.is_available(indexes[6])
+    assert ring_buffer.is_available(indexes[7])
+    assert ring_buffer.is_available(indexes[9])
+    # Not written yet.
+    assert not ring_buffer.is_available(ring_buffer.write_index)
+
+
+def test_block_size_mismatch():
+    """ """
+    ring_buffer = SoundRingBuffer(block_size=100, capacity_blocks=4)
+    with pytest.raises(ValueError):
+        ring_buffer.write(block(1, block_size=99))
+
+
+def test_clear():
+    """ """
+    ring_buffer = SoundRingBuffer(block_size=100, capacity_blocks=4)
+    index = ring_buffer.write(block(1))
+    ring_buffer.clear()
+    assert not ring_buffer.is_available(index)
+    assert ring_buffer.write(block(2)) == 0
@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org, https://github.com/cloudedbats
+# Copyright (c) 2020-present Arnold Andreasson
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import numpy as np
+from wurb_rec.wurb_recorder import SoundTrigger
+from wurb_rec.wurb_recorder import VariableLengthTrigger
+
+NO_SOUND = (False, None, None)
+SOUND = (True, 40000.0, -30.0)
+
+
+def sound_item(position, length=500):
+    """ Sound data is the sample position in the stream. """
+    return {
+        "adc_time": position / 1000.0,
+        "index": position,
+        "data": np.arange(position, position + length, dtype=np.int16),
+    }
+
+
+def get_file_data(file_items):
+    """ """
+    return np.concatenate([item["data"] for item in file_items])
+
+
+def test_fixed_length_file():
+    """ Three buffers before the first detected sound are included. """
+    sound_trigger = SoundTrigger(rec_length_s=5)
+    files = []
+    first_peaks = []
+    for number in range(20):
+        detection_result = SOUND if number in [8, 9] else NO_SOUND
+        first_peak, file_items = sound_trigger.add_buffer(
+            sound_item(number * 500), detection_result
+        )
+        if first_peak:
+            first_peaks.append((number, first_peak))
+        if file_items:
+            files.append((number, file_items))
+    assert first_peaks == [(8, (40000.0, -30.0))]
+    assert len(files) == 1
+    number, file_items = files[0]
+    assert number == 14
+    assert [item["index"] for item in file_items] == [
+        position * 500 for position in range(5, 15)
+    ]
+    assert file_items[0]["status"] == "new_file"
+    assert file_items[0]["max_peak_freq_hz"] == 40000.0
+    assert file_items[-1]["status"] == "close_file"
+
+
+def test_variable_length_file_is_cut():
+    """ Pre- and post-trigger times are counted from the sound. """
+    sound_trigger = VariableLengthTrigger(
+        max_length_s=5, sampling_freq_hz=1000, pre_trigger_s=1.0, post_trigger_s=0.5
+    )
+    files = []
+    for number in range(12):
+        detection_result = NO_SOUND
+        active_ranges = None
+        if number == 6:
+            detection_result = SOUND
+            active_ranges = [[100, 200]]
+        if number == 8:
+            detection_result = SOUND
+            active_ranges = [[0, 50]]
+        _first_peak, file_items = sound_trigger.add_buffer(
+            sound_item(number * 500), detection_result, active_ranges
+        )
+        if file_items:
+            files.append((number, file_items))
+    assert len(files) == 2
+    # Sound at 3100-3200.
+    number, file_items = files[0]
+    assert number == 7
+    assert (get_file_data(file_items) == np.arange(2100, 3700)).all()
+    assert file_items[0]["index"] == 2100
+    assert file_items[0]["status"] == "new_file"
+    assert file_items[-1]["status"] == "close_file"
+    # Sound at 4000-4050, starts where the last file ended.
+    number, file_items = files[1]
+    assert number == 9
+    assert (get_file_data(file_items) == np.arange(3700, 4550)).all()
+
+
+def test_variable_length_max_length():
+    """ """
+    sound_trigger = VariableLengthTrigger(
+        max_length_s=2, sampling_freq_hz=1000, pre_trigger_s=0.5, post_trigger_s=0.5
+    )
+    files = []
+    for number in range(12):
+        detection_result = SOUND if number >= 4 else NO_SOUND
+        _first_peak, file_items = sound_trigger.add_buffer(
+            sound_item(number * 500), detection_result
+        )
+        if file_items:
+            files.append((number, file_items))
+    number, file_items = files[0]
+    assert number == 6
+    assert (get_file_data(file_items) == np.arange(1500, 3500)).all()
+    # Next file continues without a gap when the sound continues.
+    number, file_items = files[1]
+    assert number == 10
+    assert (get_file_data(file_items) == np.arange(3500, 5500)).all()
+
+
+def test_variable_length_single_item_file():
+    """ A short file may only contain one item, marked with "close_file". """
+    sound_trigger = VariableLengthTrigger(
+        max_length_s=5, sampling_freq_hz=1000, pre_trigger_s=0.1, post_trigger_s=0.1
+    )
+    files = []
+    for number in range(4):
+        detection_result = SOUND if number == 2 else NO_SOUND
+        active_ranges = [[200, 250]] if number == 2 else None
+        _first_peak, file_items = sound_trigger.add_buffer(
+            sound_item(number * 500), detection_result, active_ranges
+        )
+        if file_items:
+            files.append(file_items)
+    file_items = files[0]
+    assert len(file_items) == 1
+    assert file_items[0]["status"] == "new_file"
+    assert file_items[0]["close_file"]
+    assert (file_items[0]["data"] == np.arange(1100, 1350)).all()
@@ -5,6 +5,8 @@ from .wurb_logging import WurbLogging
 from .lib.pettersson_m500_batmic import PetterssonM500BatMic
 from .lib.solartime import SolarTime
 from .sound_stream_manager import SoundStreamManager
+from .sound_ring_buffer import SoundRingBuffer
+from .sound_spill_buffer import SoundSpillBuffer
 from .wurb_rpi import WurbRaspberryPi
 from .wurb_settings import WurbSettings
 from .wurb_gps import WurbGps
@@ -17,11 +19,27 @@ from .wurb_audio_m500 import PetterssonM500
 
 from .wurb_audiofeedback import WurbPitchShifting
 from .wurb_sound_detection import SoundDetection
+from .wurb_sound_detection import SoundDetectionWorker
 from .wurb_recorder import UltrasoundDevices
 from .wurb_recorder import WaveFileWriter
+from .wurb_recorder import WaveFileWriteBehind
 from .wurb_recorder import WurbRecorder
 from .wurb_scheduler import WurbScheduler
 from .wurb_manager import WurbRecManager
 from .api_app import app
 from .wurb_database import WurbDatabase
+from .wurb_retention import WurbRetention
+from .wurb_classify_queue import WurbClassifyQueue
+from .wurb_classify_queue import create_content_hash
+from .wurb_classify_queue import get_file_content_hash
+from .wurb_classify_scheduler import WurbClassifyScheduler
+from .wurb_archiver import WurbArchiver
+from .wurb_classifier import BatClassifyProcess
+from .wurb_classifier import BatClassifyPool
+from .wurb_classifier import SoundClassification
+from .wurb_classifier import ClassifierBase
+from .wurb_classifier import ClassifierSpectrumModel
+from .wurb_classifier import register_classifier
+from .wurb_classifier import get_command_version
+from .wurb_classifier import set_low_priority
 from .wurb_metadata import WurbMetadata
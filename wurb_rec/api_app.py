@@ -50,13 +50,19 @@ class DetectorSettings(BaseModel):
     rec_mode: str = None
     file_directory: str = None
     file_directory_date_option: str = None
+    file_directory_shard_option: str = None
     filename_prefix: str = None
     detection_limit_khz: float = None
     detection_sensitivity_dbfs: float = None
     detection_algorithm: str = None
     classification_algorithm: str = None
     rec_length_s: str = None
+    rec_length_option: str = None
+    rec_pre_trigger_s: float = None
+    rec_post_trigger_s: float = None
     rec_type: str = None
+    rec_file_format: str = None
+    rec_sparse_option: str = None
     feedback_on_off: str = None
     feedback_volume: float = None
     feedback_pitch: float = None
@@ -105,6 +111,38 @@ async def all_bat_data():
     else:
         return 0
 
+@app.get("/get-recordings/")
+async def get_recordings(directory: str = "", limit: int = 100, offset: int = 0):
+    """ Recorded files from the recordings index, newest first. """
+    try:
+        global wurb_rec_manager
+        # Logging debug.
+        wurb_rec_manager.wurb_logging.debug(message="API called: get-recordings.")
+        return await wurb_rec_manager.wurb_retention.get_recordings(
+            directory=directory, limit=limit, offset=offset
+        )
+    except Exception as e:
+        # Logging error.
+        message = "Called: get_recordings: " + str(e)
+        wurb_rec_manager.wurb_logging.error(message, short_message=message)
+
+
+@app.get("/get-classification-progress/")
+async def get_classification_progress():
+    """ Classification state and number of files waiting. """
+    try:
+        global wurb_rec_manager
+        # Logging debug.
+        wurb_rec_manager.wurb_logging.debug(
+            message="API called: get-classification-progress."
+        )
+        return await wurb_rec_manager.wurb_classify_scheduler.get_progress()
+    except Exception as e:
+        # Logging error.
+        message = "Called: get_classification_progress: " + str(e)
+        wurb_rec_manager.wurb_logging.error(message, short_message=message)
+
+
 @app.on_event("startup")
 async def startup_event():
     """ """
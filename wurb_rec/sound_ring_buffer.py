@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org, https://github.com/cloudedbats
+# Copyright (c) 2020-present Arnold Andreasson
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import threading
+import numpy as np
+
+
+class SoundRingBuffer(object):
+    """ Preallocated int16 ring buffer for the sound pipeline.
+        The capture thread writes each buffer once, and the detector,
+        audio feedback and file writer read it as views by absolute
+        sample index. The capacity is a multiple of the block size
+        and blocks are written as a whole, so a block never wraps
+        around and views are always contiguous.
+        Data is only valid until it is overwritten, check with
+        is_available() before using old data.
+    """
+
+    def __init__(self, block_size, capacity_blocks):
+        """ """
+        self.block_size = int(block_size)
+        self.capacity_blocks = int(capacity_blocks)
+        self.capacity = self.block_size * self.capacity_blocks
+        self.buffer = np.zeros(self.capacity, dtype=np.int16)
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """ """
+        with self.lock:
+            # Absolute sample index for the next write.
+            self.write_index = 0
+
+    def write(self, data_int16):
+        """ Copy one block into the buffer. Returns the absolute sample index. """
+        length = len(data_int16)
+        if length != self.block_size:
+            raise ValueError(
+                "Ring buffer: Block size mismatch: "
+                + str(length)
+                + " != "
+                + str(self.block_size)
+            )
+        with self.lock:
+            index = self.write_index
+        start = index % self.capacity
+        self.buffer[start : start + length] = data_int16
+        with self.lock:
+            self.write_index = index + length
+        return index
+
+    def get_data(self, index, length):
+        """ Returns a view, no copy. """
+        start = index % self.capacity
+        return self.buffer[start : start + length]
+
+    def is_available(self, index, margin_blocks=1):
+        """ True if the data at "index" is not overwritten, and will not be
+            overwritten by the next "margin_blocks" writes. """
+        with self.lock:
+            write_index = self.write_index
+        if index >= write_index:
+            return False
+        oldest_index = write_index + margin_blocks * self.block_size - self.capacity
+        return index >= oldest_index
+
+    def get_capacity_s(self, sampling_freq_hz):
+        """ """
+        return self.capacity / sampling_freq_hz
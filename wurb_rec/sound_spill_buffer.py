@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org, https://github.com/cloudedbats
+# Copyright (c) 2020-present Arnold Andreasson
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import mmap
+import pathlib
+import tempfile
+import logging
+import numpy as np
+from collections import deque
+
+
+class SoundSpillBuffer(object):
+    """ Overflow stage for sound buffer queues. Sound data that does not
+        fit in the queue budget is stored in a memory-mapped scratch file,
+        on tmpfs (/dev/shm) or the SD card, and moved back to the queue
+        in the same order when there is room again.
+        The scratch file is used as a ring, first in first out.
+    """
+
+    def __init__(self, dir_path="/dev/shm", size_mb=256):
+        """ """
+        self.logger = logging.getLogger("CloudedBats-WURB")
+        self.dir_path = dir_path
+        self.size = int(size_mb * 1024 * 1024)
+        self.scratch_file = None
+        self.scratch_mmap = None
+        # Pending items as (item_without_data, offset, length).
+        self.pending = deque()
+        self.head = 0  # Next write offset.
+        self.tail = 0  # Oldest used offset.
+
+    def open(self):
+        """ The scratch file is removed when closed. """
+        if self.scratch_mmap is not None:
+            return
+        dir_path = pathlib.Path(self.dir_path)
+        if not dir_path.exists():
+            dir_path = None  # Default temp dir.
+        self.scratch_file = tempfile.TemporaryFile(dir=dir_path, prefix="wurb_spill_")
+        self.scratch_file.truncate(self.size)
+        self.scratch_mmap = mmap.mmap(self.scratch_file.fileno(), self.size)
+        message = "Spill buffer created, size: " + str(self.size // (1024 * 1024))
+        message += " MB. Directory: " + str(dir_path)
+        self.logger.debug(message)
+
+    def close(self):
+        """ """
+        self.clear()
+        if self.scratch_mmap is not None:
+            self.scratch_mmap.close()
+            self.scratch_mmap = None
+        if self.scratch_file is not None:
+            self.scratch_file.close()
+            self.scratch_file = None
+
+    def clear(self):
+        """ """
+        self.pending.clear()
+        self.head = 0
+        self.tail = 0
+
+    def is_empty(self):
+        """ """
+        return len(self.pending) == 0
+
+    def allocate(self, length):
+        """ Returns offset, or None if full. """
+        if self.is_empty():
+            self.head = 0
+            self.tail = 0
+        if length > self.size:
+            return None
+        if (self.head > self.tail) or self.is_empty():
+            # Not wrapped.
+            if (self.head + length) <= self.size:
+                return self.head
+            if length <= self.tail:
+                return 0  # Wrap to start.
+            return None
+        # Wrapped, or full if head equals tail.
+        if (self.head + length) <= self.tail:
+            return self.head
+        return None
+
+    def spill(self, item):
+        """ Stores an item. Items without sound data are stored in order.
+            Returns False if there is no space left. """
+        data = None
+        if isinstance(item, dict):
+            data = item.get("data", None)
+        if data is None:
+            self.pending.append((item, None, 0))
+            return True
+        if self.scratch_mmap is None:
+            self.open()
+        length = data.nbytes
+        offset = self.allocate(length)
+        if offset is None:
+            return False
+        spill_view = np.frombuffer(
+            self.scratch_mmap, dtype=np.int16, count=len(data), offset=offset
+        )
+        spill_view[:] = data
+        item_without_data = dict(item)
+        item_without_data["data"] = None
+        self.pending.append((item_without_data, offset, length))
+        self.head = offset + length
+        return True
+
+    def spill_file(self, items):
+        """ Stores all items for a sound file, or none of them.
+            Returns False if there is no space left. """
+        head = self.head
+        tail = self.tail
+        pending_length = len(self.pending)
+        for item in items:
+            if not self.spill(item):
+                while len(self.pending) > pending_length:
+                    self.pending.pop()
+                self.head = head
+                self.tail = tail
+                return False
+        return True
+
+    def peek_bytes(self):
+        """ Size of sound data in the next item. """
+        if self.is_empty():
+            return 0
+        return self.pending[0][2]
+
+    def restore(self):
+        """ Returns the oldest item, with a copy of the sound data. """
+        item, offset, length = self.pending.popleft()
+        if offset is None:
+            return item
+        data = np.frombuffer(
+            self.scratch_mmap, dtype=np.int16, count=length // 2, offset=offset
+        ).copy()
+        self.tail = offset + length
+        item["data"] = data
+        # Data is no longer in the ring buffer.
+        item["index"] = None
+        return item
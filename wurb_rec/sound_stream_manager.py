@@ -5,6 +5,213 @@
 # License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
 
 import asyncio
+import logging
+
+
+class SoundBufferQueue(asyncio.Queue):
+    """ Queue for sound buffers, bounded by the number of bytes of
+        sound data in the queue. Items are dicts where "data" contains
+        the sound buffer. Control items (None, False, items without data)
+        are not counted and never dropped.
+        Items for sound files are added with put_file_nowait() and are
+        dropped or spilled as whole files, never the first or last item alone.
+        Drop policies when the byte budget is exceeded:
+            "drop-oldest": Remove the oldest sound buffers in the queue.
+            "drop-newest": Do not add the new sound buffer.
+            "spill": Hand over to "spill_target", drop newest if not available.
+    """
+
+    def __init__(self, maxsize=0, max_bytes=0, drop_policy="drop-oldest", name=""):
+        """ """
+        super().__init__(maxsize=maxsize)
+        self.logger = logging.getLogger("CloudedBats-WURB")
+        self.max_bytes = max_bytes
+        self.drop_policy = drop_policy
+        self.name = name
+        self.spill_target = None
+        self.queued_bytes = 0
+        # Counters.
+        self.dropped_items = 0
+        self.dropped_bytes = 0
+        self.dropped_files = 0
+        self.spilled_items = 0
+
+    def get_item_bytes(self, item):
+        """ """
+        if isinstance(item, dict):
+            data = item.get("data", None)
+            if data is not None:
+                return data.nbytes
+        return 0
+
+    def _put(self, item):
+        """ """
+        super()._put(item)
+        self.queued_bytes += self.get_item_bytes(item)
+
+    def _get(self):
+        """ """
+        item = super()._get()
+        self.queued_bytes -= self.get_item_bytes(item)
+        self.drain_spill()
+        return item
+
+    def is_over_budget(self, item_bytes):
+        """ """
+        if self.max_bytes <= 0:
+            return False
+        return (self.queued_bytes + item_bytes) > self.max_bytes
+
+    def put_nowait(self, item):
+        """ """
+        item_bytes = self.get_item_bytes(item)
+        # Keep order. Spill all new items until the spill target is empty.
+        if (self.spill_target is not None) and (not self.spill_target.is_empty()):
+            self.drain_spill()
+            if not self.spill_target.is_empty():
+                if self.spill_target.spill(item):
+                    if item_bytes > 0:
+                        self.spilled_items += 1
+                else:
+                    self.count_dropped(item_bytes)
+                return
+        if (item_bytes > 0) and self.is_over_budget(item_bytes):
+            if self.drop_policy == "drop-oldest":
+                while self.is_over_budget(item_bytes):
+                    if not self.drop_oldest():
+                        break
+            elif self.drop_policy == "spill" and (self.spill_target is not None):
+                if self.spill_target.spill(item):
+                    self.spilled_items += 1
+                    return
+                self.count_dropped(item_bytes)
+                return
+            else:
+                self.count_dropped(item_bytes)
+                return
+        super().put_nowait(item)
+
+    def put_file_nowait(self, items):
+        """ Items for one sound file, the first item contains "new_file".
+            The file is added, spilled or dropped as a whole. """
+        if not items:
+            return
+        file_bytes = sum(self.get_item_bytes(item) for item in items)
+        # Keep order. Spill all new files until the spill target is empty.
+        if (self.spill_target is not None) and (not self.spill_target.is_empty()):
+            self.drain_spill()
+            if not self.spill_target.is_empty():
+                if self.spill_target.spill_file(items):
+                    self.spilled_items += len(items)
+                else:
+                    self.count_dropped_file(items, file_bytes)
+                return
+        if self.is_file_over_budget(file_bytes, len(items)):
+            if self.drop_policy == "drop-oldest":
+                while self.is_file_over_budget(file_bytes, len(items)):
+                    if not self.drop_oldest_file():
+                        break
+            elif self.drop_policy == "spill" and (self.spill_target is not None):
+                if self.spill_target.spill_file(items):
+                    self.spilled_items += len(items)
+                    return
+            if self.is_file_over_budget(file_bytes, len(items)):
+                self.count_dropped_file(items, file_bytes)
+                return
+        for item in items:
+            super().put_nowait(item)
+
+    def is_file_over_budget(self, file_bytes, file_length):
+        """ A file is always accepted by an empty queue, also if it is
+            larger than the budget. """
+        if (self.maxsize > 0) and ((self.qsize() + file_length) > self.maxsize):
+            return True
+        if self.queued_bytes == 0:
+            return False
+        return self.is_over_budget(file_bytes)
+
+    def is_file_end(self, item):
+        """ """
+        return (item.get("status", "") == "close_file") or item.get(
+            "close_file", False
+        )
+
+    def drain_spill(self):
+        """ Moves spilled items back to the queue when there is room. """
+        if (self.spill_target is None) or self.spill_target.is_empty():
+            return
+        while not self.spill_target.is_empty():
+            item_bytes = self.spill_target.peek_bytes()
+            if (self.qsize() > 0) and self.is_over_budget(item_bytes):
+                break
+            if self.full():
+                break
+            # Bytes are counted in _put().
+            super().put_nowait(self.spill_target.restore())
+
+    def clear_spill(self):
+        """ """
+        if self.spill_target is not None:
+            self.spill_target.clear()
+
+    def drop_oldest(self):
+        """ Removes the oldest sound buffer. Returns False if there is none. """
+        for index, queued_item in enumerate(self._queue):
+            item_bytes = self.get_item_bytes(queued_item)
+            if item_bytes > 0:
+                del self._queue[index]
+                self.queued_bytes -= item_bytes
+                self.task_done()
+                self.count_dropped(item_bytes)
+                return True
+        return False
+
+    def drop_oldest_file(self):
+        """ Removes the oldest sound file. Items before the first "new_file"
+            belong to a file that is already read from the queue, and are kept.
+            Returns False if there is no file to remove. """
+        file_start = None
+        for index, queued_item in enumerate(self._queue):
+            if not isinstance(queued_item, dict):
+                continue
+            if queued_item.get("status", "") == "new_file":
+                file_start = index
+            if (file_start is not None) and self.is_file_end(queued_item):
+                file_bytes = 0
+                for _ in range(file_start, index + 1):
+                    removed_item = self._queue[file_start]
+                    del self._queue[file_start]
+                    item_bytes = self.get_item_bytes(removed_item)
+                    self.queued_bytes -= item_bytes
+                    file_bytes += item_bytes
+                    self.task_done()
+                self.count_dropped(file_bytes, items=index + 1 - file_start)
+                self.dropped_files += 1
+                return True
+        return False
+
+    def count_dropped_file(self, items, file_bytes):
+        """ """
+        self.count_dropped(file_bytes, items=len(items))
+        self.dropped_files += 1
+
+    def count_dropped(self, item_bytes, items=1):
+        """ """
+        if self.dropped_items == 0:
+            message = "Sound buffers dropped, queue budget exceeded: " + self.name
+            self.logger.warning(message)
+        self.dropped_items += items
+        self.dropped_bytes += item_bytes
+
+    def get_statistics(self):
+        """ """
+        return {
+            "queue": self.name,
+            "dropped_items": self.dropped_items,
+            "dropped_bytes": self.dropped_bytes,
+            "dropped_files": self.dropped_files,
+            "spilled_items": self.spilled_items,
+        }
 
 
 class SoundStreamManager(object):
@@ -16,10 +223,12 @@ class SoundStreamManager(object):
             Source ---> Queue ---> Process ---> Queue ---> Target
     """
 
-    def __init__(self, queue_max_size=120):
+    def __init__(self, queue_max_size=120, queue_max_bytes=0, queue_drop_policy="drop-oldest"):
         """ """
         try:
             self.queue_max_size = queue_max_size
+            self.queue_max_bytes = queue_max_bytes
+            self.queue_drop_policy = queue_drop_policy
             self.clear()
         except Exception as e:
             print("Exception: SoundStreamManager: init:", e)
@@ -27,15 +236,22 @@ class SoundStreamManager(object):
     def clear(self):
         """ """
         try:
-            self.from_source_queue = asyncio.Queue(maxsize=self.queue_max_size)
-            self.to_target_queue = asyncio.Queue(maxsize=self.queue_max_size)
-            self.to_classify_queue = asyncio.Queue(maxsize=self.queue_max_size)
-            self.to_database_queue = asyncio.Queue(maxsize=self.queue_max_size)
+            # Queues for sound buffers are also limited by size in bytes.
+            self.from_source_queue = SoundBufferQueue(
+                maxsize=self.queue_max_size,
+                max_bytes=self.queue_max_bytes,
+                drop_policy=self.queue_drop_policy,
+                name="from_source_queue",
+            )
+            self.to_target_queue = SoundBufferQueue(
+                maxsize=self.queue_max_size,
+                max_bytes=self.queue_max_bytes,
+                drop_policy=self.queue_drop_policy,
+                name="to_target_queue",
+            )
             self.source_task = None
             self.process_task = None
             self.target_task = None
-            self.classify_task = None
-            self.database_task = None
         except Exception as e:
             print("Exception: SoundStreamManager: clear:", e)
 
@@ -46,9 +262,6 @@ class SoundStreamManager(object):
             self.source_task = asyncio.create_task(self.sound_source_worker())
             self.process_task = asyncio.create_task(self.sound_process_worker())
             self.target_task = asyncio.create_task(self.sound_target_worker())
-            if self.wurb_settings.get_setting("classification_algorithm") == "classification-batclassify":
-                self.classify_task = asyncio.create_task(self.sound_classify_worker())
-                self.database_task = asyncio.create_task(self.sound_database_worker())
         except Exception as e:
             print("Exception: SoundStreamManager: start_streaming:", e)
 
@@ -63,13 +276,8 @@ class SoundStreamManager(object):
                     self.process_task.cancel()
                 if self.target_task:
                     self.target_task.cancel()
-                if self.classify_task:
-                    self.classify_task.cancel()
-                if self.database_task:
-                    self.database_task.cancel()
             else:
-                # Stop source only and let process, target, classify and database
-                # finish their work.
+                # Stop source only and let process and target finish their work.
                 if self.source_task:
                     self.source_task.cancel()
                     await self.from_source_queue.put(None)  # Terminate.
@@ -179,6 +387,8 @@ class SoundStreamManager(object):
     async def remove_items_from_queue(self, queue):
         """ Helper method. """
         try:
+            if isinstance(queue, SoundBufferQueue):
+                queue.clear_spill()
             while True:
                 try:
                     queue.get_nowait()
@@ -1,6 +1,6 @@
 
 function checkClassificationPossibility() {
-  if (settings_rec_length_id.value > 12 || settings_rec_type_id.value == "TE" || ['mode-on', 'mode-scheduler-on'].includes(detector_mode_select_id.value)) {
+  if (settings_rec_length_id.value > 12 || settings_rec_type_id.value == "TE" || settings_rec_file_format_id.value == "format-flac" || ['mode-on', 'mode-scheduler-on'].includes(detector_mode_select_id.value)) {
     return false
   } else {
     return true
@@ -59,6 +59,15 @@ function recTypeOnChange() {
   }
 }
 
+function recFileFormatOnChange() {
+  // disable classification option if FLAC is used
+  if (settings_rec_file_format_id.value == "format-flac") {
+    document.getElementById("settings_classification_algorithm_id").disabled = true;
+  } else if (checkClassificationPossibility()){
+    document.getElementById("settings_classification_algorithm_id").disabled = false;
+  }
+}
+
 async function saveLocationSource() {
   try {
     let location = {
@@ -163,13 +172,19 @@ async function saveSettings(settings_type) {
       rec_mode: detector_mode_select_id.value,
       file_directory: settings_file_directory_id.value,
       file_directory_date_option: settings_file_directory_date_option_id.value,
+      file_directory_shard_option: settings_file_directory_shard_option_id.value,
       filename_prefix: settings_filename_prefix_id.value,
       detection_limit_khz: settings_detection_limit_id.value,
       detection_sensitivity_dbfs: settings_detection_sensitivity_id.value,
       detection_algorithm: settings_detection_algorithm_id.value,
       classification_algorithm: classification_algorithm,
       rec_length_s: settings_rec_length_id.value,
+      rec_length_option: settings_rec_length_option_id.value,
+      rec_pre_trigger_s: settings_rec_pre_trigger_id.value,
+      rec_post_trigger_s: settings_rec_post_trigger_id.value,
       rec_type: settings_rec_type_id.value,
+      rec_file_format: settings_rec_file_format_id.value,
+      rec_sparse_option: settings_rec_sparse_option_id.value,
       feedback_on_off: settings_feedback_on_off_id.value,
       feedback_volume: feedback_volume_slider_id.value,
       feedback_pitch: feedback_pitch_slider_id.value,
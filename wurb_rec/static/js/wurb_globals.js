@@ -28,13 +28,19 @@ function define_global_variables() {
   // Fields and buttons.
   const settings_file_directory_id = document.getElementById("settings_file_directory_id");
   const settings_file_directory_date_option_id = document.getElementById("settings_file_directory_date_option_id");
+  const settings_file_directory_shard_option_id = document.getElementById("settings_file_directory_shard_option_id");
   const settings_filename_prefix_id = document.getElementById("settings_filename_prefix_id");
   const settings_detection_limit_id = document.getElementById("settings_detection_limit_id");
   const settings_detection_sensitivity_id = document.getElementById("settings_detection_sensitivity_id");
   const settings_detection_algorithm_id = document.getElementById("settings_detection_algorithm_id");
   const settings_classification_algorithm_id = document.getElementById("settings_classification_algorithm_id");
   const settings_rec_length_id = document.getElementById("settings_rec_length_id");
+  const settings_rec_length_option_id = document.getElementById("settings_rec_length_option_id");
+  const settings_rec_pre_trigger_id = document.getElementById("settings_rec_pre_trigger_id");
+  const settings_rec_post_trigger_id = document.getElementById("settings_rec_post_trigger_id");
   const settings_rec_type_id = document.getElementById("settings_rec_type_id");
+  const settings_rec_file_format_id = document.getElementById("settings_rec_file_format_id");
+  const settings_rec_sparse_option_id = document.getElementById("settings_rec_sparse_option_id");
   const settings_feedback_on_off_id = document.getElementById("settings_feedback_on_off_id");
   const settings_feedback_filter_low_id = document.getElementById("settings_feedback_filter_low_id");
   const settings_feedback_filter_high_id = document.getElementById("settings_feedback_filter_high_id");
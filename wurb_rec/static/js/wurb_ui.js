@@ -255,13 +255,19 @@ function updateSettings(settings) {
   detector_mode_select_id.value = settings.rec_mode
   settings_file_directory_id.value = settings.file_directory
   settings_file_directory_date_option_id.value = settings.file_directory_date_option
+  settings_file_directory_shard_option_id.value = settings.file_directory_shard_option
   settings_filename_prefix_id.value = settings.filename_prefix
   settings_detection_limit_id.value = settings.detection_limit_khz
   settings_detection_sensitivity_id.value = settings.detection_sensitivity_dbfs
   settings_detection_algorithm_id.value = settings.detection_algorithm
   settings_classification_algorithm_id = settings.classification_algorithm
   settings_rec_length_id.value = settings.rec_length_s
+  settings_rec_length_option_id.value = settings.rec_length_option
+  settings_rec_pre_trigger_id.value = settings.rec_pre_trigger_s
+  settings_rec_post_trigger_id.value = settings.rec_post_trigger_s
   settings_rec_type_id.value = settings.rec_type
+  settings_rec_file_format_id.value = settings.rec_file_format
+  settings_rec_sparse_option_id.value = settings.rec_sparse_option
   settings_feedback_on_off_id.value = settings.feedback_on_off
   feedback_volume_slider_id.value = settings.feedback_volume
   feedback_pitch_slider_id.value = settings.feedback_pitch
@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org, https://github.com/cloudedbats
+# Copyright (c) 2020-present Arnold Andreasson
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import asyncio
+import concurrent.futures
+import os
+import pathlib
+import numpy as np
+import guano
+import wurb_rec
+
+try:
+    import soundfile
+except ImportError:
+    soundfile = None  # Archiving not available.
+
+
+class WurbArchiver(object):
+    """ Converts recorded WAV files to lossless FLAC when the detector is
+        idle, normally during the day when the scheduler has turned the
+        microphone off. Conversion is done in a separate process with low
+        priority, and each file is read back and compared before the WAV
+        file is removed. New files are not started when recording restarts.
+        Only files in the recordings index are converted.
+    """
+
+    def __init__(self, wurb_manager):
+        """ """
+        self.wurb_manager = wurb_manager
+        self.wurb_logging = wurb_manager.wurb_logging
+        self.main_loop_task = None
+        self.executor = None
+        self.files_converted = 0
+        self.files_failed = 0
+        self.failed_filepaths = set()  # Not tried again in this session.
+        self.saved_bytes = 0
+        # Config.
+        self.archive_active = os.getenv("WURB_REC_ARCHIVE_FLAC", "false") == "true"
+        self.max_workers = int(os.getenv("WURB_REC_ARCHIVE_WORKERS", "1"))
+        self.main_loop_interval_s = 60  # Unit: sec.
+        self.files_per_batch = 10
+
+    async def startup(self):
+        """ """
+        if not self.archive_active:
+            return
+        if soundfile is None:
+            # Logging.
+            message = "Archiver: FLAC not available, install soundfile."
+            self.wurb_logging.warning(message, short_message=message)
+            return
+        if not self.main_loop_task:
+            self.main_loop_task = asyncio.create_task(self.main_loop())
+
+    async def shutdown(self):
+        """ """
+        if self.main_loop_task:
+            self.main_loop_task.cancel()
+            self.main_loop_task = None
+        self.stop_executor()
+
+    def stop_executor(self):
+        """ """
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    async def main_loop(self):
+        """ """
+        try:
+            while True:
+                try:
+                    await asyncio.sleep(self.main_loop_interval_s)
+                    if await self.wurb_manager.wurb_scheduler.is_detector_idle():
+                        await self.archive_files()
+                    else:
+                        # Free memory used by the worker processes.
+                        self.stop_executor()
+                except asyncio.CancelledError:
+                    break
+                except Exception as e:
+                    # Logging error.
+                    message = "Archiver: main_loop: " + str(e)
+                    self.wurb_manager.wurb_logging.error(message, short_message=message)
+        except Exception as e:
+            # Logging error.
+            message = "Archiver main loop: " + str(e)
+            self.wurb_manager.wurb_logging.error(message, short_message=message)
+        finally:
+            # Logging debug.
+            message = "Archiver main loop terminated."
+            self.wurb_manager.wurb_logging.debug(message)
+
+    async def archive_files(self):
+        """ Converts files in small batches until all are done or the
+            detector is no longer idle. """
+        wurb_retention = self.wurb_manager.wurb_retention
+        # Files waiting for classification must be kept as WAV files.
+        skip_priority = None
+        if self.wurb_manager.wurb_classify_scheduler.is_active():
+            skip_priority = 1
+        files_before = self.files_converted
+        loop = asyncio.get_event_loop()
+        while True:
+            filepaths = await wurb_retention.get_wave_files(
+                skip_priority=skip_priority,
+                limit=self.files_per_batch + len(self.failed_filepaths),
+            )
+            filepaths = [path for path in filepaths if path not in self.failed_filepaths]
+            if not filepaths:
+                break
+            for filepath in filepaths:
+                if not await self.wurb_manager.wurb_scheduler.is_detector_idle():
+                    # Logging.
+                    message = "Archiver: Paused, recording is active."
+                    self.wurb_logging.info(message, short_message=message)
+                    return
+                if self.executor is None:
+                    self.executor = concurrent.futures.ProcessPoolExecutor(
+                        max_workers=self.max_workers, initializer=wurb_rec.set_low_priority
+                    )
+                try:
+                    result = await loop.run_in_executor(
+                        self.executor, convert_to_flac, filepath
+                    )
+                    flac_filepath, size_bytes, saved_bytes = result
+                except Exception as e:
+                    self.files_failed += 1
+                    self.failed_filepaths.add(filepath)
+                    # Logging error.
+                    message = "Archiver: " + pathlib.Path(filepath).name + ": " + str(e)
+                    self.wurb_manager.wurb_logging.error(message, short_message=message)
+                    continue
+                await wurb_retention.replace_file(filepath, flac_filepath, size_bytes)
+                await self.wurb_manager.wurb_database.update_filepath(
+                    filepath, flac_filepath
+                )
+                self.files_converted += 1
+                self.saved_bytes += saved_bytes
+        if self.files_converted > files_before:
+            # Logging.
+            message = "Archiver: " + str(self.files_converted - files_before)
+            message += " sound files converted to FLAC."
+            self.wurb_logging.info(message, short_message=message)
+            # Logging debug.
+            message = "Archiver statistics: " + str(self.get_statistics())
+            self.wurb_logging.debug(message=message)
+
+    def get_statistics(self):
+        """ """
+        return {
+            "files_converted": self.files_converted,
+            "files_failed": self.files_failed,
+            "saved_mb": round(self.saved_bytes / 2 ** 20, 1),
+        }
+
+
+def convert_to_flac(wave_filepath, block_size=384000):
+    """ Runs in a worker process. The FLAC file is verified against the
+        WAV file before the WAV file is removed.
+        Returns (flac_filepath, flac_size_bytes, saved_bytes). """
+    wave_path = pathlib.Path(wave_filepath)
+    flac_path = wave_path.with_suffix(".flac")
+    part_path = wave_path.with_suffix(".flac.part")
+    # Metadata from the 'guan' chunk, stored in the FLAC comment field.
+    comment = guano.GuanoFile(str(wave_path)).to_string()
+    try:
+        with soundfile.SoundFile(str(wave_path)) as wave_file:
+            sampling_freq_hz = wave_file.samplerate
+            with soundfile.SoundFile(
+                str(part_path),
+                "w",
+                samplerate=sampling_freq_hz,
+                channels=1,
+                subtype="PCM_16",
+                format="FLAC",
+            ) as flac_file:
+                # Text must be set before sound data is written.
+                if comment:
+                    flac_file.comment = comment
+                for block in wave_file.blocks(blocksize=block_size, dtype="int16"):
+                    flac_file.write(block)
+        # Verify.
+        with soundfile.SoundFile(str(wave_path)) as wave_file:
+            with soundfile.SoundFile(str(part_path)) as flac_file:
+                if (flac_file.samplerate != sampling_freq_hz) or (
+                    flac_file.frames != wave_file.frames
+                ):
+                    raise ValueError("Verification failed, length or sampling freq.")
+                while True:
+                    wave_block = wave_file.read(block_size, dtype="int16")
+                    flac_block = flac_file.read(block_size, dtype="int16")
+                    if not np.array_equal(wave_block, flac_block):
+                        raise ValueError("Verification failed, sound data.")
+                    if len(wave_block) == 0:
+                        break
+        os.replace(str(part_path), str(flac_path))
+    except Exception:
+        if part_path.exists():
+            part_path.unlink()
+        raise
+    wave_size = wave_path.stat().st_size
+    flac_size = flac_path.stat().st_size
+    wave_path.unlink()
+    return str(flac_path), flac_size, wave_size - flac_size
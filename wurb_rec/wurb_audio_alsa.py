@@ -144,10 +144,14 @@ class AlsaMixer:
 class AlsaSoundCapture:
     """ """
 
-    def __init__(self, data_queue=None, direct_target=None):
+    def __init__(
+        self, data_queue=None, direct_target=None, process_target=None, ring_buffer=None
+    ):
         """ """
         self.data_queue = data_queue
         self.direct_target = direct_target
+        self.process_target = process_target
+        self.ring_buffer = ring_buffer
         self.card_index = None
         self.sampling_freq = None
         self.buffer_size = None
@@ -225,6 +229,14 @@ class AlsaSoundCapture:
                         data_int16 = in_buffer_int16[0:self.buffer_size]
                         in_buffer_int16 = in_buffer_int16[self.buffer_size:]
 
+                        # Copy once to the ring buffer. Views are used after that.
+                        ring_index = None
+                        if self.ring_buffer:
+                            ring_index = self.ring_buffer.write(data_int16)
+                            data_int16 = self.ring_buffer.get_data(
+                                ring_index, self.buffer_size
+                            )
+
                         # Use data queue.
                         if self.data_queue:
                             # Time rounded to half sec.
@@ -232,20 +244,33 @@ class AlsaSoundCapture:
                             device_time = int((calculated_time_s) * 2) / 2
                             # Used to detect time drift.
                             detector_time = time.time()
-                            # Copy data.
-                            data_int16_copy = data_int16.copy()
+                            # Copy data if not in ring buffer.
+                            if ring_index is None:
+                                data_int16_copy = data_int16.copy()
+                            else:
+                                data_int16_copy = data_int16
                             # Put together.
                             data_dict = {
                                 "status": "data",
                                 "adc_time": device_time,
                                 "detector_time": detector_time,
+                                "index": ring_index,
+                                "ring_buffer": self.ring_buffer,
                                 "data": data_int16_copy,
                             }
                             try:
-                                if not self.data_queue.full():
-                                    self.main_loop.call_soon_threadsafe(
-                                        self.data_queue.put_nowait, data_dict
+                                # The process target must contain the method process_buffer().
+                                if self.process_target:
+                                    queue_items = self.process_target.process_buffer(
+                                        data_dict
                                     )
+                                else:
+                                    queue_items = [data_dict]
+                                for queue_item in queue_items:
+                                    if not self.data_queue.full():
+                                        self.main_loop.call_soon_threadsafe(
+                                            self.data_queue.put_nowait, queue_item
+                                        )
                             #
                             except Exception as e:
                                 # Logging error.
@@ -257,7 +282,10 @@ class AlsaSoundCapture:
                             # The target object must contain the methods is_active() and add_data().
                             try:
                                 if self.direct_target.is_active():
-                                    data_int16_copy = data_int16.copy()
+                                    if ring_index is None:
+                                        data_int16_copy = data_int16.copy()
+                                    else:
+                                        data_int16_copy = data_int16
                                     self.main_loop.call_soon_threadsafe(
                                         self.direct_target.add_data, data_int16_copy
                                     )
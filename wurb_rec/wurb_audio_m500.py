@@ -17,10 +17,14 @@ import wurb_rec
 class PetterssonM500():
     """ """
 
-    def __init__(self, data_queue=None, direct_target=None):
+    def __init__(
+        self, data_queue=None, direct_target=None, process_target=None, ring_buffer=None
+    ):
         """ """
         self.data_queue = data_queue
         self.direct_target = direct_target
+        self.process_target = process_target
+        self.ring_buffer = ring_buffer
         self.card_index = None
         self.buffer_size = None
         # M500.
@@ -102,26 +106,47 @@ class PetterssonM500():
                         data_buffer.tostring(), dtype=numpy.int16
                     )  # To ndarray.
 
+                    # Copy once to the ring buffer. Views are used after that.
+                    ring_index = None
+                    if self.ring_buffer:
+                        ring_index = self.ring_buffer.write(data_int16)
+                        data_int16 = self.ring_buffer.get_data(
+                            ring_index, len(data_int16)
+                        )
+
                     # Use data queue.
                     if self.data_queue:
                         # Round to half seconds.
                         buffer_adc_time = int((self.stream_time_s) * 2) / 2
                         detector_time = time.time()
-                        # Copy data.
-                        data_int16_copy = data_int16.copy()
+                        # Copy data if not in ring buffer.
+                        if ring_index is None:
+                            data_int16_copy = data_int16.copy()
+                        else:
+                            data_int16_copy = data_int16
                         # Put together.
                         send_dict = {
                             "status": "data",
                             "adc_time": buffer_adc_time,
                             "detector_time": detector_time,
+                            "index": ring_index,
+                            "ring_buffer": self.ring_buffer,
                             "data": data_int16_copy,
                         }
                         # Add to queue in main event loop.
                         try:
-                            if not self.data_queue.full():
-                                self.main_loop.call_soon_threadsafe(
-                                    self.data_queue.put_nowait, send_dict
+                            # The process target must contain the method process_buffer().
+                            if self.process_target:
+                                queue_items = self.process_target.process_buffer(
+                                    send_dict
                                 )
+                            else:
+                                queue_items = [send_dict]
+                            for queue_item in queue_items:
+                                if not self.data_queue.full():
+                                    self.main_loop.call_soon_threadsafe(
+                                        self.data_queue.put_nowait, queue_item
+                                    )
                         except Exception as e:
                             # Logging error.
                             message = "Failed to put buffer on queue (M500): " + str(e)
@@ -133,7 +158,10 @@ class PetterssonM500():
                         # The target object must contain the methods is_active() and add_data().
                         try:
                             if self.direct_target.is_active():
-                                data_int16_copy = data_int16.copy()
+                                if ring_index is None:
+                                    data_int16_copy = data_int16.copy()
+                                else:
+                                    data_int16_copy = data_int16
                                 self.main_loop.call_soon_threadsafe(
                                     self.direct_target.add_data, data_int16_copy
                                 )
@@ -0,0 +1,450 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org, https://github.com/cloudedbats
+# Copyright (c) 2020-present Arnold Andreasson
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import asyncio
+import hashlib
+import json
+import os
+import pty
+import shlex
+import shutil
+import threading
+import numpy as np
+
+
+class BatClassifyProcess(object):
+    """ One long-lived BatClassify process. File paths are written to
+        stdin and results are read from stdout. Stdout is connected to a
+        pseudo-terminal, as BatClassify only flushes the prompt when
+        running in a terminal. Used from the event loop only.
+    """
+
+    def __init__(self, wurb_manager, command, worker_id):
+        """ """
+        self.wurb_manager = wurb_manager
+        self.command = command
+        self.worker_id = worker_id
+        self.process = None
+        self.reader = None
+        self.transport = None
+        self.in_flight = None  # Item being classified.
+        self.failed = False  # True if the process could not be started.
+        self.files_classified = 0
+        # Config.
+        self.prompt = b"inputfile:"
+        self.startup_timeout_s = 180  # Models are loaded at startup.
+        self.classify_timeout_s = 120
+
+    async def start(self):
+        """ Returns when the process is ready for the first file. """
+        loop = asyncio.get_event_loop()
+        master_fd, slave_fd = pty.openpty()
+        try:
+            self.process = await asyncio.create_subprocess_exec(
+                *shlex.split(self.command),
+                stdin=asyncio.subprocess.PIPE,
+                stdout=slave_fd,
+                stderr=asyncio.subprocess.DEVNULL,
+                preexec_fn=set_low_priority,
+            )
+        except Exception:
+            os.close(master_fd)
+            raise
+        finally:
+            os.close(slave_fd)
+        self.reader = asyncio.StreamReader()
+        self.transport, _protocol = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(self.reader),
+            os.fdopen(master_fd, "rb", 0),
+        )
+        # Readiness handshake, instead of a fixed delay.
+        await asyncio.wait_for(
+            self.reader.readuntil(self.prompt), timeout=self.startup_timeout_s
+        )
+
+    async def classify(self, filepath):
+        """ Returns the result as a dict with probability for each species. """
+        self.process.stdin.write((str(filepath) + "\n").encode())
+        await self.process.stdin.drain()
+        result = await asyncio.wait_for(
+            self.read_result(), timeout=self.classify_timeout_s
+        )
+        self.files_classified += 1
+        return result
+
+    async def read_result(self):
+        """ The result is a JSON line followed by the next prompt. Errors
+            for a file are also followed by the prompt, without a result.
+            Raises ValueError if there is no result, the process is then
+            ready for the next file. """
+        try:
+            output = await self.reader.readuntil(self.prompt)
+        except asyncio.IncompleteReadError:
+            raise EOFError("BatClassify terminated.")
+        for line in output.splitlines():
+            line = line.strip()
+            if line.startswith(b"{"):
+                return json.loads(line.decode())
+        message = output[: -len(self.prompt)].decode(errors="replace").strip()
+        raise ValueError("No result from BatClassify. " + message)
+
+    async def stop(self):
+        """ """
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        if self.process is not None:
+            if self.process.returncode is None:
+                try:
+                    self.process.kill()
+                except ProcessLookupError:
+                    pass
+                await self.process.wait()
+            self.process = None
+
+
+class BatClassifyPool(object):
+    """ A pool of BatClassify processes, to use more than one CPU core.
+        Files are handed to the first idle process and results are
+        delivered to the result queue in the order they are ready.
+        A process that fails is restarted.
+    """
+
+    def __init__(self, wurb_manager, result_queue):
+        """ """
+        self.wurb_manager = wurb_manager
+        self.wurb_logging = wurb_manager.wurb_logging
+        self.result_queue = result_queue
+        self.workers = []
+        self.idle_workers = asyncio.Queue()
+        self.pending_tasks = set()
+        self.files_failed = 0
+        # Config.
+        self.command = os.getenv("WURB_REC_CLASSIFY_COMMAND", "BatClassify")
+        self.number_of_workers = int(os.getenv("WURB_REC_CLASSIFY_WORKERS", "2"))
+
+    async def startup(self, number_of_workers=1):
+        """ Processes are started in parallel. Files are handed out as soon
+            as the first process is ready. """
+        self.add_workers(number_of_workers)
+
+    def add_workers(self, number_of_workers):
+        """ The pool grows up to "number_of_workers" processes, but not more
+            than configured. Models are loaded at startup, processes are
+            only started when they are allowed to be used. """
+        number_of_workers = min(number_of_workers, max(1, self.number_of_workers))
+        while len(self.workers) < number_of_workers:
+            worker_id = len(self.workers)
+            worker = BatClassifyProcess(self.wurb_manager, self.command, worker_id)
+            self.workers.append(worker)
+            self.start_task(self.start_worker(worker))
+
+    def start_task(self, coroutine):
+        """ """
+        task = asyncio.ensure_future(coroutine)
+        self.pending_tasks.add(task)
+        task.add_done_callback(self.pending_tasks.discard)
+
+    async def start_worker(self, worker):
+        """ """
+        try:
+            await worker.start()
+            worker.failed = False
+            self.idle_workers.put_nowait(worker)
+            # Logging debug.
+            message = "BatClassify process " + str(worker.worker_id) + " started."
+            self.wurb_logging.debug(message=message)
+        except Exception as e:
+            await worker.stop()
+            worker.failed = True
+            # Wake up a waiting classify() call, to check if all have failed.
+            self.idle_workers.put_nowait(None)
+            # Logging error.
+            message = "Classifier: Failed to start BatClassify: " + str(e)
+            self.wurb_manager.wurb_logging.error(message, short_message=message)
+
+    async def classify(self, item):
+        """ Waits for an idle process. The result is delivered later.
+            Returns False if there is no process to classify the file. """
+        worker = None
+        while worker is None:
+            if all([w.failed for w in self.workers]):
+                # Logging.
+                message = "Classifier: No BatClassify process, files not classified."
+                self.wurb_logging.warning(message, short_message=message)
+                return False
+            worker = await self.idle_workers.get()
+        worker.in_flight = item
+        self.start_task(self.classify_in_worker(worker, item))
+        return True
+
+    async def classify_in_worker(self, worker, item):
+        """ """
+        try:
+            result = await worker.classify(item["filepath"])
+            # Other fields, like the content hash, are kept.
+            result_item = dict(item)
+            result_item["batclassify"] = result
+            result_item["filepath"] = str(item["filepath"])
+            await self.result_queue.put(result_item)
+            worker.in_flight = None
+            self.idle_workers.put_nowait(worker)
+        except ValueError as e:
+            # No result for the file, the process is waiting for the next.
+            self.files_failed += 1
+            worker.in_flight = None
+            self.idle_workers.put_nowait(worker)
+            await self.wurb_manager.wurb_classify_queue.release(item["filepath"])
+            # Logging error.
+            message = "Classifier: " + str(item["filename"]) + ": " + str(e)
+            self.wurb_manager.wurb_logging.error(message, short_message=message)
+        except Exception as e:
+            self.files_failed += 1
+            worker.in_flight = None
+            # Tried again later, from the classify queue.
+            await self.wurb_manager.wurb_classify_queue.release(item["filepath"])
+            # Logging error.
+            message = "Classifier: " + str(item["filename"]) + ": " + repr(e)
+            self.wurb_manager.wurb_logging.error(message, short_message=message)
+            # The process state is unknown, restart it.
+            await worker.stop()
+            await self.start_worker(worker)
+
+    async def wait_for_pending(self):
+        """ Waits for files in progress. """
+        while self.pending_tasks:
+            await asyncio.gather(*list(self.pending_tasks), return_exceptions=True)
+
+    async def shutdown(self):
+        """ """
+        for task in list(self.pending_tasks):
+            task.cancel()
+        for worker in self.workers:
+            await worker.stop()
+        # Logging debug.
+        message = "Classifier statistics: " + str(self.get_statistics())
+        self.wurb_logging.debug(message=message)
+
+    def get_statistics(self):
+        """ """
+        return {
+            "files_classified": sum([w.files_classified for w in self.workers]),
+            "files_failed": self.files_failed,
+            "in_flight": len([w for w in self.workers if w.in_flight is not None]),
+        }
+
+
+class SoundClassification(object):
+    """ Selects the in-process classifier plugin, if any, for the
+        "classification_algorithm" setting. """
+
+    def __init__(self, wurb_manager):
+        """ """
+        self.wurb_manager = wurb_manager
+        self.wurb_settings = wurb_manager.wurb_settings
+
+    def get_classifier_config(self):
+        """ Settings used by the classifiers. """
+        return {
+            "classification_algorithm": self.wurb_settings.get_setting(
+                "classification_algorithm"
+            ),
+            "model_path": os.getenv("WURB_REC_CLASSIFY_MODEL", ""),
+        }
+
+    def is_plugin_selected(self):
+        """ """
+        algorithm = self.wurb_settings.get_setting("classification_algorithm")
+        return algorithm in classifier_plugins
+
+    def get_classifier(self):
+        """ Select classifier plugin. None if not an in-process classifier. """
+        return create_classifier(self.get_classifier_config())
+
+
+def register_classifier(algorithm, classifier_class):
+    """ Classifier plugins are registered with the value used for the
+        "classification_algorithm" setting. """
+    classifier_plugins[algorithm] = classifier_class
+
+
+def create_classifier(classifier_config):
+    """ Select classifier plugin. """
+    algorithm = classifier_config.get("classification_algorithm", "")
+    classifier_class = classifier_plugins.get(algorithm, None)
+    if classifier_class is None:
+        return None
+    classifier_object = classifier_class()
+    classifier_object.config(classifier_config)
+    return classifier_object
+
+
+class ClassifierBase:
+    """ In-process classifier plugin. Sound data is classified in batches
+        on a worker thread, the event loop and manager can't be used here.
+    """
+
+    def __init__(self):
+        """ """
+        self.name = ""  # Used for the "Wurb|Classifier" metadata field.
+        self.version = ""  # Changed when results may differ.
+
+    def config(self, classifier_config):
+        """ Abstract. """
+        pass  # Should be overridden.
+
+    def classify_batch(self, batch):
+        """ Abstract. "batch" is a list of (data_int16, sampling_freq_hz)
+            tuples, one for each file. Returns a list with a dict for each
+            file, with probability (0.0 to 1.0) for each species. """
+        return [{} for _ in batch]  # Should be overridden.
+
+
+class ClassifierSpectrumModel(ClassifierBase):
+    """ Linear model on the mean spectrum for the loudest frames in each
+        file. Used as a stand-in until a trained model is available.
+        The built-in weights are based on typical peak frequencies. Trained
+        weights can be loaded from a NumPy .npz file with "species",
+        "band_edges_khz", "weights" (species x bands) and "bias".
+    """
+
+    # Species names and limits as used for BatClassify.
+    # Peak frequency and bandwidth in kHz, for the built-in weights.
+    species_peaks_khz = {
+        "Bbar": (33.0, 3.0),
+        "Malc": (50.0, 10.0),
+        "Mbec": (48.0, 10.0),
+        "MbraMmys": (45.0, 10.0),
+        "Mdau": (42.0, 10.0),
+        "Mnat": (40.0, 12.0),
+        "NSL": (25.0, 5.0),
+        "Paur": (35.0, 10.0),
+        "Ppip": (46.0, 3.0),
+        "Ppyg": (55.0, 3.0),
+        "Rfer": (82.0, 1.5),
+        "Rhip": (110.0, 2.0),
+    }
+
+    def __init__(self):
+        """ """
+        super(ClassifierSpectrumModel, self).__init__()
+        self.name = "Spectrum model"
+        self.version = "1"
+        self.species = []
+        self.band_edges_hz = None
+        self.weights = None
+        self.bias = None
+        # Config.
+        self.frame_length = 1024
+        self.max_frames = 64  # Loudest frames used in each file.
+
+    def config(self, classifier_config):
+        """ """
+        model_path = classifier_config.get("model_path", "")
+        if model_path:
+            with np.load(model_path) as model:
+                self.species = [str(name) for name in model["species"]]
+                self.band_edges_hz = np.asarray(model["band_edges_khz"]) * 1000.0
+                self.weights = np.asarray(model["weights"], dtype=np.float32)
+                self.bias = np.asarray(model["bias"], dtype=np.float32)
+            self.name = "Spectrum model " + os.path.basename(model_path)
+            with open(model_path, "rb") as model_file:
+                self.version = hashlib.blake2b(
+                    model_file.read(), digest_size=8
+                ).hexdigest()
+        else:
+            band_edges_khz = np.arange(10.0, 132.5, 2.5)
+            band_centers_khz = (band_edges_khz[:-1] + band_edges_khz[1:]) / 2
+            self.species = list(self.species_peaks_khz.keys())
+            self.band_edges_hz = band_edges_khz * 1000.0
+            templates = []
+            for peak_khz, bandwidth_khz in self.species_peaks_khz.values():
+                template = np.exp(
+                    -0.5 * ((band_centers_khz - peak_khz) / bandwidth_khz) ** 2
+                )
+                # Centered, flat noise gives zero.
+                template -= template.mean()
+                templates.append(template / np.linalg.norm(template))
+            # Cosine similarity with the features, probability 0.5 at 0.5.
+            self.weights = 16.0 * np.array(templates, dtype=np.float32)
+            self.bias = np.full(len(self.species), -8.0, dtype=np.float32)
+        self.window = np.hanning(self.frame_length).astype(np.float32)
+
+    def get_features(self, data_int16, sampling_freq_hz):
+        """ Energy in each frequency band, normalized to unit length. """
+        number_of_frames = len(data_int16) // self.frame_length
+        features = np.zeros(len(self.band_edges_hz) - 1, dtype=np.float32)
+        if number_of_frames == 0:
+            return features
+        frames = data_int16[: number_of_frames * self.frame_length].reshape(
+            number_of_frames, self.frame_length
+        )
+        frames = frames.astype(np.float32)
+        energy = np.einsum("ij,ij->i", frames, frames)
+        loudest = np.argsort(energy)[-self.max_frames :]
+        spectra = np.abs(np.fft.rfft(frames[loudest] * self.window, axis=1)) ** 2
+        freqs_hz = np.fft.rfftfreq(self.frame_length, 1.0 / sampling_freq_hz)
+        band_energy, _edges = np.histogram(
+            freqs_hz, bins=self.band_edges_hz, weights=spectra.mean(axis=0)
+        )
+        norm = np.linalg.norm(band_energy)
+        if norm > 0.0:
+            features[:] = band_energy / norm
+        return features
+
+    def classify_batch(self, batch):
+        """ All files in the batch are classified in one matrix operation. """
+        if not batch:
+            return []
+        features = np.array(
+            [self.get_features(data, freq_hz) for data, freq_hz in batch],
+            dtype=np.float32,
+        )
+        logits = features @ self.weights.T + self.bias
+        probabilities = 1.0 / (1.0 + np.exp(-logits))
+        results = []
+        for row in probabilities:
+            results.append(
+                {name: round(float(prob), 3) for name, prob in zip(self.species, row)}
+            )
+        return results
+
+
+# In-process classifiers, by "classification_algorithm". BatClassify runs
+# in external processes and is not a plugin.
+classifier_plugins = {
+    "classification-spectrum-model": ClassifierSpectrumModel,
+}
+
+
+def get_command_version(command):
+    """ Program path, size and modification time for a command line. Used
+        as version for BatClassify, which has no version option. """
+    args = shlex.split(command)
+    if not args:
+        return command
+    program_path = shutil.which(args[0])
+    if program_path is None:
+        return command
+    stat = os.stat(program_path)
+    return " ".join(
+        [command, program_path, str(stat.st_size), str(int(stat.st_mtime))]
+    )
+
+
+def set_low_priority():
+    """ Recording has higher priority. Used before BatClassify is started,
+        and as initializer for worker processes and threads. The nice value
+        is per thread on Linux, only the calling thread is changed. """
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+    except AttributeError:
+        try:
+            os.nice(19)
+        except OSError:
+            pass
+    except OSError:
+        pass
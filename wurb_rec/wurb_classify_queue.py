@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org, https://github.com/cloudedbats
+# Copyright (c) 2020-present Arnold Andreasson
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import datetime
+import hashlib
+import json
+import wave
+
+
+class WurbClassifyQueue(object):
+    """ Persistent queue for files waiting for classification, stored in
+        the database. Files are claimed by the classify worker and removed
+        when the result is stored. Claimed files are pending again after a
+        restart, and files that fail are tried again a few times.
+        Classification results are also cached, by a hash of the sound data
+        and the classifier version, to avoid classifying the same sound again.
+        Used from the event loop only, like the database.
+    """
+
+    def __init__(self, wurb_manager):
+        """ """
+        self.wurb_manager = wurb_manager
+        self.wurb_logging = wurb_manager.wurb_logging
+        self.conn = None
+        self.cache_hits = 0
+        # Config.
+        self.max_attempts = 3
+        self.cache_max_age_days = 365
+
+    async def startup(self):
+        """ """
+        try:
+            self.conn = await self.wurb_manager.wurb_database.get_db()
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS classify_queue
+                (filepath text PRIMARY KEY,
+                filename text NOT NULL,
+                datetime text NOT NULL,
+                state text NOT NULL,
+                attempts integer NOT NULL,
+                content_hash text)"""
+            )
+            columns = [
+                row[1]
+                for row in self.conn.execute("PRAGMA table_info(classify_queue)")
+            ]
+            if "content_hash" not in columns:
+                self.conn.execute(
+                    "ALTER TABLE classify_queue ADD COLUMN content_hash text"
+                )
+            self.conn.execute(
+                """CREATE INDEX IF NOT EXISTS classify_queue_state
+                ON classify_queue (state, datetime)"""
+            )
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS classify_cache
+                (content_hash text NOT NULL,
+                classifier text NOT NULL,
+                result json NOT NULL,
+                datetime text NOT NULL,
+                PRIMARY KEY (content_hash, classifier))"""
+            )
+            # Old results are not likely to be used again.
+            oldest_time = datetime.datetime.now(
+                datetime.timezone.utc
+            ) - datetime.timedelta(days=self.cache_max_age_days)
+            self.conn.execute(
+                "DELETE FROM classify_cache WHERE datetime < ?",
+                [oldest_time.strftime("%Y-%m-%dT%H:%M:%SZ")],
+            )
+            self.conn.commit()
+            # Files claimed when the detector was stopped are resumed.
+            await self.release_claimed()
+            pending = self.get_counts()["pending"]
+            if pending > 0:
+                # Logging.
+                message = "Classification: " + str(pending) + " files waiting."
+                self.wurb_logging.info(message, short_message=message)
+        except Exception as e:
+            # Logging error.
+            message = "Classify queue: startup: " + str(e)
+            self.wurb_manager.wurb_logging.error(message, short_message=message)
+
+    async def add(self, filepath, filename, content_hash=None):
+        """ """
+        try:
+            queued_time = datetime.datetime.now(datetime.timezone.utc)
+            self.conn.execute(
+                """INSERT OR IGNORE INTO classify_queue (filepath, filename,
+                datetime, state, attempts, content_hash) VALUES (?,?,?,?,?,?)""",
+                [
+                    str(filepath),
+                    filename,
+                    queued_time.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+                    "pending",
+                    0,
+                    content_hash,
+                ],
+            )
+            self.conn.commit()
+        except Exception as e:
+            # Logging error.
+            message = "Classify queue: add: " + str(e)
+            self.wurb_manager.wurb_logging.error(message, short_message=message)
+
+    async def claim(self):
+        """ Returns the oldest pending file as a dict, or None. """
+        row = self.conn.execute(
+            """SELECT filepath, filename, content_hash FROM classify_queue
+            WHERE state='pending' ORDER BY datetime LIMIT 1"""
+        ).fetchone()
+        if row is None:
+            return None
+        self.conn.execute(
+            "UPDATE classify_queue SET state='claimed' WHERE filepath=?", [row[0]]
+        )
+        self.conn.commit()
+        return {"filepath": row[0], "filename": row[1], "content_hash": row[2]}
+
+    async def complete(self, filepath):
+        """ Called when the result is stored, or if the file is gone. """
+        self.conn.execute(
+            "DELETE FROM classify_queue WHERE filepath=?", [str(filepath)]
+        )
+        self.conn.commit()
+
+    async def remove(self, filepaths):
+        """ Called when sound files are removed, not classified. """
+        self.conn.executemany(
+            "DELETE FROM classify_queue WHERE filepath=?",
+            [[str(filepath)] for filepath in filepaths],
+        )
+        self.conn.commit()
+
+    async def release(self, filepath, failed=True):
+        """ Back to pending. Failed files are marked as failed after
+            "max_attempts" tries. """
+        attempts_add = 1 if failed else 0
+        self.conn.execute(
+            """UPDATE classify_queue SET attempts=attempts+?,
+            state=CASE WHEN attempts+? >= ? THEN 'failed' ELSE 'pending' END
+            WHERE filepath=?""",
+            [attempts_add, attempts_add, self.max_attempts, str(filepath)],
+        )
+        self.conn.commit()
+
+    async def release_claimed(self):
+        """ All claimed files are pending again. """
+        self.conn.execute(
+            "UPDATE classify_queue SET state='pending' WHERE state='claimed'"
+        )
+        self.conn.commit()
+
+    def get_counts(self):
+        """ Number of files for each state. """
+        counts = {"pending": 0, "claimed": 0, "failed": 0}
+        for state, count in self.conn.execute(
+            "SELECT state, COUNT(*) FROM classify_queue GROUP BY state"
+        ).fetchall():
+            counts[state] = count
+        return counts
+
+    async def get_cached_result(self, content_hash, classifier):
+        """ Cached classification result as a dict, or None. """
+        row = self.conn.execute(
+            """SELECT result FROM classify_cache
+            WHERE content_hash=? AND classifier=?""",
+            [content_hash, classifier],
+        ).fetchone()
+        if row is None:
+            return None
+        self.cache_hits += 1
+        return json.loads(row[0])
+
+    async def add_cached_result(self, content_hash, classifier, result):
+        """ """
+        try:
+            cached_time = datetime.datetime.now(datetime.timezone.utc)
+            self.conn.execute(
+                """INSERT OR REPLACE INTO classify_cache (content_hash,
+                classifier, result, datetime) VALUES (?,?,?,?)""",
+                [
+                    content_hash,
+                    classifier,
+                    json.dumps(result),
+                    cached_time.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                ],
+            )
+            self.conn.commit()
+        except Exception as e:
+            # Logging error.
+            message = "Classify queue: add_cached_result: " + str(e)
+            self.wurb_manager.wurb_logging.error(message, short_message=message)
+
+
+def create_content_hash():
+    """ Hash for sound data. Updated with the int16 samples, followed by
+        the sampling frequency in the file header as text. """
+    return hashlib.blake2b(digest_size=16)
+
+
+def get_file_content_hash(filepath, block_frames=384000):
+    """ Content hash for a WAV file, the same as when the file was written.
+        Not for the event loop. """
+    content_hash = create_content_hash()
+    with wave.open(str(filepath), "rb") as wave_file:
+        while True:
+            frames = wave_file.readframes(block_frames)
+            if not frames:
+                break
+            content_hash.update(frames)
+        content_hash.update(str(wave_file.getframerate()).encode())
+    return content_hash.hexdigest()
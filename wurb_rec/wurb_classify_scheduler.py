@@ -0,0 +1,509 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org, https://github.com/cloudedbats
+# Copyright (c) 2020-present Arnold Andreasson
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import asyncio
+import concurrent.futures
+import datetime
+import os
+import pathlib
+import re
+import shutil
+import time
+import wave
+import numpy as np
+import psutil
+import wurb_rec
+
+
+class WurbClassifyScheduler(object):
+    """ Classifies files from the classify queue, independent of recording.
+        While recording is active only a limited number of BatClassify
+        processes are used, and classification is paused when the CPU load
+        or temperature is high or when sound buffers are queued up. When
+        the microphone is off, the backlog is classified at full speed.
+        In-process classifier plugins get batches of files, with sound data
+        from the recorder when available, instead of reading the files.
+        Results for sound already classified are taken from the cache.
+    """
+
+    def __init__(self, wurb_manager):
+        """ """
+        self.wurb_manager = wurb_manager
+        self.wurb_logging = wurb_manager.wurb_logging
+        self.main_loop_task = None
+        self.classify_task = None
+        self.result_task = None
+        self.classifier_pool = None
+        self.sound_classification = None
+        self.classifier = None
+        self.classifier_algorithm = None
+        self.classifier_executor = None
+        self.sample_cache = {}  # Sound data for new files, by filepath.
+        self.sample_cache_bytes = 0
+        self.batclassify_version = None
+        self.result_queue = None
+        self.change_event = None
+        self.allowed_workers = 0
+        self.classify_state = "Not active."
+        self.last_used_classify_state = ""
+        self.cpu_load_percent = None
+        self.temperature_c = None
+        self.last_work_time = 0.0
+        self.pool_failed_time = None
+        self.files_classified = 0
+        # Config.
+        self.classify_command = os.getenv("WURB_REC_CLASSIFY_COMMAND", "BatClassify")
+        self.number_of_workers = max(1, int(os.getenv("WURB_REC_CLASSIFY_WORKERS", "2")))
+        self.rec_workers = int(os.getenv("WURB_REC_CLASSIFY_REC_WORKERS", "1"))
+        self.batch_size = int(os.getenv("WURB_REC_CLASSIFY_BATCH_SIZE", "8"))
+        self.max_cache_bytes = (
+            int(os.getenv("WURB_REC_CLASSIFY_CACHE_MB", "64")) * 1024 * 1024
+        )
+        self.max_load_percent = float(os.getenv("WURB_REC_CLASSIFY_MAX_LOAD", "70"))
+        self.max_temp_c = float(os.getenv("WURB_REC_CLASSIFY_MAX_TEMP_C", "75"))
+        self.max_buffer_fill = 0.25  # Part of the sound buffer queue used.
+        self.main_loop_interval_s = 5  # Unit: sec.
+        self.pool_idle_timeout_s = 300  # Processes stopped when idle.
+        self.pool_retry_interval_s = 600  # If BatClassify failed to start.
+
+    async def startup(self):
+        """ """
+        self.result_queue = asyncio.Queue()
+        self.change_event = asyncio.Event()
+        self.sound_classification = wurb_rec.SoundClassification(self.wurb_manager)
+        # Initial call, cpu_percent is measured between calls.
+        psutil.cpu_percent(interval=None)
+        if not self.main_loop_task:
+            self.main_loop_task = asyncio.create_task(self.main_loop())
+            self.classify_task = asyncio.create_task(self.classify_loop())
+            self.result_task = asyncio.create_task(self.result_loop())
+
+    async def shutdown(self):
+        """ """
+        for task in [self.main_loop_task, self.classify_task, self.result_task]:
+            if task:
+                task.cancel()
+        self.main_loop_task = None
+        self.classify_task = None
+        self.result_task = None
+        await self.stop_pool()
+        if self.classifier_executor is not None:
+            self.classifier_executor.shutdown(wait=False)
+            self.classifier_executor = None
+        self.clear_sound_data()
+
+    def is_active(self):
+        """ True if files should be added to the classify queue. """
+        classification = self.wurb_manager.wurb_settings.get_setting(
+            "classification_algorithm"
+        )
+        if classification == "classification-batclassify":
+            return True
+        return self.sound_classification.is_plugin_selected()
+
+    def uses_sound_data(self):
+        """ True if the recorder should keep sound data for classification.
+            Called from the I/O thread. """
+        if self.sound_classification is None:
+            return False
+        return self.sound_classification.is_plugin_selected()
+
+    def can_accept_sound_data(self, data_bytes):
+        """ True if there is room for the sound data in the cache. Called from
+            the I/O thread, to avoid copying data that will not be used. """
+        return (self.sample_cache_bytes + data_bytes) <= self.max_cache_bytes
+
+    def add_sound_data(self, filepath, data_int16, sampling_freq_hz):
+        """ Sound data for a new file. Not kept if classification is behind,
+            the file is read when classified. """
+        if self.can_accept_sound_data(data_int16.nbytes):
+            self.pop_sound_data(filepath)
+            self.sample_cache[str(filepath)] = (data_int16, sampling_freq_hz)
+            self.sample_cache_bytes += data_int16.nbytes
+
+    def pop_sound_data(self, filepath):
+        """ Sound data as (data_int16, sampling_freq_hz), or None. """
+        sound_data = self.sample_cache.pop(str(filepath), None)
+        if sound_data is not None:
+            self.sample_cache_bytes -= sound_data[0].nbytes
+        return sound_data
+
+    def clear_sound_data(self):
+        """ """
+        self.sample_cache = {}
+        self.sample_cache_bytes = 0
+
+    def notify(self):
+        """ Called when a file is added to the classify queue. """
+        if self.change_event is not None:
+            self.change_event.set()
+
+    async def wait_for_change(self):
+        """ New files, a finished file or a new throttle level. """
+        try:
+            await asyncio.wait_for(
+                self.change_event.wait(), timeout=self.main_loop_interval_s
+            )
+        except asyncio.TimeoutError:
+            pass
+        self.change_event.clear()
+
+    async def main_loop(self):
+        """ """
+        try:
+            while True:
+                try:
+                    await self.update_throttle()
+                    await asyncio.sleep(self.main_loop_interval_s)
+                except asyncio.CancelledError:
+                    break
+                except Exception as e:
+                    # Logging error.
+                    message = "Classify scheduler main loop: " + str(e)
+                    self.wurb_manager.wurb_logging.error(message, short_message=message)
+        finally:
+            # Logging debug.
+            message = "Classify scheduler main loop terminated."
+            self.wurb_manager.wurb_logging.debug(message)
+
+    async def update_throttle(self):
+        """ Number of BatClassify processes allowed to run. """
+        self.cpu_load_percent = psutil.cpu_percent(interval=None)
+        self.temperature_c = get_temperature()
+        if not self.is_active():
+            allowed_workers = 0
+            self.clear_sound_data()
+            classify_state = "Not active."
+        elif await self.wurb_manager.wurb_scheduler.is_detector_idle():
+            allowed_workers = self.number_of_workers
+            classify_state = "Catch-up."
+        else:
+            allowed_workers = min(self.rec_workers, self.number_of_workers)
+            classify_state = "Throttled, recording active."
+            if self.cpu_load_percent > self.max_load_percent:
+                allowed_workers = 0
+                classify_state = "Paused, high CPU load."
+            elif self.get_buffer_fill() > self.max_buffer_fill:
+                allowed_workers = 0
+                classify_state = "Paused, sound buffers queued."
+        if (self.temperature_c is not None) and (self.temperature_c > self.max_temp_c):
+            allowed_workers = 0
+            classify_state = "Paused, high temperature."
+        if allowed_workers != self.allowed_workers:
+            self.allowed_workers = allowed_workers
+            self.change_event.set()
+        self.classify_state = classify_state
+        # Logging of changes in state.
+        if self.classify_state != self.last_used_classify_state:
+            message = "Classification: " + self.classify_state
+            self.wurb_manager.wurb_logging.info(message, short_message=message)
+            self.last_used_classify_state = self.classify_state
+        # Free memory used by idle BatClassify processes.
+        if (self.classifier_pool is not None) and (
+            (time.time() - self.last_work_time) > self.pool_idle_timeout_s
+        ):
+            if self.classifier_pool.get_statistics()["in_flight"] == 0:
+                await self.stop_pool()
+
+    def get_buffer_fill(self):
+        """ Used part of the queue for sound buffers from the microphone.
+            The byte budget is used if the queue has one, it is reached long
+            before the max number of items. """
+        queue = getattr(self.wurb_manager.wurb_recorder, "from_source_queue", None)
+        if queue is None:
+            return 0.0
+        if getattr(queue, "max_bytes", 0) > 0:
+            return queue.queued_bytes / queue.max_bytes
+        if queue.maxsize <= 0:
+            return 0.0
+        return queue.qsize() / queue.maxsize
+
+    async def start_pool(self):
+        """ Only the allowed number of processes are started. The pool
+            grows when more processes are allowed, for catch-up. """
+        if self.classifier_pool is None:
+            self.classifier_pool = wurb_rec.BatClassifyPool(
+                self.wurb_manager, self.result_queue
+            )
+            await self.classifier_pool.startup(self.allowed_workers)
+        else:
+            self.classifier_pool.add_workers(self.allowed_workers)
+
+    async def stop_pool(self):
+        """ """
+        if self.classifier_pool is not None:
+            classifier_pool = self.classifier_pool
+            self.classifier_pool = None
+            await classifier_pool.shutdown()
+        # Checked again, BatClassify may be updated.
+        self.batclassify_version = None
+
+    async def classify_loop(self):
+        """ Files are claimed from the classify queue when allowed by the
+            throttle. Results are delivered to the result loop. """
+        classify_queue = self.wurb_manager.wurb_classify_queue
+        try:
+            while True:
+                try:
+                    in_flight = 0
+                    if self.classifier_pool is not None:
+                        in_flight = self.classifier_pool.get_statistics()["in_flight"]
+                    if in_flight >= self.allowed_workers:
+                        await self.wait_for_change()
+                        continue
+                    if self.sound_classification.is_plugin_selected():
+                        await self.classify_batch()
+                        continue
+                    if (self.pool_failed_time is not None) and (
+                        (time.time() - self.pool_failed_time) < self.pool_retry_interval_s
+                    ):
+                        await self.wait_for_change()
+                        continue
+                    item = await classify_queue.claim()
+                    if item == None:
+                        await self.wait_for_change()
+                        continue
+                    if not pathlib.Path(item["filepath"]).exists():
+                        # Removed or already classified.
+                        await classify_queue.complete(item["filepath"])
+                        continue
+                    if self.batclassify_version is None:
+                        self.batclassify_version = wurb_rec.get_command_version(
+                            self.classify_command
+                        )
+                    classifier_key = "BatClassify " + self.batclassify_version
+                    if await self.use_cached_result(item, classifier_key):
+                        continue
+                    self.last_work_time = time.time()
+                    await self.start_pool()
+                    # Waits for an idle BatClassify process.
+                    if await self.classifier_pool.classify(item):
+                        self.pool_failed_time = None
+                    else:
+                        await classify_queue.release(item["filepath"], failed=False)
+                        self.pool_failed_time = time.time()
+                        await self.stop_pool()
+                except asyncio.CancelledError:
+                    break
+                except Exception as e:
+                    # Logging error.
+                    message = "Classify scheduler: classify_loop: " + str(e)
+                    self.wurb_manager.wurb_logging.error(message, short_message=message)
+                    await asyncio.sleep(self.main_loop_interval_s)
+        finally:
+            # Logging debug.
+            message = "Classify scheduler classify loop terminated."
+            self.wurb_manager.wurb_logging.debug(message)
+
+    def get_classifier(self):
+        """ Classifier plugin for the current setting. """
+        algorithm = self.wurb_manager.wurb_settings.get_setting(
+            "classification_algorithm"
+        )
+        if algorithm != self.classifier_algorithm:
+            # Not created again if it fails.
+            self.classifier_algorithm = algorithm
+            self.classifier = None
+            self.classifier = self.sound_classification.get_classifier()
+        return self.classifier
+
+    async def classify_batch(self):
+        """ Claims up to "batch_size" files and classifies them with the
+            classifier plugin on a worker thread. """
+        classify_queue = self.wurb_manager.wurb_classify_queue
+        classifier = self.get_classifier()
+        if classifier is None:
+            await self.wait_for_change()
+            return
+        items = []
+        while len(items) < self.batch_size:
+            item = await classify_queue.claim()
+            if item == None:
+                break
+            if not pathlib.Path(item["filepath"]).exists():
+                # Removed or already classified.
+                self.pop_sound_data(item["filepath"])
+                await classify_queue.complete(item["filepath"])
+                continue
+            classifier_key = classifier.name + " " + classifier.version
+            if await self.use_cached_result(item, classifier_key, classifier.name):
+                self.pop_sound_data(item["filepath"])
+                continue
+            items.append(item)
+        if not items:
+            await self.wait_for_change()
+            return
+        self.last_work_time = time.time()
+        batch = [self.pop_sound_data(item["filepath"]) for item in items]
+        if self.classifier_executor is None:
+            self.classifier_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, initializer=wurb_rec.set_low_priority
+            )
+        loop = asyncio.get_event_loop()
+        try:
+            results = await loop.run_in_executor(
+                self.classifier_executor, run_classifier, classifier, items, batch
+            )
+        except Exception as e:
+            for item in items:
+                await classify_queue.release(item["filepath"])
+            # Logging error.
+            message = "Classifier: " + classifier.name + ": " + str(e)
+            self.wurb_manager.wurb_logging.error(message, short_message=message)
+            return
+        for item, result in zip(items, results):
+            result_item = dict(item)
+            result_item["batclassify"] = result
+            result_item["classifier"] = classifier.name
+            await self.result_queue.put(result_item)
+
+    async def use_cached_result(self, item, classifier_key, classifier_name=None):
+        """ Delivers the cached result, if the same sound has been classified
+            before. Otherwise the key is added to the item, for the result. """
+        classify_queue = self.wurb_manager.wurb_classify_queue
+        if item.get("content_hash", None) is None:
+            # Files queued by older versions, or reprocessed.
+            loop = asyncio.get_event_loop()
+            try:
+                item["content_hash"] = await loop.run_in_executor(
+                    None, wurb_rec.get_file_content_hash, item["filepath"]
+                )
+            except Exception:
+                return False  # Classified without the cache.
+        result = await classify_queue.get_cached_result(
+            item["content_hash"], classifier_key
+        )
+        if result is None:
+            item["classifier_key"] = classifier_key
+            return False
+        result_item = dict(item)
+        result_item["batclassify"] = result
+        if classifier_name is not None:
+            result_item["classifier"] = classifier_name
+        await self.result_queue.put(result_item)
+        return True
+
+    async def result_loop(self):
+        """ """
+        classify_queue = self.wurb_manager.wurb_classify_queue
+        while True:
+            try:
+                item = await self.result_queue.get()
+                queued_filepath = item["filepath"]  # Changed when moved.
+                if item.get("classifier_key", None) is not None:
+                    # Cached before the file is moved, in case it fails.
+                    await classify_queue.add_cached_result(
+                        item["content_hash"], item["classifier_key"], item["batclassify"]
+                    )
+                try:
+                    await self.store_result(item)
+                finally:
+                    # Done, also if failed. Not classified again.
+                    await classify_queue.complete(queued_filepath)
+                    self.files_classified += 1
+                    self.last_work_time = time.time()
+                    self.change_event.set()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                # Logging error.
+                message = "Classify scheduler: result_loop: " + str(e)
+                self.wurb_manager.wurb_logging.error(message, short_message=message)
+
+    async def store_result(self, item):
+        """ Metadata is added to the sound file and the file is moved to
+            the "analyzed" directory. The result is stored in the database. """
+        # Datetime from the filename, as datetime for sqlite.
+        dtime = datetime.datetime.strptime(
+            item["filename"].split("_")[1], "%Y%m%dT%H%M%S%z"
+        )
+        item.update({"datetime": dtime})
+        # Adding metadata to soundfile.
+        bat, prob = await self.wurb_manager.wurb_metadata.append_fileMetadata(
+            item, classifier=item.get("classifier", "BatClassify")
+        )
+        target_path = pathlib.Path(item["filepath"]).parent
+        analyzed_path = pathlib.Path(target_path, "analyzed")
+        if not target_path.exists():
+            return
+        if not analyzed_path.exists():
+            analyzed_path.mkdir()
+        # Move file to "analyzed path".
+        target_file = pathlib.Path(
+            analyzed_path, bat + "_" + f"{prob*100:.0f}" + "_" + item["filename"]
+        )
+        old_filepath = item["filepath"]
+        shutil.move(old_filepath, target_file)
+        item.update({"filepath": str(target_file)})
+        await self.wurb_manager.wurb_retention.update_file(
+            old_filepath, target_file, bat
+        )
+        if bat == "unclassified":
+            prob = ""
+            message = "Due to low probability not classified"
+        else:
+            message = "Soundfile classified as {}; probability: {:1.2f}%".format(
+                bat, prob * 100
+            )
+        await self.wurb_manager.wurb_database.insert_data(item, bat, prob)
+        self.wurb_manager.wurb_logging.info(message, short_message=message)
+
+    async def get_progress(self):
+        """ """
+        progress = {
+            "state": self.classify_state,
+            "allowed_workers": self.allowed_workers,
+            "files_classified": self.files_classified,
+            "cache_hits": self.wurb_manager.wurb_classify_queue.cache_hits,
+            "cpu_load_percent": self.cpu_load_percent,
+            "temperature_c": self.temperature_c,
+        }
+        progress.update(self.wurb_manager.wurb_classify_queue.get_counts())
+        if self.classifier_pool is not None:
+            progress["in_flight"] = self.classifier_pool.get_statistics()["in_flight"]
+        else:
+            progress["in_flight"] = 0
+        return progress
+
+
+def run_classifier(classifier, items, batch):
+    """ Runs on the classifier thread. Files without sound data from the
+        recorder are read from disk. """
+    for index, item in enumerate(items):
+        if batch[index] is None:
+            with wave.open(item["filepath"], "rb") as wave_file:
+                frames = wave_file.readframes(wave_file.getnframes())
+                batch[index] = (
+                    np.frombuffer(frames, dtype=np.int16),
+                    get_sampling_freq_hz(item["filename"], wave_file.getframerate()),
+                )
+    return classifier.classify_batch(batch)
+
+
+def get_sampling_freq_hz(filename, header_freq_hz):
+    """ Sampling frequency used when recording. The header in TE files
+        contains the frequency divided by 10, for time expansion.
+        Filename example: "WURB1_20180420T205942+0200_N00.00E00.00_TE384.wav" """
+    if re.search(r"_[NS][0-9.]+[EW][0-9.]+_TE[0-9]+", filename):
+        return header_freq_hz * 10
+    return header_freq_hz
+
+
+def get_temperature():
+    """ Highest CPU temperature, or None if not available. """
+    try:
+        temperatures = psutil.sensors_temperatures()
+    except (AttributeError, OSError):
+        return None
+    values = [
+        sensor.current
+        for sensors in temperatures.values()
+        for sensor in sensors
+        if sensor.current is not None
+    ]
+    if not values:
+        return None
+    return max(values)
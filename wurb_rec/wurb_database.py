@@ -49,6 +49,24 @@ class WurbDatabase(object):
             self.conn.commit()
             #pass
 
+    async def update_filepath(self, old_filepath, new_filepath):
+        try:
+            self.c.execute('''UPDATE audiofiles SET filepath=?
+            WHERE filepath=?''', [str(new_filepath), str(old_filepath)])
+            self.conn.commit()
+        except Exception as err:
+            message = "Database Update Error: " + str(err)
+            self.wurb_manager.wurb_logging.error(message, short_message=message)
+
+    async def delete_filepaths(self, filepaths):
+        try:
+            self.c.executemany('''DELETE FROM audiofiles
+            WHERE filepath=?''', [[str(filepath)] for filepath in filepaths])
+            self.conn.commit()
+        except Exception as err:
+            message = "Database Delete Error: " + str(err)
+            self.wurb_manager.wurb_logging.error(message, short_message=message)
+
     async def commitChanges(self):
         self.conn.commit()
 
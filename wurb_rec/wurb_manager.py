@@ -33,6 +33,10 @@ class WurbRecManager(object):
             self.wurb_gps = None
             self.wurb_scheduler = None
             self.wurb_database = None
+            self.wurb_retention = None
+            self.wurb_archiver = None
+            self.wurb_classify_queue = None
+            self.wurb_classify_scheduler = None
             self.wurb_metadata = None
             self.wurb_audiofeedback = None
             self.manual_trigger_activated = False
@@ -53,9 +57,18 @@ class WurbRecManager(object):
             self.wurb_scheduler = wurb_rec.WurbScheduler(self)
             self.update_status_task = asyncio.create_task(self.update_status())
             self.wurb_database = wurb_rec.WurbDatabase(self)
+            self.wurb_retention = wurb_rec.WurbRetention(self)
+            self.wurb_classify_queue = wurb_rec.WurbClassifyQueue(self)
+            self.wurb_classify_scheduler = wurb_rec.WurbClassifyScheduler(self)
+            self.wurb_archiver = wurb_rec.WurbArchiver(self)
             self.wurb_metadata = wurb_rec.WurbMetadata(self)
             await self.wurb_logging.startup()
+            # Before settings, recording may be started by the scheduler.
+            await self.wurb_classify_queue.startup()
             await self.wurb_settings.startup()
+            await self.wurb_retention.startup()
+            await self.wurb_archiver.startup()
+            await self.wurb_classify_scheduler.startup()
             # await self.wurb_scheduler.startup()
             # await self.wurb_audiofeedback.startup()
             self.manual_trigger_activated = False
@@ -78,6 +91,12 @@ class WurbRecManager(object):
             if self.wurb_gps:
                 await self.wurb_gps.shutdown()
                 self.wurb_gps = None
+            if self.wurb_archiver:
+                await self.wurb_archiver.shutdown()
+                self.wurb_archiver = None
+            if self.wurb_classify_scheduler:
+                await self.wurb_classify_scheduler.shutdown()
+                self.wurb_classify_scheduler = None
             if self.wurb_scheduler:
                 await self.wurb_scheduler.shutdown()
                 self.wurb_scheduler = None
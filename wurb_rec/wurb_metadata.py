@@ -1,4 +1,5 @@
 import asyncio
+import struct
 import wurb_rec
 import guano
 import datetime
@@ -10,7 +11,9 @@ class WurbMetadata(object):
         self.wurb_manager = wurb_manager
         self.settingMetadata = None
         self.locationMetadata = {}
-        guano.GuanoFile.register('Wurb', ['Detection Algorithm', 'GPS Source', 'Microphone', 'Classifier', 'Recording Type', 'Version'], str)
+        # Cached GUANO fields, the same for all files in a session.
+        self.sessionGuanoItems = None
+        guano.GuanoFile.register('Wurb', ['Detection Algorithm', 'GPS Source', 'Microphone', 'Classifier', 'Recording Type', 'Version', 'Segments'], str)
         guano.GuanoFile.register('Wurb', ['Sensitivity', 'HP Detection'], float)
 
     async def set_settingMetadata(self):
@@ -26,42 +29,95 @@ class WurbMetadata(object):
             'Hardware': self.wurb_manager.wurb_rpi.get_hardware_info(),
             'Version': wurb_rec.__version__},)
         self.settingMetadata.update(location)
+        self.sessionGuanoItems = None
 
     async def update_location(self, location_dict):
         if location_dict["geo_source"] != "geo-not-used":
             self.locationMetadata["geo_source"] = location_dict["geo_source"]
             self.locationMetadata["latitude"] = location_dict["latitude_dd"]
             self.locationMetadata["longitude"] = location_dict["longitude_dd"]
-    
-    async def append_settingMetadata(self, filepath):
+        self.sessionGuanoItems = None
+
+    def get_session_guano_items(self):
+        """ GUANO fields from settings, cached per session. """
+        if self.sessionGuanoItems is None:
+            g = guano.GuanoFile()
+            self.set_settingFields(g)
+            self.sessionGuanoItems = list(g.items())
+        return self.sessionGuanoItems
+
+    def get_guano_bytes(self, filename, start_time, fields=None):
+        """ GUANO metadata for a new file, written when the file is created.
+            Fields for this file only, like the segment index, are optional. """
+        g = guano.GuanoFile()
+        for key, value in self.get_session_guano_items():
+            g[key] = value
+        g["Original Filename"] = filename
+        g["Timestamp"] = datetime.datetime.fromtimestamp(start_time).astimezone()
+        for key, value in (fields or {}).items():
+            g[key] = value
+        return bytes(g.serialize())
+
+    def get_guano_chunk_position(self, f):
+        """ Returns (offset, size) for the content of the 'guan' chunk, or (None, 0). """
+        f.seek(0, 2)
+        file_size = f.tell()
+        f.seek(12)  # After "RIFF", size and "WAVE".
+        while f.tell() < file_size - 8:
+            chunk_id, chunk_size = struct.unpack("<4sI", f.read(8))
+            if chunk_id == b"guan":
+                return f.tell(), chunk_size
+            f.seek(chunk_size + (chunk_size % 2), 1)
+        return None, 0
+
+    def patch_guano(self, filepath, fields):
+        """ Updates the reserved GUANO chunk in place, without rewriting
+            the sound data. Returns False if there is not enough space. """
+        g = guano.GuanoFile(filepath)
+        for key, value in fields.items():
+            g[key] = value
+        md_bytes = bytes(g.serialize())
+        with open(filepath, "r+b") as f:
+            offset, size = self.get_guano_chunk_position(f)
+            if (offset is None) or (len(md_bytes) > size):
+                return False
+            f.seek(offset)
+            f.write(md_bytes + b" " * (size - len(md_bytes)))
+        return True
+
+    async def append_settingMetadata(self, filepath, fields=None):
         try:
-            g = guano.GuanoFile(filepath)            
-            g["Length"] = int(self.settingMetadata["rec_length_s"]) # same with TE?
-            g["Samplerate"] = int(self.settingMetadata["Samplerate"])
-            g["Note"] = "Recorded with {} + {}".format(self.settingMetadata["Hardware"], self.settingMetadata["deviceName"])
-            # if metatdata["rec_type"] == "TE":
-            #    g["TE"] = 10
-            # if self.settingMetadata["geo_source_option"] == "geo-usb-gps":
-            #      g["Loc Position"] = (float(self.settingMetadata["latitude_dd"]), float(self.settingMetadata["longitude_dd"]))
-            # if self.settingMetadata["geo_source_option"] == "geo-manual":
-            #      g["Loc Position"] = (float(self.settingMetadata["manual_latitude_dd"]), float(self.settingMetadata["manual_longitude_dd"]))
-            if self.locationMetadata:
-                g["Wurb|GPS Source"] = self.locationMetadata["geo_source"]
-                g["Loc Position"] = (float(self.locationMetadata["latitude"]), float(self.locationMetadata["longitude"]))
-            g["Wurb|HP Detection"] = float(self.settingMetadata["detection_limit_khz"])
-            g["Wurb|Microphone"] = self.settingMetadata["deviceName"]
-            g["Wurb|Sensitivity"] = float(self.settingMetadata["detection_sensitivity_dbfs"])            
-            g["Wurb|Detection Algorithm"] = self.settingMetadata["detection_algorithm"]
-            g["Wurb|Recording Type"] = self.settingMetadata["rec_type"]
-            g["Wurb|Version"] = self.settingMetadata["Version"]
-            
+            g = guano.GuanoFile(filepath)
+            self.set_settingFields(g)
+            for key, value in (fields or {}).items():
+                g[key] = value
             g.write(make_backup=False)
         except Exception as e:
             message = "Guano SettingMetadata error: " + str(e)
             self.wurb_manager.wurb_logging.error(message, short_message=message)
 
-    async def append_fileMetadata(self, metadata):
-        # custom limits for batclassify
+    def set_settingFields(self, g):
+        g["Length"] = int(self.settingMetadata["rec_length_s"]) # same with TE?
+        g["Samplerate"] = int(self.settingMetadata["Samplerate"])
+        g["Note"] = "Recorded with {} + {}".format(self.settingMetadata["Hardware"], self.settingMetadata["deviceName"])
+        # if metatdata["rec_type"] == "TE":
+        #    g["TE"] = 10
+        # if self.settingMetadata["geo_source_option"] == "geo-usb-gps":
+        #      g["Loc Position"] = (float(self.settingMetadata["latitude_dd"]), float(self.settingMetadata["longitude_dd"]))
+        # if self.settingMetadata["geo_source_option"] == "geo-manual":
+        #      g["Loc Position"] = (float(self.settingMetadata["manual_latitude_dd"]), float(self.settingMetadata["manual_longitude_dd"]))
+        if self.locationMetadata:
+            g["Wurb|GPS Source"] = self.locationMetadata["geo_source"]
+            g["Loc Position"] = (float(self.locationMetadata["latitude"]), float(self.locationMetadata["longitude"]))
+        g["Wurb|HP Detection"] = float(self.settingMetadata["detection_limit_khz"])
+        g["Wurb|Microphone"] = self.settingMetadata["deviceName"]
+        g["Wurb|Sensitivity"] = float(self.settingMetadata["detection_sensitivity_dbfs"])            
+        g["Wurb|Detection Algorithm"] = self.settingMetadata["detection_algorithm"]
+        g["Wurb|Recording Type"] = self.settingMetadata["rec_type"]
+        g["Wurb|Version"] = self.settingMetadata["Version"]
+
+    async def append_fileMetadata(self, metadata, classifier="BatClassify"):
+        # custom limits for batclassify, also used for classifier plugins
         bc_limit = {"Bbar":0.6,
                     "Malc":0.7,
                     "Mbec":0.7,
@@ -78,7 +134,7 @@ class WurbMetadata(object):
         prob = 0
         bat = "unclassified"
         for i in metadata["batclassify"]:
-            if metadata["batclassify"][i]>bc_limit[i] and metadata["batclassify"][i]>prob:
+            if metadata["batclassify"][i]>bc_limit.get(i, 0.9) and metadata["batclassify"][i]>prob:
                 prob=metadata["batclassify"][i]
                 bat=i
         
@@ -95,13 +151,18 @@ class WurbMetadata(object):
         # bat = next(iter(bc_sort))
         try:
             
-            g = guano.GuanoFile(metadata["filepath"])
-            g["Original Filename"] = metadata["filename"]
-            g["Timestamp"] = metadata["datetime"]
-            g["Species Auto ID"] = bat
-            g["Wurb|Classifier"] = "BatClassify"
-
-            g.write(make_backup=False)
+            fields = {
+                "Original Filename": metadata["filename"],
+                "Timestamp": metadata["datetime"],
+                "Species Auto ID": bat,
+                "Wurb|Classifier": classifier,
+            }
+            # Patch in place if possible, else rewrite the file.
+            if not self.patch_guano(metadata["filepath"], fields):
+                g = guano.GuanoFile(metadata["filepath"])
+                for key, value in fields.items():
+                    g[key] = value
+                g.write(make_backup=False)
 
         except Exception as e:
             message = "Guano FileMetadata error: " + str(e)
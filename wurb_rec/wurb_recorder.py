@@ -6,21 +6,27 @@
 
 import os
 import asyncio
+import ctypes
+import concurrent.futures
 import time
+import struct
 import wave
 import pathlib
 import psutil
+import numpy as np
 from collections import deque
 #import sounddevice
 #import os
 import glob
-import shutil
-import json
-import pexpect as p
 import sqlite3 as sq3
 import guano
 import datetime
 
+try:
+    import soundfile
+except ImportError:
+    soundfile = None  # FLAC not available, WAV is used.
+
 # CloudedBats.
 import wurb_rec
 
@@ -164,7 +170,10 @@ class WurbRecorder(wurb_rec.SoundStreamManager):
 
     def __init__(self, wurb_manager, queue_max_size=1200):
         """ """
-        super().__init__(queue_max_size)
+        super().__init__(
+            queue_max_size,
+            queue_drop_policy=os.getenv("WURB_REC_QUEUE_DROP_POLICY", "drop-oldest"),
+        )
         self.wurb_manager = wurb_manager
         self.wurb_settings = wurb_manager.wurb_settings
         self.wurb_logging = wurb_manager.wurb_logging
@@ -180,6 +189,25 @@ class WurbRecorder(wurb_rec.SoundStreamManager):
         self.max_adc_time_diff_s = 10  # Unit: sec.
         self.rec_length_s = 6  # Unit: sec.
         self.rec_timeout_before_restart_s = 30  # Unit: sec.
+        # Sound detection in the capture thread. Only triggered segments
+        # are sent through the queues.
+        self.capture_detection_active = os.getenv(
+            "WURB_REC_CAPTURE_DETECTION", "false"
+        ).lower() in ["true", "yes", "1"]
+        self.capture_detection = None
+        # Ring buffer for sound data, shared by all parts of the pipeline.
+        self.ring_buffer = None
+        self.ring_buffer_s = int(os.getenv("WURB_REC_RING_BUFFER_S", "30"))  # Unit: sec.
+        self.ring_buffer_max_mb = int(os.getenv("WURB_REC_RING_BUFFER_MAX_MB", "96"))
+        self.ring_buffer_capped = False
+        # Max amount of sound in each queue, as seconds of sound data.
+        self.queue_budget_s = float(os.getenv("WURB_REC_QUEUE_BUDGET_S", "10"))  # Unit: sec.
+        # Spill to scratch file when the target is too slow. Used if the
+        # drop policy is "spill".
+        self.spill_dir = os.getenv("WURB_REC_SPILL_DIR", "/dev/shm")
+        self.spill_size_mb = int(os.getenv("WURB_REC_SPILL_SIZE_MB", "256"))
+        # Max number of sound files waiting to be written.
+        self.write_behind_max_files = int(os.getenv("WURB_REC_WRITE_BEHIND_MAX_FILES", "2"))
 
         # self.bat_detected_event = None
         # self.bat_data = {}
@@ -257,6 +285,8 @@ class WurbRecorder(wurb_rec.SoundStreamManager):
             self.device_name = device_name
             self.card_index = card_index
             self.sampling_freq_hz = sampling_freq_hz
+            # Queue budget in bytes, int16 mono.
+            self.queue_max_bytes = int(self.queue_budget_s * sampling_freq_hz * 2)
         except Exception as e:
             # Logging error.
             message = "Recorder: set_device: " + str(e)
@@ -268,10 +298,62 @@ class WurbRecorder(wurb_rec.SoundStreamManager):
         loop = asyncio.get_event_loop()
         self.restart_activated = False
 
+        # Preallocated ring buffer. Must hold the data in both queues and
+        # one file in progress, the pre-trigger buffer included.
+        rec_length_s = int(self.wurb_settings.get_setting("rec_length_s"))
+        if self.wurb_settings.get_setting("rec_length_option") == "length-variable":
+            rec_length_s += int(
+                float(self.wurb_settings.get_setting("rec_pre_trigger_s")) + 1
+            )
+        bytes_per_s = self.sampling_freq_hz * 2
+        file_bytes = int(rec_length_s * bytes_per_s)
+        # The queue to target must hold at least one file with max length,
+        # files are dropped as a whole if the budget is exceeded.
+        if self.to_target_queue.max_bytes > 0:
+            self.to_target_queue.max_bytes = max(self.queue_max_bytes, file_bytes)
+        queued_bytes = self.from_source_queue.max_bytes + self.to_target_queue.max_bytes
+        if queued_bytes == 0:
+            # No byte budget, sized as before for the queued files.
+            queued_bytes = file_bytes * (1 + self.write_behind_max_files)
+        ring_buffer_s = max(
+            self.ring_buffer_s, int((queued_bytes + file_bytes) / bytes_per_s + 4)
+        )
+        # Capped, files are dropped if overwritten before they are written.
+        max_ring_buffer_s = max(4, int(self.ring_buffer_max_mb * 2 ** 20 / bytes_per_s))
+        self.ring_buffer_capped = ring_buffer_s > max_ring_buffer_s
+        if self.ring_buffer_capped:
+            # Logging.
+            message = (
+                "Ring buffer capped at "
+                + str(max_ring_buffer_s)
+                + " sec, "
+                + str(ring_buffer_s)
+                + " sec needed. Files may be dropped if the target is slow."
+            )
+            self.wurb_logging.warning(message, short_message=message)
+            ring_buffer_s = max_ring_buffer_s
+        # New for each start, the capture thread from the last start may
+        # still be running. Items refer to the buffer they are stored in.
+        self.ring_buffer = wurb_rec.SoundRingBuffer(
+            block_size=int(self.sampling_freq_hz / 2),  # 0.5 sec.
+            capacity_blocks=ring_buffer_s * 2,
+        )
+
+        # Optional sound detection in the capture thread.
+        capture_detection = None
+        if self.capture_detection_active:
+            capture_detection = CaptureThreadDetection(
+                self.wurb_manager, self.create_sound_trigger()
+            )
+        # Used to reset detection in the capture thread when flushed.
+        self.capture_detection = capture_detection
+
         # Pettersson M500, not compatible with ALSA.
         pettersson_m500 = wurb_rec.PetterssonM500(
             data_queue=self.from_source_queue,
             direct_target=self.wurb_audiofeedback,
+            process_target=capture_detection,
+            ring_buffer=self.ring_buffer,
         )
         if self.device_name == pettersson_m500.get_device_name():
             # Logging.
@@ -299,6 +381,8 @@ class WurbRecorder(wurb_rec.SoundStreamManager):
         recorder_alsa = wurb_rec.AlsaSoundCapture(
             data_queue=self.from_source_queue,
             direct_target=self.wurb_audiofeedback,
+            process_target=capture_detection,
+            ring_buffer=self.ring_buffer,
         )
         # Logging.
         await self.set_rec_status("Microphone is on.")
@@ -321,24 +405,33 @@ class WurbRecorder(wurb_rec.SoundStreamManager):
             await self.set_rec_status("Recording finished.")
         return
 
+    def create_sound_trigger(self):
+        """ Fixed or variable length sound files, from settings. """
+        rec_length_s = int(self.wurb_settings.get_setting("rec_length_s"))
+        if self.wurb_settings.get_setting("rec_length_option") == "length-variable":
+            pre_trigger_s = float(self.wurb_settings.get_setting("rec_pre_trigger_s"))
+            post_trigger_s = float(self.wurb_settings.get_setting("rec_post_trigger_s"))
+            return VariableLengthTrigger(
+                rec_length_s,
+                self.sampling_freq_hz,
+                pre_trigger_s=pre_trigger_s,
+                post_trigger_s=post_trigger_s,
+            )
+        return SoundTrigger(rec_length_s)
+
     async def sound_process_worker(self):
         """ """
-
+        sound_detector = None
         try:
             # Get rec length from settings.
             self.rec_length_s = int(self.wurb_settings.get_setting("rec_length_s"))
             #
-            self.process_deque = deque()  # Double ended queue.
-            self.process_deque.clear()
-            self.process_deque_length = self.rec_length_s * 2
-            self.detection_counter_max = self.process_deque_length - 3  # 1.5 s before.
-            #
-            first_sound_detected = False
-            sound_detected = False
-            sound_detected_counter = 0
-            sound_detector = wurb_rec.SoundDetection(self.wurb_manager).get_detection()
-            max_peak_freq_hz = None
-            max_peak_dbfs = None
+            self.sound_trigger = self.create_sound_trigger()
+            # Detection runs outside the event loop. Not needed here
+            # if detection is done in the capture thread.
+            if not self.capture_detection_active:
+                sound_detector = wurb_rec.SoundDetectionWorker(self.wurb_manager)
+                await sound_detector.startup()
 
             while True:
                 try:
@@ -372,130 +465,88 @@ class WurbRecorder(wurb_rec.SoundStreamManager):
                         try:
                             # print("REC PROCESS: ", item["adc_time"], item["data"][:5])
                             if item == None:
-                                first_sound_detected == False
-                                sound_detected_counter = 0
-                                self.process_deque.clear()
+                                self.sound_trigger.clear()
                                 await self.to_target_queue.put(None)  # Terminate.
                                 break
                             elif item == False:
-                                first_sound_detected == False
-                                sound_detected_counter = 0
-                                self.process_deque.clear()
+                                self.sound_trigger.clear()
+                                if sound_detector is not None:
+                                    await sound_detector.reset()
+                                if self.capture_detection is not None:
+                                    self.capture_detection.request_reset()
                                 await self.remove_items_from_queue(self.to_target_queue)
                                 await self.to_target_queue.put(False)  # Flush.
                             else:
                                 # Compare real time and stream time.
-                                adc_time = item["adc_time"]
-                                detector_time = item["detector_time"]
-                                # Restart if it differ too much.
-                                if (
-                                    abs(adc_time - detector_time)
-                                    > self.max_adc_time_diff_s
-                                ):
-                                    # Check if restart already is requested.
-                                    if self.restart_activated:
+                                if "detector_time" in item:
+                                    adc_time = item["adc_time"]
+                                    detector_time = item["detector_time"]
+                                    # Restart if it differ too much.
+                                    if (
+                                        abs(adc_time - detector_time)
+                                        > self.max_adc_time_diff_s
+                                    ):
+                                        # Check if restart already is requested.
+                                        if self.restart_activated:
+                                            return
+                                        # Logging.
+                                        message = "Warning: Time diff. detected. Rec. will be restarted."
+                                        self.wurb_logging.info(
+                                            message, short_message=message
+                                        )
+                                        # Restart recording.
+                                        self.restart_activated = True
+                                        loop = asyncio.get_event_loop()
+                                        asyncio.run_coroutine_threadsafe(
+                                            self.wurb_manager.restart_rec(),
+                                            loop,
+                                        )
+                                        await self.remove_items_from_queue(
+                                            self.from_source_queue
+                                        )
+                                        await self.from_source_queue.put(
+                                            False
+                                        )  # Flush.
                                         return
+
+                                first_peak = None
+                                file_items = []
+                                status = item.get("status", "")
+                                if status == "data":
+                                    # Check for sound.
+                                    detection_result = await sound_detector.check_for_sound(
+                                        (item["adc_time"], item["data"])
+                                    )
+                                    first_peak, file_items = self.sound_trigger.add_buffer(
+                                        item,
+                                        detection_result,
+                                        sound_detector.active_ranges,
+                                    )
+                                elif status == "sound_detected":
+                                    # From detection in the capture thread.
+                                    first_peak = item["first_peak"]
+                                elif status == "segment":
+                                    # From detection in the capture thread.
+                                    file_items = item["file_items"]
+
+                                # Log first detected sound.
+                                if first_peak:
+                                    peak_freq_hz, peak_dbfs = first_peak
                                     # Logging.
-                                    message = "Warning: Time diff. detected. Rec. will be restarted."
+                                    message = (
+                                        "Sound peak: "
+                                        + str(round(peak_freq_hz / 1000.0, 1))
+                                        + " kHz / "
+                                        + str(round(peak_dbfs, 1))
+                                        + " dBFS."
+                                    )
                                     self.wurb_logging.info(
                                         message, short_message=message
                                     )
-                                    # Restart recording.
-                                    self.restart_activated = True
-                                    loop = asyncio.get_event_loop()
-                                    asyncio.run_coroutine_threadsafe(
-                                        self.wurb_manager.restart_rec(),
-                                        loop,
-                                    )
-                                    await self.remove_items_from_queue(
-                                        self.from_source_queue
-                                    )
-                                    await self.from_source_queue.put(False)  # Flush.
-                                    return
 
-                                # Store in list-
-                                new_item = {}
-                                new_item["status"] = "data-Counter-" + str(
-                                    sound_detected_counter
-                                )
-                                new_item["adc_time"] = item["adc_time"]
-                                new_item["data"] = item["data"]
-
-                                self.process_deque.append(new_item)
-                                # Remove oldest items if the list is too long.
-                                while (
-                                    len(self.process_deque) > self.process_deque_length
-                                ):
-                                    self.process_deque.popleft()
-
-                                # Check for sound.
-                                detection_result = sound_detector.check_for_sound(
-                                    (item["adc_time"], item["data"])
-                                )
-                                (
-                                    sound_detected,
-                                    peak_freq_hz,
-                                    peak_dbfs,
-                                ) = detection_result
-
-                                if (not first_sound_detected) and sound_detected:
-                                    first_sound_detected = True
-                                    sound_detected_counter = 0
-                                    max_peak_freq_hz = peak_freq_hz
-                                    max_peak_dbfs = peak_dbfs
-                                    # Log first detected sound.
-                                    if max_peak_dbfs and peak_dbfs:
-                                        # Logging.
-                                        message = (
-                                            "Sound peak: "
-                                            + str(round(peak_freq_hz / 1000.0, 1))
-                                            + " kHz / "
-                                            + str(round(peak_dbfs, 1))
-                                            + " dBFS."
-                                        )
-                                        self.wurb_logging.info(
-                                            message, short_message=message
-                                        )
-
-                                # Accumulate in file queue.
-                                if first_sound_detected == True:
-                                    sound_detected_counter += 1
-                                    if max_peak_dbfs and peak_dbfs:
-                                        if peak_dbfs > max_peak_dbfs:
-                                            max_peak_freq_hz = peak_freq_hz
-                                            max_peak_dbfs = peak_dbfs
-                                    if (
-                                        sound_detected_counter
-                                        >= self.detection_counter_max
-                                    ) and (
-                                        len(self.process_deque)
-                                        >= self.process_deque_length
-                                    ):
-                                        first_sound_detected = False
-                                        sound_detected_counter = 0
-                                        # Send to target.
-                                        for index in range(
-                                            0, self.process_deque_length
-                                        ):
-                                            to_file_item = self.process_deque.popleft()
-                                            #
-                                            if index == 0:
-                                                to_file_item["status"] = "new_file"
-                                                to_file_item[
-                                                    "max_peak_freq_hz"
-                                                ] = max_peak_freq_hz
-                                                to_file_item[
-                                                    "max_peak_dbfs"
-                                                ] = max_peak_dbfs
-                                            if index == (self.process_deque_length - 1):
-                                                to_file_item["status"] = "close_file"
-                                            #
-                                            if not self.to_target_queue.full():
-                                                await self.to_target_queue.put(
-                                                    to_file_item
-                                                )
-
-                                            # await asyncio.sleep(0)
+                                # Send to target. Added or dropped as a whole file.
+                                if file_items:
+                                    self.to_target_queue.put_file_nowait(file_items)
 
                             # status = item.get('status', '')
                             # adc_time = item.get('time', '')
@@ -507,7 +558,7 @@ class WurbRecorder(wurb_rec.SoundStreamManager):
 
                     except asyncio.QueueFull:
                         await self.remove_items_from_queue(self.to_target_queue)
-                        self.process_deque.clear()
+                        self.sound_trigger.clear()
                         await self.to_target_queue.put(False)  # Flush.
                 except asyncio.CancelledError:
                     break
@@ -523,53 +574,76 @@ class WurbRecorder(wurb_rec.SoundStreamManager):
             message = "Recorder: sound_process_worker(2): " + str(e)
             self.wurb_manager.wurb_logging.error(message, short_message=message)
         finally:
-            pass
+            try:
+                # Logging debug.
+                for queue in [self.from_source_queue, self.to_target_queue]:
+                    statistics = queue.get_statistics()
+                    if statistics.get("dropped_items", 0) or statistics.get(
+                        "spilled_items", 0
+                    ):
+                        message = "Sound queue statistics: " + str(statistics)
+                        self.wurb_manager.wurb_logging.debug(message=message)
+            except Exception:
+                pass
+            if sound_detector is not None:
+                try:
+                    # Logging debug.
+                    statistics = await sound_detector.get_statistics()
+                    if statistics:
+                        message = "Sound detection statistics: " + str(statistics)
+                        self.wurb_manager.wurb_logging.debug(message=message)
+                except Exception:
+                    pass
+                await sound_detector.shutdown()
 
     async def sound_target_worker(self):
-        """Worker for sound targets. Mainly files or streams."""
-        wave_file_writer = None
+        """Worker for sound targets. Mainly files or streams.
+        Items for one sound file are collected and the file is written
+        by the write-behind writer, outside the event loop."""
+        recording_items = []
+        spill_buffer = None
+        write_behind = WaveFileWriteBehind(
+            self.wurb_manager, max_pending_files=self.write_behind_max_files
+        )
         try:
+            # Overflow stage between to_target_queue and the file writer.
+            if self.queue_drop_policy == "spill":
+                spill_buffer = wurb_rec.SoundSpillBuffer(
+                    dir_path=self.spill_dir, size_mb=self.spill_size_mb
+                )
+                self.to_target_queue.spill_target = spill_buffer
             while True:
                 try:
                     item = await self.to_target_queue.get()
                     try:
-                        if self.wurb_settings.get_setting('classification_algorithm') == "classification-batclassify" and item == None:
+                        if item == None:
                             # Terminated by process.
-                            await self.to_classify_queue.put(None)
-                            break
-                        elif item == None:
+                            if recording_items:
+                                await write_behind.write_recording(recording_items)
+                                recording_items = []
+                            await write_behind.wait_for_pending()
                             break
                         elif item == False:
                             await self.remove_items_from_queue(self.to_target_queue)
-                            if wave_file_writer:
-                                wave_file_writer.close()
+                            if recording_items:
+                                await write_behind.write_recording(recording_items)
+                                recording_items = []
                         else:
                             # New.
                             if item["status"] == "new_file":
-                                if wave_file_writer:
-                                    wave_file_writer.close()
-
-                                wave_file_writer = WaveFileWriter(self.wurb_manager)
-                                max_peak_freq_hz = item.get("max_peak_freq_hz", None)
-                                max_peak_dbfs = item.get("max_peak_dbfs", None)
-                                wave_file_writer.create(
-                                    item["adc_time"], max_peak_freq_hz, max_peak_dbfs
-                                )
+                                if recording_items:
+                                    await write_behind.write_recording(recording_items)
+                                recording_items = [item]
                             # Data.
-                            if wave_file_writer:
-                                data_array = item["data"]
-                                wave_file_writer.write(data_array)
+                            elif recording_items:
+                                recording_items.append(item)
                             # File.
-                            if item["status"] == "close_file":
-                                if wave_file_writer:
-                                    if wave_file_writer.wave_file is not None:
-                                        wave_filename = wave_file_writer.filename
-                                        wave_filepath = wave_file_writer.filepath
-                                        await self.wurb_manager.wurb_metadata.append_settingMetadata(str(wave_filepath))
-                                        if self.wurb_settings.get_setting('classification_algorithm') == 'classification-batclassify':
-                                            await self.to_classify_queue.put({"filename": wave_filename, "filepath": wave_filepath}) 
-                                    wave_file_writer.close()
-                                    wave_file_writer = None
+                            if (item["status"] == "close_file") or item.get(
+                                "close_file", False
+                            ):
+                                if recording_items:
+                                    await write_behind.write_recording(recording_items)
+                                    recording_items = []
                     finally:
                         self.to_target_queue.task_done()
                         await asyncio.sleep(0)
@@ -585,156 +659,569 @@ class WurbRecorder(wurb_rec.SoundStreamManager):
             message = "Recorder: sound_target_worker: " + str(e)
             self.wurb_manager.wurb_logging.error(message, short_message=message)
         finally:
-            pass
-    
-    async def sound_classify_worker(self):
-        # target_path = self.wurb_manager.wurb_rpi.get_wavefile_target_dir_path()
-        # analyzed_path = self.wurb_manager.wurb_rpi.get_wavefile_analyzed_dir_path()
-        try:
-            proc = p.spawn("BatClassify", timeout=None)           
-            # waiting 40 seconds to be sure models for batclassify are loaded
-            await asyncio.sleep(40)
-            message = "Process BatClassify started"
-            self.wurb_logging.debug(message, short_message=message)
-            while True:
-                try:
-                    item = await self.to_classify_queue.get()                
-                    try:
-                        if item == None:
-                            await self.to_database_queue.put(None)
-                            break
-                        else: 
-                            # target_path = item["filepath"]
-                            # analyzed_path = pathlib.Path(target_path, "analyzed")
-                            # if target_path.exists():
-                            #     if not analyzed_path.exists():
-                            #         analyzed_path.mkdir()                             
-
-                            filepath = str(item["filepath"])
-                            # filepath = str(target_path) + "/" + item
-                            proc.expect('inputfile:')   
-                            proc.sendline(str(filepath))
-                            # message = "Analysing sound file..."
-                            # self.wurb_manager.wurb_logging.info(message, short_message = message)                            
-                            proc.expect('\n')
-                            proc.expect('\n')
-                            stdout = proc.before.decode()                      
-                            stdout = json.loads(stdout)
-                            await self.to_database_queue.put({"filename": item["filename"], "batclassify": stdout, "filepath": filepath})                           
-                            
-                    # except Exception as e:
-                    #     message = "Recorder: sound_classify_worker: " + str(e)
-                    #     self.wurb_manager.wurb_logging.error(message, short_message=message)
-                    finally:
-                        self.to_classify_queue.task_done
+            await write_behind.shutdown()
+            if spill_buffer is not None:
+                self.to_target_queue.spill_target = None
+                spill_buffer.close()
+
+    async def file_written(self, file_info):
+        """ Called in the event loop when a sound file is written. """
+        filename = file_info["filename"]
+        filepath = file_info["filepath"]
+        # FLAC: Metadata in the comment field, not readable by the guano module.
+        # WAV: Metadata is written on the I/O thread.
+        is_flac = file_info.get("file_format", "wav") == "flac"
+        # Index used for disk quota.
+        file_datetime = datetime.datetime.fromtimestamp(
+            file_info["start_time"], datetime.timezone.utc
+        )
+        await self.wurb_manager.wurb_retention.add_file(
+            filepath, file_datetime.strftime("%Y-%m-%dT%H:%M:%SZ"), file_info["size_bytes"]
+        )
+        if is_flac:
+            return
+        wurb_classify_scheduler = self.wurb_manager.wurb_classify_scheduler
+        if wurb_classify_scheduler.is_active():
+            # Sound data for in-process classifiers, the file is not read again.
+            if file_info.get("data_int16", None) is not None:
+                wurb_classify_scheduler.add_sound_data(
+                    filepath, file_info["data_int16"], file_info["sampling_freq_hz"]
+                )
+            # Stored in the database, classified when allowed by the scheduler.
+            await self.wurb_manager.wurb_classify_queue.add(
+                filepath, filename, file_info.get("content_hash", None)
+            )
+            wurb_classify_scheduler.notify()
 
 
-                except asyncio.CancelledError:
-                    # proc.close()
+class SoundTrigger(object):
+    """ Pre-trigger buffer and trigger logic for sound files.
+        Used by the sound process worker, or in the capture thread
+        when detection is done there. Does not use asyncio.
+    """
+
+    def __init__(self, rec_length_s):
+        """ """
+        self.process_deque = deque()  # Double ended queue.
+        self.process_deque_length = rec_length_s * 2
+        self.detection_counter_max = self.process_deque_length - 3  # 1.5 s before.
+        self.clear()
+
+    def clear(self):
+        """ """
+        self.process_deque.clear()
+        self.first_sound_detected = False
+        self.sound_detected_counter = 0
+        self.max_peak_freq_hz = None
+        self.max_peak_dbfs = None
+
+    def add_buffer(self, item, detection_result, active_ranges=None):
+        """ Returns (freq, dBFS) for the first detected sound and a list
+            of items to send to target when a file is complete.
+            Active ranges from the detector are used for sparse files. """
+        first_peak = None
+        file_items = []
+        # Store in list.
+        new_item = {}
+        new_item["status"] = "data-Counter-" + str(self.sound_detected_counter)
+        new_item["adc_time"] = item["adc_time"]
+        new_item["index"] = item.get("index", None)
+        new_item["ring_buffer"] = item.get("ring_buffer", None)
+        new_item["data"] = item["data"]
+        new_item["active_ranges"] = active_ranges
+
+        self.process_deque.append(new_item)
+        # Remove oldest items if the list is too long.
+        while len(self.process_deque) > self.process_deque_length:
+            self.process_deque.popleft()
+
+        sound_detected, peak_freq_hz, peak_dbfs = detection_result
+
+        if (not self.first_sound_detected) and sound_detected:
+            self.first_sound_detected = True
+            self.sound_detected_counter = 0
+            self.max_peak_freq_hz = peak_freq_hz
+            self.max_peak_dbfs = peak_dbfs
+            if peak_freq_hz and peak_dbfs:
+                first_peak = (peak_freq_hz, peak_dbfs)
+
+        # Accumulate in file queue.
+        if self.first_sound_detected == True:
+            self.sound_detected_counter += 1
+            if self.max_peak_dbfs and peak_dbfs:
+                if peak_dbfs > self.max_peak_dbfs:
+                    self.max_peak_freq_hz = peak_freq_hz
+                    self.max_peak_dbfs = peak_dbfs
+            if (self.sound_detected_counter >= self.detection_counter_max) and (
+                len(self.process_deque) >= self.process_deque_length
+            ):
+                self.first_sound_detected = False
+                self.sound_detected_counter = 0
+                # Send to target.
+                for index in range(0, self.process_deque_length):
+                    to_file_item = self.process_deque.popleft()
+                    #
+                    if index == 0:
+                        to_file_item["status"] = "new_file"
+                        to_file_item["max_peak_freq_hz"] = self.max_peak_freq_hz
+                        to_file_item["max_peak_dbfs"] = self.max_peak_dbfs
+                    if index == (self.process_deque_length - 1):
+                        to_file_item["status"] = "close_file"
+                    file_items.append(to_file_item)
+
+        return first_peak, file_items
+
+
+class VariableLengthTrigger(object):
+    """ Trigger for variable length sound files. The file is extended as
+        long as sound is detected, up to the max length. The pre- and
+        post-trigger times are counted in samples from the detected sound,
+        and the first and last buffer in the file are cut to match them.
+        Same interface as SoundTrigger.
+    """
+
+    def __init__(
+        self, max_length_s, sampling_freq_hz, pre_trigger_s=1.0, post_trigger_s=1.0
+    ):
+        """ """
+        self.max_length = int(max_length_s * sampling_freq_hz)
+        self.pre_trigger = int(max(0.0, pre_trigger_s) * sampling_freq_hz)
+        self.post_trigger = int(max(0.0, post_trigger_s) * sampling_freq_hz)
+        # Items as (position, item), position is the sample count in the stream.
+        self.process_deque = deque()  # Before the trigger.
+        self.file_deque = deque()  # In the current file.
+        self.clear()
+
+    def clear(self):
+        """ """
+        self.process_deque.clear()
+        self.file_deque.clear()
+        self.stream_position = 0
+        self.file_start = None
+        self.last_file_end = 0
+        self.sound_end = 0
+        self.max_peak_freq_hz = None
+        self.max_peak_dbfs = None
+
+    def add_buffer(self, item, detection_result, active_ranges=None):
+        """ Returns (freq, dBFS) for the first detected sound and a list
+            of items to send to target when a file is complete. """
+        first_peak = None
+        file_items = []
+        position = self.stream_position
+        length = len(item["data"])
+        self.stream_position += length
+        new_item = {}
+        new_item["status"] = "data"
+        new_item["adc_time"] = item["adc_time"]
+        new_item["index"] = item.get("index", None)
+        new_item["ring_buffer"] = item.get("ring_buffer", None)
+        new_item["data"] = item["data"]
+        new_item["active_ranges"] = active_ranges
+
+        sound_detected, peak_freq_hz, peak_dbfs = detection_result
+        # Position of the sound in the stream.
+        sound_start = position
+        sound_end = position + length
+        if active_ranges:
+            sound_start = position + max(0, active_ranges[0][0])
+            sound_end = position + active_ranges[-1][1]
+
+        if self.file_start is None:
+            self.process_deque.append((position, new_item))
+            # Remove items not needed for the pre-trigger time.
+            while self.process_deque:
+                first_position, first_item = self.process_deque[0]
+                first_end = first_position + len(first_item["data"])
+                if first_end > (position - self.pre_trigger):
                     break
-                except Exception as e:
-                    message = "Recorder: sound_classify_worker: " + str(e)
-                    self.wurb_manager.wurb_logging.error(message, short_message=message)
-                    
-                finally:                                        
-                    await asyncio.sleep(10)
-        
-        except asyncio.CancelledError:
-            # proc.close()
-            pass
+                self.process_deque.popleft()
+            if sound_detected:
+                # New file. Data already stored in the last file is not used.
+                self.file_start = max(
+                    sound_start - self.pre_trigger,
+                    self.process_deque[0][0],
+                    self.last_file_end,
+                )
+                self.file_deque.extend(self.process_deque)
+                self.process_deque.clear()
+                self.sound_end = sound_end
+                self.max_peak_freq_hz = peak_freq_hz
+                self.max_peak_dbfs = peak_dbfs
+                if peak_freq_hz and peak_dbfs:
+                    first_peak = (peak_freq_hz, peak_dbfs)
+        else:
+            self.file_deque.append((position, new_item))
+            if sound_detected:
+                # Extend the file.
+                self.sound_end = max(self.sound_end, sound_end)
+                if self.max_peak_dbfs and peak_dbfs:
+                    if peak_dbfs > self.max_peak_dbfs:
+                        self.max_peak_freq_hz = peak_freq_hz
+                        self.max_peak_dbfs = peak_dbfs
+
+        if self.file_start is not None:
+            file_end = min(
+                self.sound_end + self.post_trigger, self.file_start + self.max_length
+            )
+            if self.stream_position >= file_end:
+                file_items = self.get_file_items(file_end)
+        return first_peak, file_items
+
+    def get_file_items(self, file_end):
+        """ Items in the file, the first and last are cut. Data after the
+            end is kept as pre-trigger data for the next file. """
+        file_items = []
+        for position, item in self.file_deque:
+            length = len(item["data"])
+            start = max(self.file_start, position) - position
+            end = min(file_end, position + length) - position
+            if end > start:
+                file_item = item
+                if (start > 0) or (end < length):
+                    file_item = dict(item)
+                    file_item["data"] = item["data"][start:end]
+                    if item["index"] is not None:
+                        file_item["index"] = item["index"] + start
+                    if item["active_ranges"]:
+                        file_item["active_ranges"] = [
+                            [range_start - start, range_end - start]
+                            for range_start, range_end in item["active_ranges"]
+                        ]
+                file_items.append(file_item)
+            if position + length > file_end:
+                self.process_deque.append((position, item))
+        self.file_deque.clear()
+        self.file_start = None
+        self.last_file_end = file_end
+        if file_items:
+            file_items[0]["status"] = "new_file"
+            file_items[0]["max_peak_freq_hz"] = self.max_peak_freq_hz
+            file_items[0]["max_peak_dbfs"] = self.max_peak_dbfs
+            # A short file may only contain one item.
+            file_items[-1]["close_file"] = True
+            if len(file_items) > 1:
+                file_items[-1]["status"] = "close_file"
+        return file_items
+
+
+class CaptureThreadDetection(object):
+    """ Sound detection and pre-trigger buffer in the capture thread.
+        Only complete file segments, the first detected peak and
+        status ticks are sent to the event loop. The capture classes
+        use it as "process_target", with the method process_buffer().
+    """
+
+    def __init__(self, wurb_manager, sound_trigger):
+        """ """
+        self.wurb_manager = wurb_manager
+        self.sound_trigger = sound_trigger
+        self.sound_detector = wurb_rec.SoundDetection(wurb_manager).get_detection()
+        self.buffer_counter = 0
+        self.reset_requested = False
+        # Config.
+        self.tick_interval_buffers = 10  # 5 sec.
+
+    def request_reset(self):
+        """ Called from the event loop when the sound stream is flushed.
+            Buffers kept in the trigger and detector are cleared by the
+            capture thread, before the next buffer is used. """
+        self.reset_requested = True
+
+    def process_buffer(self, data_dict):
+        """ Called from the capture thread. Returns items for the data queue. """
+        queue_items = []
+        if self.reset_requested:
+            self.reset_requested = False
+            self.sound_trigger.clear()
+            self.sound_detector.reset()
+        detection_result = self.sound_detector.check_for_sound(
+            (data_dict["adc_time"], data_dict["data"])
+        )
+        first_peak, file_items = self.sound_trigger.add_buffer(
+            data_dict, detection_result, self.sound_detector.active_ranges
+        )
+        if first_peak:
+            queue_items.append({"status": "sound_detected", "first_peak": first_peak})
+        if file_items:
+            queue_items.append({"status": "segment", "file_items": file_items})
+        # Status tick. Used to check time drift and lost connection.
+        self.buffer_counter += 1
+        if self.buffer_counter >= self.tick_interval_buffers:
+            self.buffer_counter = 0
+            queue_items.append(
+                {
+                    "status": "tick",
+                    "adc_time": data_dict["adc_time"],
+                    "detector_time": data_dict["detector_time"],
+                }
+            )
+        return queue_items
+
+    def get_statistics(self):
+        """ """
+        return self.sound_detector.get_statistics()
+
+
+class WaveFileWriteBehind(object):
+    """ Writes complete sound files on a dedicated I/O thread.
+        The number of files waiting to be written is limited, the
+        target worker waits when the limit is reached.
+    """
+
+    def __init__(self, wurb_manager, max_pending_files=2):
+        """ """
+        self.wurb_manager = wurb_manager
+        self.wurb_recorder = wurb_manager.wurb_recorder
+        self.wurb_logging = wurb_manager.wurb_logging
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.pending_semaphore = asyncio.Semaphore(max_pending_files)
+        self.pending_tasks = set()
+        # "preallocated" or "wave" (wave module, header patched on close).
+        self.wave_file_mode = os.getenv("WURB_REC_WAVE_FILE_MODE", "preallocated")
+        # Sound before and after each segment in sparse files.
+        self.sparse_padding_s = (
+            float(os.getenv("WURB_REC_SPARSE_PADDING_MS", "50")) / 1000.0
+        )
+        # A copy of the sound data is kept for in-process classifiers.
+        self.keep_sound_data = wurb_manager.wurb_classify_scheduler.uses_sound_data()
+        # Hash of the sound data, used for cached classification results.
+        self.hash_sound_data = wurb_manager.wurb_classify_scheduler.is_active()
+        # Statistics.
+        self.files_written = 0
+        self.files_lost = 0
+        self.write_time_max_s = 0.0
+        self.write_time_sum_s = 0.0
+        self.latency_max_s = 0.0
+
+    async def write_recording(self, items):
+        """ Items for one file, the first item contains "new_file".
+            Returns when the file is queued for writing. """
+        await self.pending_semaphore.acquire()
+        task = asyncio.ensure_future(self.write_and_finish(items, time.time()))
+        self.pending_tasks.add(task)
+        task.add_done_callback(self.pending_tasks.discard)
+
+    async def write_and_finish(self, items, queued_time):
+        """ """
+        try:
+            loop = asyncio.get_event_loop()
+            result = await loop.run_in_executor(
+                self.executor, self.write_file, items, queued_time
+            )
+            if result:
+                await self.wurb_recorder.file_written(result)
         except Exception as e:
-            message = "Recorder: sound_classify_worker: " + str(e)
+            # Logging error.
+            message = "Recorder: write_and_finish: " + str(e)
             self.wurb_manager.wurb_logging.error(message, short_message=message)
         finally:
-            proc.close()
-
-    async def sound_database_worker(self):
-        # target_path = self.wurb_manager.wurb_rpi.get_wavefile_target_dir_path()
-        # analyzed_path = self.wurb_manager.wurb_rpi.get_wavefile_analyzed_dir_path()
-        database = self.wurb_manager.wurb_database
-        
-        try:
-            while True:
-                try:
-                    item = await self.to_database_queue.get()
-                    message = "Sound_database_worker: got item from queue"
-                    self.wurb_manager.wurb_logging.debug(message, short_message=message)
-                    try:
-                        if item == None:
-                            message = "Sound_database_worker: terminated with item: None"
-                            self.wurb_manager.wurb_logging.debug(message, short_message=message)
-                            break
-                        else:
-                            # extract datatime String from filename and transform dtime to datetimeformat for sqlite
-                            dtime = datetime.datetime.strptime(item["filename"].split('_')[1], "%Y%m%dT%H%M%S%z")
-
-                            item.update({'datetime': dtime})                        
-
-                            message = "Sound_database_worker: extracted datetime from item"
-                            self.wurb_manager.wurb_logging.debug(message, short_message=message)
-                            
-                            # adding metadata to soundfile                     
-                            # await self.wurb_manager.wurb_metadata.append_settingMetadata(item["filepath"])                            
-                            bat, prob = await self.wurb_manager.wurb_metadata.append_fileMetadata(item)
-                                                    
-                            message = "Sound_database_worker: added metadata to soundfile"
-                            self.wurb_manager.wurb_logging.debug(message, short_message=message)
-                            
-                            try:
-                                target_path = pathlib.Path(item["filepath"]).parent
-                                analyzed_path = pathlib.Path(target_path, "analyzed")
-                                if target_path.exists():
-                                    if not analyzed_path.exists():
-                                        analyzed_path.mkdir()
-
-                                    # move file to "analyzed path"
-                                    target_file = pathlib.Path(analyzed_path, bat + "_" + f"{prob*100:.0f}" + "_" + item["filename"])
-                                    # shutil.move(item["filepath"], str(analyzed_path)+"/"+item["filename"])
-                                    shutil.move(item["filepath"], target_file)
-                                    # update filepath in item
-                                    # item.update({"filepath": str(analyzed_path)+"/"+item["filename"]})
-                                    item.update({"filepath": str(target_file)})
-
-                                    if bat == "unclassified":
-                                        prob = ""
-                                        message = "Due to low probability not classified"
-                                    else:
-                                        message = "Soundfile classified as {}; probability: {:1.2f}%".format(bat, prob*100)
-                                    await database.insert_data(item, bat, prob)                            
-                                    
-                                    self.wurb_manager.wurb_logging.info(message, short_message = message)
-
-                                    # await self.set_bat_data(bat)
-                            except Exception as e:
-                                message = "Recorder: sound_database_worker: " + str(e)
-                                self.wurb_manager.wurb_logging.error(message, short_message=message)
-                    finally:
-                        self.to_database_queue.task_done                   
+            self.pending_semaphore.release()
+
+    def write_file(self, items, queued_time):
+        """ Runs on the I/O thread. Returns a dict with file info, or None. """
+        start_time = time.time()
+        wave_file_writer = WaveFileWriter(self.wurb_manager)
+        first_item = items[0]
+        file_format = wave_file_writer.get_file_format()
+        buffers = self.get_buffers(items, wave_file_writer)
+        wave_file_writer.stored_samples = sum([len(buffer) for buffer in buffers])
+        data_int16 = None
+        if self.keep_sound_data and (file_format != "flac"):
+            # Only copied if there is room in the classifier cache.
+            data_bytes = sum([buffer.nbytes for buffer in buffers])
+            classify_scheduler = self.wurb_manager.wurb_classify_scheduler
+            if classify_scheduler.can_accept_sound_data(data_bytes):
+                # Copied before the check below, the ring buffer is reused.
+                data_int16 = np.concatenate(buffers)
+        content_hash = None
+        if self.hash_sound_data and (file_format != "flac"):
+            content_hash = wurb_rec.create_content_hash()
+            for buffer in buffers:
+                content_hash.update(np.ascontiguousarray(buffer))
+        if (file_format == "flac") or (self.wave_file_mode == "preallocated"):
+            wave_file_writer.create_filepath(
+                first_item["adc_time"],
+                first_item.get("max_peak_freq_hz", None),
+                first_item.get("max_peak_dbfs", None),
+            )
+            if wave_file_writer.filepath is None:
+                return None
+            if not self.is_data_available(items):
+                return self.data_lost(None)
+            if file_format == "flac":
+                wave_file_writer.write_flac(buffers)
+            else:
+                wave_file_writer.write_complete(buffers)
+            # Check again, data may have been overwritten during the write.
+            if not self.is_data_available(items):
+                return self.data_lost(wave_file_writer)
+        else:
+            wave_file_writer.create(
+                first_item["adc_time"],
+                first_item.get("max_peak_freq_hz", None),
+                first_item.get("max_peak_dbfs", None),
+            )
+            if wave_file_writer.wave_file is None:
+                return None
+            if not self.is_data_available(items):
+                wave_file_writer.close()
+                return self.data_lost(wave_file_writer)
+            for buffer in buffers:
+                wave_file_writer.write(buffer)
+            wave_file_writer.close()
+            wave_file_writer.append_guano_chunk()
+            if not self.is_data_available(items):
+                return self.data_lost(wave_file_writer)
+        if content_hash is not None:
+            # Sampling freq. in the header, differs for TE.
+            content_hash.update(str(wave_file_writer.sampling_freq_hz).encode())
+            content_hash = content_hash.hexdigest()
+        # Size on disk, header and GUANO chunk included. Used by retention
+        # and to forecast free space on the target media.
+        size_bytes = os.path.getsize(wave_file_writer.filepath)
+        self.wurb_manager.wurb_rpi.report_bytes_written(size_bytes)
+        # Statistics.
+        end_time = time.time()
+        write_time_s = end_time - start_time
+        self.files_written += 1
+        self.write_time_sum_s += write_time_s
+        self.write_time_max_s = max(self.write_time_max_s, write_time_s)
+        self.latency_max_s = max(self.latency_max_s, end_time - queued_time)
+        return {
+            "filename": wave_file_writer.filename,
+            "filepath": wave_file_writer.filepath,
+            "file_format": wave_file_writer.file_format,
+            "start_time": first_item["adc_time"],
+            "size_bytes": size_bytes,
+            "data_int16": data_int16,
+            "sampling_freq_hz": self.wurb_recorder.sampling_freq_hz,
+            "content_hash": content_hash,
+        }
+
+    def get_buffers(self, items, wave_file_writer):
+        """ Sound data to write. Sparse files only contain the segments
+            with sound, and the segments are added to the metadata. """
+        buffers = [item["data"] for item in items]
+        if not self.is_sparse_file():
+            return buffers
+        segments = self.get_segments(items)
+        if not segments:
+            return buffers
+        wave_file_writer.segments = segments
+        buffers = []
+        item_start = 0
+        for item in items:
+            data = item["data"]
+            item_end = item_start + len(data)
+            for start, end in segments:
+                if (start < item_end) and (end > item_start):
+                    first = max(start, item_start) - item_start
+                    last = min(end, item_end) - item_start
+                    buffers.append(data[first:last])
+            item_start = item_end
+        return buffers
+
+    def is_sparse_file(self):
+        """ Sparse files are only used when sound detection triggers the files. """
+        wurb_settings = self.wurb_manager.wurb_settings
+        if wurb_settings.get_setting("rec_sparse_option") != "sparse-on":
+            return False
+        rec_mode = wurb_settings.get_setting("rec_mode")
+        return rec_mode in ["mode-auto", "mode-scheduler-auto"]
+
+    def get_segments(self, items):
+        """ Active ranges from the detector, with padding, as [start, end]
+            sample positions from the start of the file. Overlapping
+            segments are merged. """
+        padding = int(self.sparse_padding_s * self.wurb_recorder.sampling_freq_hz)
+        segments = []
+        item_start = 0
+        for item in items:
+            length = len(item["data"])
+            active_ranges = item.get("active_ranges", None)
+            if active_ranges is None:
+                # Not known, all is used.
+                active_ranges = [[0, length]]
+            for range_start, range_end in active_ranges:
+                start = max(0, item_start + range_start - padding)
+                end = item_start + range_end + padding
+                if segments and (start <= segments[-1][1]):
+                    segments[-1][1] = max(segments[-1][1], end)
+                else:
+                    segments.append([start, end])
+            item_start += length
+        for segment in segments:
+            segment[1] = min(segment[1], item_start)
+        return segments
+
+    def is_data_available(self, items):
+        """ Check that data in the ring buffer is not overwritten. Each item
+            refers to its own ring buffer, files waiting to be written when
+            recording is restarted use the old buffer. """
+        for item in items:
+            ring_buffer = item.get("ring_buffer", None)
+            ring_index = item.get("index", None)
+            if (ring_buffer is not None) and (ring_index is not None):
+                if not ring_buffer.is_available(ring_index):
+                    return False
+        return True
+
+    def data_lost(self, wave_file_writer):
+        """ Removes the file if created. Returns None. """
+        if (wave_file_writer is not None) and (wave_file_writer.filepath is not None):
+            if wave_file_writer.filepath.exists():
+                wave_file_writer.filepath.unlink()
+        self.files_lost += 1
+        # Logging.
+        message = "Sound data lost, file removed. Too slow target."
+        if self.wurb_recorder.ring_buffer_capped:
+            message = (
+                "Sound data lost, file removed. Too slow target, "
+                + "ring buffer capped by WURB_REC_RING_BUFFER_MAX_MB."
+            )
+        self.wurb_logging.warning(message, short_message=message)
+        return None
 
+    async def wait_for_pending(self):
+        """ """
+        if self.pending_tasks:
+            await asyncio.gather(*list(self.pending_tasks), return_exceptions=True)
 
-                except asyncio.CancelledError:                   
-                    break
-                except Exception as e:
-                    message = "Recorder: sound_database_worker: " + str(e)
-                    self.wurb_manager.wurb_logging.error(message, short_message=message)
-                    
-                finally:                                        
-                    await asyncio.sleep(1)
-        
-        except asyncio.CancelledError:                   
-            pass
+    async def shutdown(self):
+        """ Waits for pending files. """
+        try:
+            await self.wait_for_pending()
+            self.executor.shutdown(wait=False)
+            # Logging debug.
+            if self.files_written or self.files_lost:
+                message = "Sound file writer statistics: " + str(self.get_statistics())
+                self.wurb_logging.debug(message=message)
         except Exception as e:
-            message = "Recorder: sound_database_worker: " + str(e)
+            # Logging error.
+            message = "Recorder: write-behind shutdown: " + str(e)
             self.wurb_manager.wurb_logging.error(message, short_message=message)
-        finally:
-            pass
-            
+
+    def get_statistics(self):
+        """ """
+        write_time_mean_s = 0.0
+        if self.files_written > 0:
+            write_time_mean_s = self.write_time_sum_s / self.files_written
+        return {
+            "files_written": self.files_written,
+            "files_lost": self.files_lost,
+            "write_time_mean_s": round(write_time_mean_s, 3),
+            "write_time_max_s": round(self.write_time_max_s, 3),
+            "latency_max_s": round(self.latency_max_s, 3),
+        }
 
 
 class WaveFileWriter:
     """Each file is connected to a separate file writer object
     to avoid concurrency problems."""
 
+    flac_warning_logged = False
+
     def __init__(self, wurb_manager):
         """ """
         self.wurb_manager = wurb_manager
@@ -746,16 +1233,53 @@ class WaveFileWriter:
         self.wave_file = None
         self.filename = None
         self.filepath = None
+        self.sampling_freq_hz = None
+        self.start_time = None
+        self.guano_written = False
+        self.file_format = "wav"
+        self.segments = None  # Used for sparse files.
+        self.stored_samples = 0
         # self.size_counter = 0
+        # Config.
+        self.guano_reserved_size = 4096  # Unit: bytes.
+
+    def get_file_format(self):
+        """ "wav" or "flac". WAV is used if the soundfile package is missing. """
+        self.file_format = "wav"
+        if self.wurb_settings.get_setting("rec_file_format") == "format-flac":
+            if soundfile is not None:
+                self.file_format = "flac"
+            elif not WaveFileWriter.flac_warning_logged:
+                WaveFileWriter.flac_warning_logged = True
+                # Logging.
+                message = "FLAC not available, install soundfile. WAV is used."
+                self.wurb_logging.warning(message, short_message=message)
+        return self.file_format
 
     def create(self, start_time, max_peak_freq_hz, max_peak_dbfs):
         """ """
+        self.create_filepath(start_time, max_peak_freq_hz, max_peak_dbfs)
+        if self.filepath is None:
+            self.wave_file = None
+            return
+        # Open wave file for writing.
+        self.wave_file = wave.open(str(self.filepath), "wb")
+        self.wave_file.setnchannels(1)  # 1=Mono.
+        self.wave_file.setsampwidth(2)  # 2=16 bits.
+        self.wave_file.setframerate(self.sampling_freq_hz)
+
+    def create_filepath(self, start_time, max_peak_freq_hz, max_peak_dbfs):
+        """ Filename and directory for a new file. """
         rec_file_prefix = self.wurb_settings.get_setting("filename_prefix")
         rec_type = self.wurb_settings.get_setting("rec_type")
         sampling_freq_hz = self.wurb_recorder.sampling_freq_hz
         if rec_type == "TE":
             sampling_freq_hz = int(sampling_freq_hz / 10.0)
-        self.rec_target_dir_path = self.wurb_rpi.get_wavefile_target_dir_path()
+        self.sampling_freq_hz = sampling_freq_hz
+        self.start_time = start_time
+        self.rec_target_dir_path = self.wurb_rpi.get_wavefile_target_dir_path(
+            start_time=start_time, new_file=True
+        )
         rec_datetime = self.get_datetime(start_time)
         rec_location = self.get_location()
         rec_type_str = self.create_rec_type_str(
@@ -772,7 +1296,7 @@ class WaveFileWriter:
             peak_info_str += "dB"
 
         if self.rec_target_dir_path is None:
-            self.wave_file = None
+            self.filepath = None
             return
 
         # Filename example: "WURB1_20180420T205942+0200_N00.00E00.00_TE384.wav"
@@ -784,18 +1308,13 @@ class WaveFileWriter:
         filename += "_"
         filename += rec_type_str
         filename += peak_info_str
-        filename += ".wav"
+        filename += "." + self.file_format
         self.filename = filename
 
         # Create directories.
         if not self.rec_target_dir_path.exists():
             self.rec_target_dir_path.mkdir(parents=True)
-        # Open wave file for writing.
         filenamepath = pathlib.Path(self.rec_target_dir_path, filename)
-        self.wave_file = wave.open(str(filenamepath), "wb")
-        self.wave_file.setnchannels(1)  # 1=Mono.
-        self.wave_file.setsampwidth(2)  # 2=16 bits.
-        self.wave_file.setframerate(sampling_freq_hz)
         # Logging.
         target_path_str = str(self.rec_target_dir_path)
         target_path_str = target_path_str.replace("/media/pi/", "USB:")
@@ -816,19 +1335,139 @@ class WaveFileWriter:
             self.wave_file.writeframes(buffer)
             # self.size_counter += len(buffer) / 2  # Count frames.
 
+    def write_complete(self, buffers):
+        """ Writes a complete file with a single header pass. The file size
+            is preallocated and header, sound data and a reserved GUANO
+            chunk are written with one vectored write. """
+        data_size = sum([buffer.nbytes for buffer in buffers])
+        guano_chunk = self.get_guano_chunk()
+        header = self.get_wave_header(data_size, len(guano_chunk))
+        file_size = len(header) + data_size + len(guano_chunk)
+        fd = os.open(str(self.filepath), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            # Preallocate to avoid fragmentation. Not supported on all file systems.
+            preallocate_file(fd, file_size)
+            self.write_vectored(fd, [header] + list(buffers) + [guano_chunk])
+        finally:
+            os.close(fd)
+        self.copy_settings()
+
+    def write_flac(self, buffers):
+        """ Lossless FLAC, encoded on the calling thread. The GUANO metadata
+            is stored as text in the FLAC comment field, since FLAC
+            files have no place for the 'guan' chunk. """
+        guano_bytes = self.get_guano_bytes()
+        with soundfile.SoundFile(
+            str(self.filepath),
+            "w",
+            samplerate=self.sampling_freq_hz,
+            channels=1,
+            subtype="PCM_16",
+            format="FLAC",
+        ) as flac_file:
+            # Text must be set before sound data is written.
+            flac_file.comment = guano_bytes.decode("utf-8")
+            for buffer in buffers:
+                flac_file.write(buffer)
+        self.copy_settings()
+
+    def get_wave_header(self, data_size, guano_chunk_size):
+        """ RIFF/WAVE header for mono 16 bits PCM, up to the data content. """
+        riff_size = 4 + (8 + 16) + (8 + data_size) + guano_chunk_size
+        header = struct.pack("<4sI4s", b"RIFF", riff_size, b"WAVE")
+        header += struct.pack(
+            "<4sIHHIIHH",
+            b"fmt ",
+            16,  # Chunk size.
+            1,  # PCM.
+            1,  # Mono.
+            self.sampling_freq_hz,
+            self.sampling_freq_hz * 2,  # Byte rate.
+            2,  # Block align.
+            16,  # Bits per sample.
+        )
+        header += struct.pack("<4sI", b"data", data_size)
+        return header
+
+    def get_guano_chunk(self):
+        """ GUANO chunk with settings metadata, padded with spaces to a
+            fixed size. Classification results are added later in place. """
+        guano_bytes = self.get_guano_bytes()
+        reserved_size = max(self.guano_reserved_size, len(guano_bytes))
+        reserved_size += reserved_size % 2
+        guano_bytes += b" " * (reserved_size - len(guano_bytes))
+        return struct.pack("<4sI", b"guan", len(guano_bytes)) + guano_bytes
+
+    def append_guano_chunk(self):
+        """ Adds the GUANO chunk to a file written by the wave module. The
+            chunk is added last and the sound data is not written again. """
+        guano_chunk = self.get_guano_chunk()
+        with open(self.filepath, "r+b") as f:
+            f.seek(4)
+            riff_size = struct.unpack("<I", f.read(4))[0]
+            f.seek(0, 2)
+            f.write(guano_chunk)
+            f.seek(4)
+            f.write(struct.pack("<I", riff_size + len(guano_chunk)))
+
+    def get_guano_bytes(self):
+        """ GUANO metadata with settings, if available. """
+        guano_bytes = "GUANO|Version: 1.0\n".encode("utf-8")
+        self.guano_written = False
+        try:
+            wurb_metadata = self.wurb_manager.wurb_metadata
+            if wurb_metadata.settingMetadata is not None:
+                guano_bytes = wurb_metadata.get_guano_bytes(
+                    self.filename, self.start_time, self.get_guano_fields()
+                )
+                self.guano_written = True
+        except Exception as e:
+            # Logging error.
+            message = "Recorder: GUANO metadata: " + str(e)
+            self.wurb_manager.wurb_logging.error(message, short_message=message)
+        return guano_bytes
+
+    def get_guano_fields(self):
+        """ Fields for this file only. The length of the stored sound and,
+            for sparse files, the segment index as "start+length" in samples
+            from the start of the recording. """
+        fields = {}
+        if self.stored_samples:
+            fields["Length"] = round(
+                self.stored_samples / self.wurb_recorder.sampling_freq_hz, 3
+            )
+        if self.segments:
+            fields["Wurb|Segments"] = " ".join(
+                [str(start) + "+" + str(end - start) for start, end in self.segments]
+            )
+        return fields
+
+    def write_vectored(self, fd, buffers):
+        """ Handles partial writes from os.writev(). Sparse files can have
+            more buffers than IOV_MAX, they are written in groups. """
+        buffers = [memoryview(buffer).cast("B") for buffer in buffers]
+        iov_max = get_iov_max()
+        index = 0
+        while index < len(buffers):
+            written = os.writev(fd, buffers[index : index + iov_max])
+            while (index < len(buffers)) and (written >= len(buffers[index])):
+                written -= len(buffers[index])
+                index += 1
+            if (index < len(buffers)) and (written > 0):
+                buffers[index] = buffers[index][written:]
+
     def close(self):
         """ """
         if self.wave_file is not None:
             self.wave_file.close()
             self.wave_file = None
-        # Copy settings to target directory.
+        self.copy_settings()
+
+    def copy_settings(self):
+        """ Copy settings to target directory. """
         try:
             if self.rec_target_dir_path is not None:
-                from_dir = self.wurb_settings.settings_dir_path
-                log_file_name = self.wurb_settings.settings_file_name
-                from_file_path = pathlib.Path(from_dir, log_file_name)
-                to_file_path = pathlib.Path(self.rec_target_dir_path, log_file_name)
-                to_file_path.write_text(from_file_path.read_text())
+                self.wurb_settings.copy_settings_to_dir(self.rec_target_dir_path)
                 # Logging debug.
                 self.wurb_logging.debug(message="File closed.")
         except Exception as e:
@@ -875,3 +1514,28 @@ class WaveFileWriter:
 
     def get_filepath(self):
         return self.filepath
+
+
+
+def get_iov_max():
+    """ Max number of buffers in one os.writev() call. """
+    try:
+        iov_max = os.sysconf("SC_IOV_MAX")
+    except (AttributeError, ValueError, OSError):
+        iov_max = -1
+    return iov_max if iov_max > 0 else 1024
+
+
+def preallocate_file(fd, size):
+    """ Reserves disk space for a new file, without writing to it.
+        os.posix_fallocate() is not used, glibc then writes to every block
+        on file systems without fallocate, like vfat and exFAT on USB memories.
+        Nothing is done if fallocate is not supported. """
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fallocate = libc.fallocate64
+        fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    except (OSError, AttributeError):
+        return False
+    FALLOC_FL_KEEP_SIZE = 0x01
+    return fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, size) == 0
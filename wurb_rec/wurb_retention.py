@@ -0,0 +1,265 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org, https://github.com/cloudedbats
+# Copyright (c) 2020-present Arnold Andreasson
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import asyncio
+import os
+import pathlib
+import psutil
+
+
+class WurbRetention(object):
+    """ Disk quota for recorded sound files. Recorded files are indexed
+        in the database and the oldest files are removed when the quota
+        is exceeded or when the target media is full.
+        Only files in the index are removed, directories are not scanned.
+        Retention policy, WURB_REC_RETENTION_POLICY:
+            "oldest": Oldest files first. Default.
+            "priority": Lowest priority first, oldest first for the same
+                priority. Newer classified files are kept before older
+                files that are not classified.
+        Priority: 0=unclassified, 1=not classified yet, 2=classified.
+        Used from the event loop only, like the database.
+    """
+
+    def __init__(self, wurb_manager):
+        """ """
+        self.wurb_manager = wurb_manager
+        self.wurb_logging = wurb_manager.wurb_logging
+        self.conn = None
+        self.loop = None
+        self.total_bytes = 0
+        self.space_request_active = False
+        self.files_removed = 0
+        # Config.
+        self.quota_mb = int(os.getenv("WURB_REC_RETENTION_QUOTA_MB", "0"))  # 0=off.
+        self.policy = os.getenv("WURB_REC_RETENTION_POLICY", "oldest")
+        self.max_files_per_check = 20
+        self.free_space_margin_mb = 200  # Freed when the media is full.
+
+    def is_active(self):
+        """ """
+        return self.quota_mb > 0
+
+    async def startup(self):
+        """ """
+        try:
+            self.loop = asyncio.get_event_loop()
+            self.conn = await self.wurb_manager.wurb_database.get_db()
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS recordings
+                (filepath text PRIMARY KEY,
+                datetime text NOT NULL,
+                size_bytes integer NOT NULL,
+                priority integer NOT NULL)"""
+            )
+            self.conn.execute(
+                """CREATE INDEX IF NOT EXISTS recordings_eviction
+                ON recordings (priority, datetime)"""
+            )
+            self.conn.execute(
+                """CREATE INDEX IF NOT EXISTS recordings_datetime
+                ON recordings (datetime)"""
+            )
+            self.conn.commit()
+            row = self.conn.execute("SELECT SUM(size_bytes) FROM recordings").fetchone()
+            self.total_bytes = row[0] or 0
+        except Exception as e:
+            # Logging error.
+            message = "Retention: startup: " + str(e)
+            self.wurb_manager.wurb_logging.error(message, short_message=message)
+
+    async def add_file(self, filepath, datetime_str, size_bytes):
+        """ Called when a sound file is written. """
+        try:
+            row = self.conn.execute(
+                "SELECT size_bytes FROM recordings WHERE filepath=?",
+                [str(filepath)],
+            ).fetchone()
+            self.conn.execute(
+                """INSERT OR REPLACE INTO recordings (filepath, datetime,
+                size_bytes, priority) VALUES (?,?,?,?)""",
+                [str(filepath), datetime_str, int(size_bytes), 1],
+            )
+            self.conn.commit()
+            self.total_bytes += int(size_bytes) - (row[0] if row else 0)
+            if self.is_active():
+                await self.check_quota()
+        except Exception as e:
+            # Logging error.
+            message = "Retention: add_file: " + str(e)
+            self.wurb_manager.wurb_logging.error(message, short_message=message)
+
+    async def update_file(self, old_filepath, new_filepath, bat):
+        """ Called when a sound file is classified and moved. """
+        try:
+            priority = 0 if bat == "unclassified" else 2
+            self.conn.execute(
+                """UPDATE recordings SET filepath=?, priority=?
+                WHERE filepath=?""",
+                [str(new_filepath), priority, str(old_filepath)],
+            )
+            self.conn.commit()
+        except Exception as e:
+            # Logging error.
+            message = "Retention: update_file: " + str(e)
+            self.wurb_manager.wurb_logging.error(message, short_message=message)
+
+    async def replace_file(self, old_filepath, new_filepath, size_bytes):
+        """ Called when a sound file is converted to another format. """
+        try:
+            row = self.conn.execute(
+                "SELECT size_bytes FROM recordings WHERE filepath=?",
+                [str(old_filepath)],
+            ).fetchone()
+            if row is None:
+                return
+            self.conn.execute(
+                """UPDATE recordings SET filepath=?, size_bytes=?
+                WHERE filepath=?""",
+                [str(new_filepath), int(size_bytes), str(old_filepath)],
+            )
+            self.conn.commit()
+            self.total_bytes += int(size_bytes) - row[0]
+        except Exception as e:
+            # Logging error.
+            message = "Retention: replace_file: " + str(e)
+            self.wurb_manager.wurb_logging.error(message, short_message=message)
+
+    async def get_wave_files(self, skip_priority=None, limit=10):
+        """ Indexed WAV files, oldest first. """
+        sql = "SELECT filepath FROM recordings WHERE filepath LIKE ?"
+        parameters = ["%.wav"]
+        if skip_priority is not None:
+            sql += " AND priority != ?"
+            parameters.append(int(skip_priority))
+        sql += " ORDER BY datetime LIMIT ?"
+        parameters.append(int(limit))
+        return [row[0] for row in self.conn.execute(sql, parameters).fetchall()]
+
+    async def get_recordings(self, directory="", limit=100, offset=0):
+        """ Indexed recordings, newest first. Filtered on directory if given. """
+        sql = "SELECT filepath, datetime, size_bytes, priority FROM recordings"
+        parameters = []
+        if directory:
+            sql += " WHERE filepath LIKE ? ESCAPE '\\'"
+            parameters.append(escape_like(directory.rstrip("/")) + "/%")
+        sql += " ORDER BY datetime DESC LIMIT ? OFFSET ?"
+        parameters += [int(limit), int(offset)]
+        recordings = []
+        for filepath, datetime_str, size_bytes, priority in self.conn.execute(
+            sql, parameters
+        ).fetchall():
+            path = pathlib.Path(filepath)
+            recordings.append(
+                {
+                    "filename": path.name,
+                    "directory": str(path.parent),
+                    "filepath": filepath,
+                    "datetime": datetime_str,
+                    "size_bytes": size_bytes,
+                    "priority": priority,
+                }
+            )
+        return recordings
+
+    async def check_quota(self):
+        """ Removes a limited number of files each time, to keep it incremental. """
+        quota_bytes = self.quota_mb * 2 ** 20
+        if self.total_bytes > quota_bytes:
+            await self.remove_oldest(self.total_bytes - quota_bytes)
+
+    def request_space(self):
+        """ Called, from any thread, when the target media is full. """
+        if (not self.is_active()) or (self.loop is None):
+            return
+        if self.space_request_active:
+            return
+        self.space_request_active = True
+        asyncio.run_coroutine_threadsafe(self.free_space(), self.loop)
+
+    async def free_space(self):
+        """ """
+        try:
+            wurb_rpi = self.wurb_manager.wurb_rpi
+            full_path = wurb_rpi.target_full_path
+            if full_path is None:
+                return
+            hdd = psutil.disk_usage(str(full_path))
+            needed_bytes = wurb_rpi.target_full_needed_bytes
+            needed_bytes += self.free_space_margin_mb * 2 ** 20
+            if hdd.free < needed_bytes:
+                await self.remove_oldest(
+                    needed_bytes - hdd.free, max_files=None, path_prefix=str(full_path)
+                )
+                # Check target media again.
+                wurb_rpi.invalidate_target()
+        except Exception as e:
+            # Logging error.
+            message = "Retention: free_space: " + str(e)
+            self.wurb_manager.wurb_logging.error(message, short_message=message)
+        finally:
+            self.space_request_active = False
+
+    async def remove_oldest(self, bytes_to_remove, max_files=-1, path_prefix=None):
+        """ Removes files until "bytes_to_remove" is reached or "max_files" removed. """
+        if max_files == -1:
+            max_files = self.max_files_per_check
+        sql = "SELECT filepath, size_bytes FROM recordings"
+        parameters = []
+        if path_prefix is not None:
+            sql += " WHERE filepath LIKE ? ESCAPE '\\'"
+            parameters.append(escape_like(path_prefix.rstrip("/")) + "/%")
+        if self.policy == "priority":
+            sql += " ORDER BY priority, datetime"
+        else:
+            sql += " ORDER BY datetime"
+        if max_files is not None:
+            sql += " LIMIT " + str(int(max_files))
+        rows = []
+        removed_bytes = 0
+        for filepath, size_bytes in self.conn.execute(sql, parameters).fetchall():
+            if removed_bytes >= bytes_to_remove:
+                break
+            rows.append((filepath, size_bytes))
+            removed_bytes += size_bytes
+        if not rows:
+            return
+        # Rows removed before the await, a concurrent call will not
+        # select the same files or subtract their size again.
+        filepaths = [filepath for filepath, _size in rows]
+        self.conn.executemany(
+            "DELETE FROM recordings WHERE filepath=?", [[path] for path in filepaths]
+        )
+        self.conn.commit()
+        self.total_bytes -= removed_bytes
+        self.files_removed += len(rows)
+        # File system calls outside the event loop.
+        await self.loop.run_in_executor(None, self.remove_files, filepaths)
+        # Not classified, and not listed as classified, when removed.
+        await self.wurb_manager.wurb_classify_queue.remove(filepaths)
+        await self.wurb_manager.wurb_database.delete_filepaths(filepaths)
+        for filepath in filepaths:
+            self.wurb_manager.wurb_classify_scheduler.pop_sound_data(filepath)
+        # Logging.
+        message = "Retention: " + str(len(rows)) + " old sound files removed."
+        self.wurb_logging.info(message, short_message=message)
+
+    def remove_files(self, filepaths):
+        """ """
+        for filepath in filepaths:
+            try:
+                os.remove(filepath)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                # Logging error.
+                message = "Retention: remove: " + str(e)
+                self.wurb_manager.wurb_logging.error(message, short_message=message)
+
+
+def escape_like(text):
+    """ Escapes wildcards for a LIKE pattern with ESCAPE '\\'. """
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
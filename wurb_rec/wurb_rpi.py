@@ -6,8 +6,11 @@
 
 import asyncio
 import os
+import time
 import datetime
 import pathlib
+import re
+import threading
 import psutil
 
 
@@ -19,6 +22,28 @@ class WurbRaspberryPi(object):
         self.wurb_manager = wurb_manager
         self.os_raspbian = None
         self.hardware_info = None
+        # Cached target for sound files.
+        self.target_lock = threading.Lock()
+        self.target_base_path = None
+        self.target_full = False
+        self.target_full_path = None
+        self.target_full_needed_bytes = 0
+        self.target_checked_time = None
+        self.target_free_bytes = 0
+        self.target_min_free_bytes = 0
+        self.target_bytes_written = 0
+        self.mounts_hash = None
+        self.mounts_checked_time = 0.0
+        self.write_rate_bytes_per_s = 0.0
+        self.write_rate_start_time = time.time()
+        self.write_rate_bytes = 0
+        # Subdirectories with a max number of files.
+        self.shard_lock = threading.Lock()
+        self.shard_counters = {}
+        # Config.
+        self.target_refresh_interval_s = 60  # Unit: sec.
+        self.mounts_check_interval_s = 5  # Unit: sec.
+        self.target_forecast_s = 120  # Switch target before full. Unit: sec.
 
     async def rpi_control(self, command):
         """ """
@@ -87,7 +112,66 @@ class WurbRaspberryPi(object):
             dir_path.mkdir(parents=True)
         return dir_path
 
-    def get_wavefile_target_dir_path(self):
+    def get_wavefile_target_dir_path(self, start_time=None, new_file=False):
+        """ The storage media is checked by a cached resolver, only the
+            directory name is calculated for each call. """
+        base_path = self.get_target_base_path()
+        if base_path is None:
+            return None
+        dir_path = pathlib.Path(base_path, self.get_file_directory_name())
+        # Optional subdirectories, to keep directories small.
+        shard_name = self.get_shard_directory_name(dir_path, start_time, new_file)
+        if shard_name:
+            dir_path = pathlib.Path(dir_path, shard_name)
+        return dir_path
+
+    def get_shard_directory_name(self, dir_path, start_time=None, new_file=False):
+        """ """
+        shard_option = self.wurb_manager.wurb_settings.get_setting(
+            "file_directory_shard_option"
+        )
+        if shard_option == "shard-hour":
+            if start_time is None:
+                start_time = time.time()
+            return time.strftime("%Hh", time.localtime(start_time))
+        if shard_option == "shard-500-files":
+            return self.get_file_count_shard_name(dir_path, 500, new_file)
+        return ""
+
+    def get_file_count_shard_name(self, dir_path, max_files, new_file):
+        """ Subdirectories named "part-001", "part-002", etc. Existing
+            subdirectories are only checked the first time. """
+        with self.shard_lock:
+            dir_key = str(dir_path)
+            if dir_key not in self.shard_counters:
+                shard_index = 1
+                file_counter = 0
+                if dir_path.exists():
+                    # Other directories, like "part-old", are not used.
+                    shards = []
+                    for path in dir_path.iterdir():
+                        match = re.fullmatch(r"part-(\d+)", path.name)
+                        if match and path.is_dir():
+                            shards.append((int(match.group(1)), path))
+                    if shards:
+                        shard_index, last_shard_path = max(shards)
+                        file_counter = len(
+                            [
+                                path
+                                for path in last_shard_path.glob("**/*")
+                                if path.suffix in [".wav", ".flac"]
+                            ]
+                        )
+                self.shard_counters[dir_key] = [shard_index, file_counter]
+            counter = self.shard_counters[dir_key]
+            if new_file:
+                if counter[1] >= max_files:
+                    counter[0] += 1
+                    counter[1] = 0
+                counter[1] += 1
+            return "part-" + str(counter[0]).zfill(3)
+
+    def get_file_directory_name(self):
         """ """
         file_directory = self.wurb_manager.wurb_settings.get_setting("file_directory")
         # Add date to file directory.
@@ -106,10 +190,51 @@ class WurbRaspberryPi(object):
             file_directory = used_date_str + "_" + file_directory
         if date_option in ["date-post-true", "date-post-after", "date-post-before"]:
             file_directory = file_directory + "_" + used_date_str
+        return file_directory
+
+    def get_target_base_path(self):
+        """ Cached. Checked again on timer, when mounts are changed or
+            when the forecast says that the media will soon be full. """
+        with self.target_lock:
+            now = time.time()
+            refresh = False
+            if self.target_checked_time is None:
+                refresh = True
+            elif (now - self.target_checked_time) > self.target_refresh_interval_s:
+                refresh = True
+            if (now - self.mounts_checked_time) > self.mounts_check_interval_s:
+                self.mounts_checked_time = now
+                if self.is_mounts_changed():
+                    refresh = True
+                # Forecast free space from bytes written since last check.
+                elif self.target_min_free_bytes > 0:
+                    free_bytes = self.target_free_bytes - self.target_bytes_written
+                    margin_bytes = self.write_rate_bytes_per_s * self.target_forecast_s
+                    if (free_bytes - margin_bytes) < self.target_min_free_bytes:
+                        refresh = True
+            if refresh:
+                self.resolve_target_base_path()
+            return self.target_base_path
+
+    def is_mounts_changed(self):
+        """ """
+        try:
+            mounts_hash = hash(pathlib.Path("/proc/mounts").read_text())
+        except Exception:
+            return False
+        changed = (self.mounts_hash is not None) and (mounts_hash != self.mounts_hash)
+        self.mounts_hash = mounts_hash
+        return changed
+
+    def resolve_target_base_path(self):
+        """ Select storage media. Probes the file systems. """
+        self.target_checked_time = time.time()
+        self.target_bytes_written = 0
+        # Space needed before the next check.
+        forecast_bytes = self.write_rate_bytes_per_s * self.target_forecast_s
         # Defaults for RPi.
         target_rpi_media_path = "/media/pi/"  # For RPi USB.
         target_rpi_internal_path = "/home/pi/"  # For RPi SD card with user 'pi'.
-        dir_path = None
 
         # Example code:
         # hdd = psutil.disk_usage(str(dir_path))
@@ -130,26 +255,70 @@ class WurbRaspberryPi(object):
                 # Directory may exist even when no USB attached.
                 if usb_stick_path.is_mount():
                     hdd = psutil.disk_usage(str(usb_stick_path))
-                    free_disk = hdd.free / (2 ** 20)  # To MB.
-                    if free_disk >= 20.0:  # 20 MB.
-                        return pathlib.Path(usb_stick_path, file_directory)
+                    min_free_bytes = 20 * 2 ** 20  # 20 MB.
+                    if hdd.free >= (min_free_bytes + forecast_bytes):
+                        self.set_target(usb_stick_path, hdd.free, min_free_bytes)
+                        return
 
         # Check internal SD card. At least 500 MB left.
         rpi_internal_path = pathlib.Path(target_rpi_internal_path)
         if rpi_internal_path.exists():
             hdd = psutil.disk_usage(str(rpi_internal_path))
-            free_disk = hdd.free / (2 ** 20)  # To MB.
-            if free_disk >= 500.0:  # 500 MB.
-                return pathlib.Path(rpi_internal_path, "wurb_recordings", file_directory)
+            min_free_bytes = 500 * 2 ** 20  # 500 MB.
+            sd_path = pathlib.Path(rpi_internal_path, "wurb_recordings")
+            if hdd.free >= (min_free_bytes + forecast_bytes):
+                self.set_target(sd_path, hdd.free, min_free_bytes)
+                return
             else:
-                # Logging error.
-                message = "RPi Not enough space left on RPi SD card."
-                self.wurb_manager.wurb_logging.error(message, short_message=message)
-                return None  # Not enough space left on RPi SD card.
+                self.set_target(None, 0, 0)
+                # Retention may remove old files to make space.
+                self.target_full_path = sd_path
+                self.target_full_needed_bytes = min_free_bytes + forecast_bytes
+                wurb_retention = self.wurb_manager.wurb_retention
+                if wurb_retention is not None:
+                    wurb_retention.request_space()
+                if not self.target_full:
+                    self.target_full = True
+                    # Logging error.
+                    message = "RPi Not enough space left on RPi SD card."
+                    self.wurb_manager.wurb_logging.error(message, short_message=message)
+                return  # Not enough space left on RPi SD card.
 
         # Default for not Raspberry Pi.
-        dir_path = pathlib.Path("wurb_recordings", file_directory)
-        return dir_path
+        self.set_target(pathlib.Path("wurb_recordings"), 0, 0)
+
+    def invalidate_target(self):
+        """ Target media will be checked again at next call. """
+        with self.target_lock:
+            self.target_checked_time = None
+
+    def set_target(self, base_path, free_bytes, min_free_bytes):
+        """ """
+        if base_path is not None:
+            self.target_full = False
+            self.target_full_path = None
+        if (base_path is not None) and (base_path != self.target_base_path):
+            # Logging debug.
+            message = "Target for sound files: " + str(base_path)
+            self.wurb_manager.wurb_logging.debug(message=message)
+        self.target_base_path = base_path
+        self.target_free_bytes = free_bytes
+        self.target_min_free_bytes = min_free_bytes
+
+    def report_bytes_written(self, bytes_written):
+        """ Called by the file writer. Used to forecast free space. """
+        with self.target_lock:
+            self.target_bytes_written += bytes_written
+            self.write_rate_bytes += bytes_written
+            elapsed_s = time.time() - self.write_rate_start_time
+            if elapsed_s >= 60.0:
+                self.write_rate_bytes_per_s = self.write_rate_bytes / elapsed_s
+                self.write_rate_start_time = time.time()
+                self.write_rate_bytes = 0
+
+    def get_write_rate_mb_per_min(self):
+        """ """
+        return round(self.write_rate_bytes_per_s * 60 / 2 ** 20, 1)
 
     def get_wavefile_analyzed_dir_path(self):
         target_dir_path = self.get_wavefile_target_dir_path()
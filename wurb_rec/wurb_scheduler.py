@@ -100,6 +100,15 @@ class WurbScheduler(object):
             message = "Scheduler update status: " + str(e)
             self.wurb_manager.wurb_logging.error(message, short_message=message)
 
+    async def is_detector_idle(self):
+        """ True when the microphone is off by the scheduler or by the user. """
+        rec_status = await self.wurb_manager.wurb_recorder.get_rec_status()
+        if rec_status == "Microphone is on.":
+            return False
+        if self.current_scheduler_state == "Recording not active.":
+            return True
+        return self.current_mode == "mode-off"
+
     async def check_scheduler(self, rec_status):
         """ """
         # Start/stop time.
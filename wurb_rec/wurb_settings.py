@@ -8,6 +8,8 @@ import asyncio
 import os
 import datetime
 import pathlib
+import hashlib
+import threading
 
 
 class WurbSettings(object):
@@ -31,6 +33,12 @@ class WurbSettings(object):
         self.settings_user_file_name = "wurb_rec_settings_user.txt"
         self.settings_startup_file_name = "wurb_rec_settings_startup.txt"
         self.settings_dir_path = self.wurb_rpi.get_settings_dir_path()
+        # Settings snapshots copied to sound file directories.
+        self.snapshot_lock = threading.Lock()
+        self.snapshot_source_stat = None
+        self.snapshot_text = None
+        self.snapshot_hash = None
+        self.snapshot_dir_hashes = {}
         #
         self.define_default_settings()
         self.current_settings = self.default_settings.copy()
@@ -50,13 +58,19 @@ class WurbSettings(object):
             "rec_mode": "mode-off",
             "file_directory": "Station-1",
             "file_directory_date_option": "date-post-before",
+            "file_directory_shard_option": "shard-not-used",
             "filename_prefix": "wurb",
             "detection_limit_khz": "17.0",
             "detection_sensitivity_dbfs": "-50",
             "detection_algorithm": "detection-simple",
             "classification_algorithm": "classification-batclassify",
             "rec_length_s": "6",
+            "rec_length_option": "length-fixed",
+            "rec_pre_trigger_s": "1.0",
+            "rec_post_trigger_s": "1.0",
             "rec_type": "FS",
+            "rec_file_format": "format-wav",
+            "rec_sparse_option": "sparse-off",
             "feedback_on_off": "feedback-off",
             "feedback_volume": "50",
             "feedback_pitch": "30",
@@ -393,6 +407,31 @@ class WurbSettings(object):
                         if key in self.default_location.keys():
                             self.current_location[key] = value
 
+    def copy_settings_to_dir(self, target_dir_path):
+        """ Copy the settings file to a sound file directory. Only copied when
+            the directory or the settings have changed since the last copy.
+            Comment rows, like the time when saved, are not compared. """
+        from_file_path = pathlib.Path(self.settings_dir_path, self.settings_file_name)
+        to_file_path = pathlib.Path(target_dir_path, self.settings_file_name)
+        with self.snapshot_lock:
+            # Read settings again only if the file is changed.
+            stat = from_file_path.stat()
+            source_stat = (stat.st_mtime_ns, stat.st_size)
+            if source_stat != self.snapshot_source_stat:
+                self.snapshot_text = from_file_path.read_text()
+                rows = [row for row in self.snapshot_text.splitlines() if not row.startswith("#")]
+                self.snapshot_hash = hashlib.sha1("\n".join(rows).encode("utf-8")).hexdigest()
+                self.snapshot_source_stat = source_stat
+            # Copy if needed.
+            dir_key = str(target_dir_path)
+            if (self.snapshot_dir_hashes.get(dir_key, None) == self.snapshot_hash) and (
+                to_file_path.exists()
+            ):
+                return False
+            to_file_path.write_text(self.snapshot_text)
+            self.snapshot_dir_hashes[dir_key] = self.snapshot_hash
+            return True
+
     def save_settings_to_file(self, settings_file_name=None, skip_keys=[]):
         """ Save to file. """
         if settings_file_name is None:
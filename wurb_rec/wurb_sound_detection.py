@@ -4,8 +4,12 @@
 # Copyright (c) 2020-present Arnold Andreasson
 # License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
 
+import os
+import asyncio
+import concurrent.futures
 import logging
 import numpy as np
+import scipy.fft
 import scipy.signal
 
 
@@ -19,40 +23,208 @@ class SoundDetection(object):
         self.wurb_settings = wurb_manager.wurb_settings
         self.wurb_logging = wurb_manager.wurb_logging
 
+    def get_detection_config(self):
+        """ Settings used by the detection algorithms. """
+        return {
+            "detection_algorithm": self.wurb_settings.get_setting(
+                "detection_algorithm"
+            ),
+            "sampling_freq_hz": self.wurb_recorder.sampling_freq_hz,
+            "detection_limit_khz": self.wurb_settings.get_setting(
+                "detection_limit_khz"
+            ),
+            "detection_sensitivity_dbfs": self.wurb_settings.get_setting(
+                "detection_sensitivity_dbfs"
+            ),
+        }
+
     def get_detection(self):
         """ Select detection algorithm. """
-        algorithm = self.wurb_settings.get_setting("detection_algorithm")
-        if algorithm == "detection-none":
-            detection_object = SoundDetectionNone(self.wurb_manager)
-        elif algorithm == "detection-simple":
-            detection_object = SoundDetectionSimple(self.wurb_manager)
+        return create_detection(self.get_detection_config(), self.wurb_manager)
+
+
+def create_detection(detection_config, wurb_manager=None):
+    """ Select detection algorithm. The manager is only needed for
+        manual triggering and is not used in a separate process. """
+    algorithm = detection_config.get("detection_algorithm", "")
+    if algorithm == "detection-none":
+        detection_object = SoundDetectionNone(wurb_manager)
+    elif algorithm == "detection-simple":
+        detection_object = SoundDetectionSimple(wurb_manager)
+    elif algorithm == "detection-cascade":
+        detection_object = SoundDetectionCascade(wurb_manager)
+    elif algorithm == "detection-adaptive":
+        detection_object = SoundDetectionAdaptive(wurb_manager)
+    else:
+        # Use the most common as default.
+        detection_object = SoundDetectionSimple(wurb_manager)
+    #
+    detection_object.config(detection_config)
+    return detection_object
+
+
+class SoundDetectionWorker(object):
+    """ Runs the detection algorithm outside the asyncio event loop.
+        The environment variable WURB_REC_DETECTION_WORKER selects
+        "thread" (default), "process" or "none". "process" makes it
+        possible to use another CPU core. Buffers are handled one at a
+        time and in order, since the algorithms keep data between buffers.
+    """
+
+    def __init__(self, wurb_manager):
+        """ """
+        self.wurb_manager = wurb_manager
+        self.worker_mode = os.getenv("WURB_REC_DETECTION_WORKER", "thread")
+        self.sound_detector = None
+        self.executor = None
+        self.active_ranges = None  # From the last checked buffer.
+        self.logger = logging.getLogger("CloudedBats-WURB")
+
+    async def startup(self):
+        """ """
+        await self.shutdown()
+        detection_config = SoundDetection(self.wurb_manager).get_detection_config()
+        # Local detector. Also used for the manual triggering check.
+        self.sound_detector = create_detection(detection_config, self.wurb_manager)
+        try:
+            if self.worker_mode == "process":
+                self.executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=1,
+                    initializer=detection_process_init,
+                    initargs=(detection_config,),
+                )
+            elif self.worker_mode == "thread":
+                self.executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="wurb_detection"
+                )
+        except Exception as e:
+            # Run in the event loop if the worker can't be created.
+            self.executor = None
+            self.logger.debug("EXCEPTION: SoundDetectionWorker: startup: " + str(e))
+
+    async def shutdown(self):
+        """ """
+        if self.executor:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    async def run_in_worker(self, function, *args):
+        """ Runs the function in the worker, or directly if no worker is used. """
+        if self.executor is None:
+            return function(*args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, function, *args)
+
+    async def check_for_sound(self, time_and_data):
+        """ Same as for the detection algorithms, but awaitable. """
+        # Returns "is sound", "freq. at peak", "dBFS at peak".
+        _rec_time, data_int16 = time_and_data
+        if isinstance(self.executor, concurrent.futures.ProcessPoolExecutor):
+            detection_result, self.active_ranges = await self.run_in_worker(
+                detection_process_detect_sound, data_int16
+            )
+        else:
+            detection_result = await self.run_in_worker(
+                self.sound_detector.detect_sound, data_int16
+            )
+            self.active_ranges = self.sound_detector.active_ranges
+        sound_detected, peak_freq_hz, peak_dbfs = detection_result
+        # Manual triggering must be checked in the main process.
+        sound_detected = self.sound_detector.manual_triggering_check(sound_detected)
+        return sound_detected, peak_freq_hz, peak_dbfs
+
+    async def reset(self):
+        """ """
+        if isinstance(self.executor, concurrent.futures.ProcessPoolExecutor):
+            await self.run_in_worker(detection_process_reset)
         else:
-            # Use the most common as default.
-            detection_object = SoundDetectionSimple(self.wurb_manager)
-        #
-        detection_object.config()
-        return detection_object
+            await self.run_in_worker(self.sound_detector.reset)
+
+    async def get_statistics(self):
+        """ """
+        if isinstance(self.executor, concurrent.futures.ProcessPoolExecutor):
+            return await self.run_in_worker(detection_process_get_statistics)
+        return self.sound_detector.get_statistics()
+
+
+# Used in the detection process when running
+# SoundDetectionWorker in "process" mode.
+process_sound_detector = None
+
+
+def detection_process_init(detection_config):
+    """ """
+    global process_sound_detector
+    process_sound_detector = create_detection(detection_config)
+
+
+def detection_process_detect_sound(data_int16):
+    """ Returns the detection result and the active ranges. """
+    detection_result = process_sound_detector.detect_sound(data_int16)
+    return detection_result, process_sound_detector.active_ranges
+
+
+def detection_process_reset():
+    """ """
+    process_sound_detector.reset()
+
+
+def detection_process_get_statistics():
+    """ """
+    return process_sound_detector.get_statistics()
 
 
 class SoundDetectionBase:
     """ """
 
-    def __init__(self, wurb_manager):
+    def __init__(self, wurb_manager=None):
         """ """
         self.wurb_manager = wurb_manager
-        self.wurb_recorder = wurb_manager.wurb_recorder
-        self.wurb_settings = wurb_manager.wurb_settings
-        self.wurb_logging = wurb_manager.wurb_logging
+        self.wurb_recorder = None
+        self.wurb_settings = None
+        self.wurb_logging = None
+        if wurb_manager is not None:
+            self.wurb_recorder = wurb_manager.wurb_recorder
+            self.wurb_settings = wurb_manager.wurb_settings
+            self.wurb_logging = wurb_manager.wurb_logging
+        # Sample ranges, [start, end], with sound in the last buffer. Relative
+        # to the buffer start, negative for frames starting in the buffer
+        # before. None if not known.
+        self.active_ranges = None
 
-    def config(self, _time_and_data):
+    def config(self, detection_config):
         """ Abstract. """
         pass  # Should be overridden.
 
+    def reset(self):
+        """ Abstract. Called when the sound stream is flushed. """
+        pass  # Should be overridden if data is kept between buffers.
+
+    def get_statistics(self):
+        """ Counters for debug logging. Empty if not used. """
+        return {}
+
     def check_for_sound(self, time_and_data):
-        """ Abstract. """
+        """ Detection followed by the check for manual triggering. """
+        # Returns "is sound", "freq. at peak", "dBFS at peak".
+        _rec_time, data_int16 = time_and_data
+        sound_detected, peak_freq_hz, peak_dbfs = self.detect_sound(data_int16)
+        sound_detected = self.manual_triggering_check(sound_detected)
+        return sound_detected, peak_freq_hz, peak_dbfs
+
+    def detect_sound(self, data_int16):
+        """ Abstract. The manager can't be used here, since detection
+            may run in a separate process. """
         # Returns "is sound", "freq. at peak", "dBFS at peak".
         return True, None, None  # Should be overridden.
 
+    def log_error(self, message):
+        """ The manager is not available if detection runs in a separate process. """
+        if self.wurb_logging is not None:
+            self.wurb_logging.error(message, short_message=message)
+        else:
+            logging.getLogger("CloudedBats-WURB").error(message)
+
     def manual_triggering_check(self, sound_detected):
         """ """
         rec_mode = self.wurb_settings.get_setting("rec_mode")
@@ -78,17 +250,16 @@ class SoundDetectionNone(SoundDetectionBase):
         """ """
         super(SoundDetectionNone, self).__init__(wurb_manager)
 
-    def config(self):
+    def config(self, detection_config):
         """ """
         pass  # Not needed.
 
-    def check_for_sound(self, time_and_data):
+    def detect_sound(self, data_int16):
         """ """
         # Always true, except when running in manual triggering mode.
         # Returns "is sound", "freq. at peak", "dBFS at peak".
-        sound_detected = True
-        sound_detected = self.manual_triggering_check(sound_detected)
-        return (sound_detected, None, None)
+        self.active_ranges = [[0, len(data_int16)]]
+        return (True, None, None)
 
 
 class SoundDetectionSimple(SoundDetectionBase):
@@ -100,11 +271,11 @@ class SoundDetectionSimple(SoundDetectionBase):
         # Config.
         self.sound_detected_counter_min = 3
 
-    def config(self):
+    def config(self, detection_config):
         """ """
-        sampling_freq = self.wurb_recorder.sampling_freq_hz
-        filter_min_khz = self.wurb_settings.get_setting("detection_limit_khz")
-        threshold_dbfs = self.wurb_settings.get_setting("detection_sensitivity_dbfs")
+        sampling_freq = detection_config["sampling_freq_hz"]
+        filter_min_khz = detection_config["detection_limit_khz"]
+        threshold_dbfs = detection_config["detection_sensitivity_dbfs"]
 
         self.sampling_freq = float(sampling_freq)
         self.filter_min_hz = float(filter_min_khz) * 1000.0
@@ -119,6 +290,19 @@ class SoundDetectionSimple(SoundDetectionBase):
         self.freq_bins_hz = np.arange((self.window_size / 2) + 1) / (
             self.window_size / self.sampling_freq
         )
+        # High pass filter. First frequency bin to use in the spectrum.
+        self.filter_min_bin = int(
+            np.searchsorted(self.freq_bins_hz, self.filter_min_hz)
+        )
+        # Transform from int16 to the interval -1 to 1 and apply
+        # the window function in one multiplication. Float32 is enough
+        # for detection and makes the FFT about twice as fast.
+        self.window_function_int16 = (self.window_function / 32768.0).astype(
+            np.float32
+        )
+        # Samples left from the last buffer are used in the first
+        # frames of next buffer.
+        self.reset()
 
         # print(
         #     "DEBUG: Detection: Freq: ",
@@ -129,57 +313,145 @@ class SoundDetectionSimple(SoundDetectionBase):
         #     self.threshold_dbfs,
         # )
 
-    def check_for_sound(self, time_and_data):
+    def reset(self):
+        """ Clear samples kept between buffers. """
+        self.overlap_buffer = np.zeros(self.window_size, dtype=np.int16)
+        self.overlap_length = 0
+
+    def get_frame_groups(self, data_int16):
+        """ Frames are contiguous over the whole stream. Samples not used
+            by a complete frame are kept in the overlap buffer to next call.
+            Returns a list of (frames, offset), offset is the start of the
+            first frame relative to data_int16 and negative for frames
+            starting in the overlap buffer. """
+        frame_groups = []
+        data_start = 0  # Start of next frame, relative to data_int16.
+        overlap_length = self.overlap_length
+        if overlap_length > 0:
+            # Frames starting in the overlap buffer. Only a small part is copied.
+            head = np.concatenate(
+                (self.overlap_buffer[:overlap_length], data_int16[: self.window_size])
+            )
+            number_of_head_frames = (overlap_length - 1) // self.jump_size + 1
+            head_frames = self.get_frames(head)[:number_of_head_frames]
+            if len(head_frames) > 0:
+                frame_groups.append((head_frames, -overlap_length))
+            if len(head_frames) < number_of_head_frames:
+                # Too short buffer. Keep the rest for next call.
+                remaining = head[len(head_frames) * self.jump_size :]
+                self.overlap_buffer[: len(remaining)] = remaining
+                self.overlap_length = len(remaining)
+                return frame_groups
+            data_start = number_of_head_frames * self.jump_size - overlap_length
+        # Frames inside the new buffer.
+        body_frames = self.get_frames(data_int16[data_start:])
+        if len(body_frames) > 0:
+            frame_groups.append((body_frames, data_start))
+        # Save the part that not was used by a complete frame.
+        remaining = data_int16[data_start + len(body_frames) * self.jump_size :]
+        self.overlap_buffer[: len(remaining)] = remaining
+        self.overlap_length = len(remaining)
+        return frame_groups
+
+    def get_frames(self, data_int16):
+        """ All windows in the buffer as a strided view, rows are frames.
+            No data is copied. """
+        frames_length = len(data_int16) - self.window_size
+        if frames_length < 0:
+            return np.empty((0, self.window_size), dtype=data_int16.dtype)
+        number_of_frames = frames_length // self.jump_size + 1
+        sample_stride = data_int16.strides[0]
+        return np.lib.stride_tricks.as_strided(
+            data_int16,
+            shape=(number_of_frames, self.window_size),
+            strides=(self.jump_size * sample_stride, sample_stride),
+            writeable=False,
+        )
+
+    def get_frame_starts(self, frame_groups):
+        """ Start of each frame, relative to the buffer. """
+        starts_list = [
+            offset + np.arange(len(frames)) * self.jump_size
+            for frames, offset in frame_groups
+        ]
+        return np.concatenate(starts_list or [np.empty(0, dtype=int)])
+
+    def get_active_ranges(self, frame_starts, active_frames):
+        """ Sample ranges for active frames, overlapping frames are merged. """
+        active_ranges = []
+        for frame_start in frame_starts[active_frames]:
+            start = int(frame_start)
+            end = start + self.window_size
+            if active_ranges and (start <= active_ranges[-1][1]):
+                active_ranges[-1][1] = end
+            else:
+                active_ranges.append([start, end])
+        return active_ranges
+
+    def get_power_spectra(self, frames):
+        """ Power spectrum for all frames in one batched FFT.
+            Only bins above the high pass filter limit are returned. """
+        # Transform to intervall -1 to 1 and apply window function.
+        signals = frames * self.window_function_int16
+        # From time domain to frequency domain. High pass filter. Unit Hz.
+        spectra = scipy.fft.rfft(signals, axis=1)[:, self.filter_min_bin :]
+        # Squared magnitude, sqrt is only needed for the peaks.
+        power_spectra = spectra.real * spectra.real
+        power_spectra += spectra.imag * spectra.imag
+        return power_spectra
+
+    def get_frame_peaks(self, frames):
+        """ Returns dBFS and bin index at peak for each frame. """
+        if (len(frames) == 0) or (self.filter_min_bin >= len(self.freq_bins_hz)):
+            return np.empty(0), np.empty(0, dtype=int)
+        power_spectra = self.get_power_spectra(frames)
+        # Find peak for each frame.
+        peak_bins = power_spectra.argmax(axis=1)
+        peak_power = power_spectra[np.arange(len(power_spectra)), peak_bins]
+        # Convert peaks to dBFS (bin values related to maximal possible value).
+        # log10 does not like zero.
+        with np.errstate(divide="ignore"):
+            peak_dbfs = 10 * np.log10(
+                peak_power.astype(np.float64) / (self.window_function_dbfs_max ** 2)
+            )
+        return peak_dbfs, peak_bins + self.filter_min_bin
+
+    def detect_sound(self, data_int16):
         """ """
-        _rec_time, raw_data = time_and_data
-        # data_int16 = np.fromstring(raw_data, dtype=np.int16) # To ndarray.
-        data_int16 = raw_data
-        # self.work_buffer = np.concatenate([self._work_buffer, data_int16])
-        self.work_buffer = data_int16
-        #
         sound_detected = False
-        sound_detected_counter = 0
         peak_frequency_hz = None
         peak_dbfs_at_max = None
+        self.active_ranges = []
         try:
-            while len(self.work_buffer) >= self.window_size:
-                # Get frame of window size.
-                data_frame = self.work_buffer[: self.window_size]
-                # Cut the first jumped size.
-                self.work_buffer = self.work_buffer[self.jump_size :]
-                # Transform to intervall -1 to 1 and apply window function.
-                signal = data_frame / 32768.0 * self.window_function
-                # From time domain to frequency domain.
-                spectrum = np.fft.rfft(signal)
-                # High pass filter. Unit Hz. Cut below 15 kHz.
-                # log10 does not like zero.
-                spectrum[self.freq_bins_hz < self.filter_min_hz] = 0.000000001
-                # Convert spectrum to dBFS (bin values related to maximal possible value).
-                if self.window_function_dbfs_max > 0.0:
-                    dbfs_spectrum = 20 * np.log10(
-                        np.abs(spectrum) / self.window_function_dbfs_max
-                    )
-                    # Find peak and dBFS value for the peak.
-                    bin_peak_index = dbfs_spectrum.argmax()
-                    peak_db = dbfs_spectrum[bin_peak_index]
-                else:
-                    peak_db = -500.0
-                # Treshold.
-                if peak_db > self.threshold_dbfs:
-                    sound_detected_counter += 1
-                    if sound_detected_counter >= self.sound_detected_counter_min:
-                        sound_detected = True
-                        if (peak_dbfs_at_max is None) or (peak_db > peak_dbfs_at_max):
-                            peak_dbfs_at_max = peak_db
-                            peak_frequency_hz = (
-                                bin_peak_index * self.sampling_freq / self.window_size
-                            )
-                            # print(
-                            #     "DEBUG: Peak freq hz: "
-                            #     + str(peak_frequency_hz)
-                            #     + "   dBFS: "
-                            #     + str(peak_db)
-                            # )
+            # All frames in one step, including frames overlapping last buffer.
+            peak_dbfs_list = []
+            peak_bins_list = []
+            frame_groups = self.get_frame_groups(data_int16)
+            for frames, _offset in frame_groups:
+                frame_peak_dbfs, frame_peak_bins = self.get_frame_peaks(frames)
+                peak_dbfs_list.append(frame_peak_dbfs)
+                peak_bins_list.append(frame_peak_bins)
+            peak_dbfs = np.concatenate(peak_dbfs_list or [np.empty(0)])
+            peak_bins = np.concatenate(peak_bins_list or [np.empty(0, dtype=int)])
+            # Treshold. Sound is detected from the n:th frame above threshold.
+            above_threshold = peak_dbfs > self.threshold_dbfs
+            detected_frames = above_threshold & (
+                np.cumsum(above_threshold) >= self.sound_detected_counter_min
+            )
+            if above_threshold.any():
+                self.active_ranges = self.get_active_ranges(
+                    self.get_frame_starts(frame_groups)[: len(above_threshold)],
+                    above_threshold,
+                )
+            if detected_frames.any():
+                sound_detected = True
+                # Find the first frame with the highest peak.
+                detected_indexes = np.flatnonzero(detected_frames)
+                max_index = detected_indexes[peak_dbfs[detected_indexes].argmax()]
+                peak_dbfs_at_max = float(peak_dbfs[max_index])
+                peak_frequency_hz = float(
+                    peak_bins[max_index] * self.sampling_freq / self.window_size
+                )
             # # Log if sound was detected.
             # if sound_detected:
             #     # Logging.
@@ -193,9 +465,203 @@ class SoundDetectionSimple(SoundDetectionBase):
             #     self.wurb_logging.info(message, short_message=message)
             #
         except Exception as e:
-            print("DEBUG: xception in check_for_sound: ", e)
+            # Logging error.
+            self.log_error("Sound detection: detect_sound: " + str(e))
 
-        # Check if running in manual triggering mode.
-        sound_detected = self.manual_triggering_check(sound_detected)
+        return sound_detected, peak_frequency_hz, peak_dbfs_at_max
+
+
+class SoundDetectionCascade(SoundDetectionSimple):
+    """ Two stage detection. A cheap spectral gate, with short frames that
+        do not overlap, is checked first. The spectral analysis in
+        SoundDetectionSimple is only used when the gate is open.
+        Noise is spread over fewer bins in the short frames, but the level
+        of a call in one bin is about the same. With the margin the gate
+        opens for calls at the detection threshold, and stays closed for
+        broadband noise up to about the threshold level.
+    """
+
+    def __init__(self, wurb_manager):
+        """ """
+        super(SoundDetectionCascade, self).__init__(wurb_manager)
+        # Config.
+        self.gate_margin_db = 6.0
+        # Counters.
+        self.buffers_checked = 0
+        self.buffers_skipped = 0
+
+    def config(self, detection_config):
+        """ """
+        super(SoundDetectionCascade, self).config(detection_config)
+        self.gate_window_size = max(64, self.window_size // 8)
+        gate_window_function = scipy.signal.windows.hann(self.gate_window_size)
+        self.gate_window_function_int16 = (gate_window_function / 32768.0).astype(
+            np.float32
+        )
+        # The bin that contains the detection limit is also used.
+        gate_bin_hz = self.sampling_freq / self.gate_window_size
+        self.gate_filter_min_bin = int(self.filter_min_hz // gate_bin_hz)
+        # Power in one bin, in the same unit as the detector but with margin.
+        gate_dbfs_max = np.sum(gate_window_function) / 2
+        self.gate_threshold_power = (gate_dbfs_max ** 2) * (
+            10.0 ** ((self.threshold_dbfs - self.gate_margin_db) / 10.0)
+        )
+
+    def is_gate_open(self, data_int16):
+        """ Peak in the spectrum of short frames, above the high pass filter.
+            Samples kept from the last buffer are included, they are used
+            in the first frames of this buffer. """
+        if len(data_int16) == 0:
+            return False
+        if self.gate_filter_min_bin > self.gate_window_size // 2:
+            return False
+        overlap_length = self.overlap_length
+        length = overlap_length + len(data_int16)
+        # The last frame is padded with zeros.
+        number_of_frames = -(-length // self.gate_window_size)
+        data_float = np.zeros(
+            number_of_frames * self.gate_window_size, dtype=np.float32
+        )
+        data_float[:overlap_length] = self.overlap_buffer[:overlap_length]
+        data_float[overlap_length:length] = data_int16
+        frames = data_float.reshape(number_of_frames, self.gate_window_size)
+        spectra = scipy.fft.rfft(frames * self.gate_window_function_int16, axis=1)
+        spectra = spectra[:, self.gate_filter_min_bin :]
+        power_spectra = spectra.real * spectra.real
+        power_spectra += spectra.imag * spectra.imag
+        return power_spectra.max() > self.gate_threshold_power
+
+    def detect_sound(self, data_int16):
+        """ """
+        self.buffers_checked += 1
+        self.active_ranges = []
+        try:
+            if self.is_gate_open(data_int16):
+                return super(SoundDetectionCascade, self).detect_sound(data_int16)
+            # Gate closed. Frames must still be aligned for next buffer.
+            self.buffers_skipped += 1
+            self.get_frame_groups(data_int16)
+        except Exception as e:
+            # Logging error.
+            self.log_error("Sound detection: detect_sound (cascade): " + str(e))
+
+        return False, None, None
+
+    def get_statistics(self):
+        """ """
+        return {
+            "buffers_checked": self.buffers_checked,
+            "buffers_skipped": self.buffers_skipped,
+        }
+
+
+class SoundDetectionAdaptive(SoundDetectionSimple):
+    """ Adaptive noise floor. A running background level is estimated for
+        each frequency bin and sound is detected when the signal to noise
+        ratio, SNR, is above a limit. Steady sound from insects or rain will
+        after a while be a part of the background.
+    """
+
+    def __init__(self, wurb_manager):
+        """ """
+        super(SoundDetectionAdaptive, self).__init__(wurb_manager)
+        # Config.
+        self.snr_threshold_db = 15.0
+        self.noise_floor_time_constant_s = 3.0
+        self.noise_floor_min_dbfs = -120.0
+
+    def config(self, detection_config):
+        """ """
+        super(SoundDetectionAdaptive, self).config(detection_config)
+        # Part of the difference that is added to the noise floor for each frame.
+        self.noise_floor_alpha = self.jump_size / (
+            self.sampling_freq * self.noise_floor_time_constant_s
+        )
+        # Power in the spectrum related to dBFS.
+        self.dbfs_power_ref = self.window_function_dbfs_max ** 2
+        self.noise_floor_min_power = self.dbfs_power_ref * (
+            10.0 ** (self.noise_floor_min_dbfs / 10.0)
+        )
+        self.snr_threshold = 10.0 ** (self.snr_threshold_db / 10.0)
+
+    def reset(self):
+        """ """
+        super(SoundDetectionAdaptive, self).reset()
+        self.noise_floor_db = None
+        self.noise_floor = None
+        self.noise_floor_inverted = None
+
+    def update_noise_floor(self, power_spectra):
+        """ Exponentially updated noise floor in dB for each bin. The quietest
+            half of the frames is used to avoid short sounds like bat calls. """
+        frame_power = power_spectra.sum(axis=1)
+        quiet_frames = frame_power <= np.median(frame_power)
+        background = power_spectra[quiet_frames].mean(axis=0)
+        background_db = 10.0 * np.log10(
+            np.maximum(background, self.noise_floor_min_power)
+        )
+        if self.noise_floor_db is None:
+            self.noise_floor_db = background_db
+        else:
+            alpha = 1.0 - (1.0 - self.noise_floor_alpha) ** len(power_spectra)
+            self.noise_floor_db += alpha * (background_db - self.noise_floor_db)
+        self.noise_floor = 10.0 ** (self.noise_floor_db / 10.0)
+        self.noise_floor_inverted = (1.0 / self.noise_floor).astype(np.float32)
+
+    def detect_sound(self, data_int16):
+        """ """
+        sound_detected = False
+        peak_frequency_hz = None
+        peak_dbfs_at_max = None
+        self.active_ranges = []
+        try:
+            spectra_list = []
+            frame_groups = []
+            for frames, offset in self.get_frame_groups(data_int16):
+                if (len(frames) > 0) and (
+                    self.filter_min_bin < len(self.freq_bins_hz)
+                ):
+                    spectra_list.append(self.get_power_spectra(frames))
+                    frame_groups.append((frames, offset))
+            if spectra_list:
+                power_spectra = np.concatenate(spectra_list)
+                # Start value from the first buffer.
+                if self.noise_floor is None:
+                    self.update_noise_floor(power_spectra)
+                # SNR for each bin, peaks for each frame.
+                snr = power_spectra * self.noise_floor_inverted
+                peak_bins = snr.argmax(axis=1)
+                frame_indexes = np.arange(len(snr))
+                peak_snr = snr[frame_indexes, peak_bins]
+                # Treshold. Sound is detected from the n:th frame above threshold.
+                above_threshold = peak_snr > self.snr_threshold
+                detected_frames = above_threshold & (
+                    np.cumsum(above_threshold) >= self.sound_detected_counter_min
+                )
+                if above_threshold.any():
+                    self.active_ranges = self.get_active_ranges(
+                        self.get_frame_starts(frame_groups), above_threshold
+                    )
+                if detected_frames.any():
+                    sound_detected = True
+                    # Report the strongest detected peak as dBFS.
+                    detected_indexes = np.flatnonzero(detected_frames)
+                    detected_bins = peak_bins[detected_indexes]
+                    detected_power = power_spectra[detected_indexes, detected_bins]
+                    max_index = detected_power.argmax()
+                    peak_dbfs_at_max = float(
+                        10.0
+                        * np.log10(detected_power[max_index] / self.dbfs_power_ref)
+                    )
+                    peak_frequency_hz = float(
+                        (detected_bins[max_index] + self.filter_min_bin)
+                        * self.sampling_freq
+                        / self.window_size
+                    )
+                # Adapt to the background in this buffer.
+                self.update_noise_floor(power_spectra)
+        except Exception as e:
+            # Logging error.
+            self.log_error("Sound detection: detect_sound (adaptive): " + str(e))
 
         return sound_detected, peak_frequency_hz, peak_dbfs_at_max
@@ -18,6 +18,29 @@ source venv/bin/activate
 # export WURB_REC_INPUT_DEVICE_FREQ_HZ=192000
 # export WURB_REC_OUTPUT_DEVICE=Headphones
 # export WURB_REC_OUTPUT_DEVICE_FREQ_HZ=48000
+# export WURB_REC_DETECTION_WORKER=thread
+# export WURB_REC_CAPTURE_DETECTION=false
+# export WURB_REC_RING_BUFFER_S=30
+# export WURB_REC_RING_BUFFER_MAX_MB=96
+# export WURB_REC_QUEUE_BUDGET_S=10
+# export WURB_REC_QUEUE_DROP_POLICY=drop-oldest
+# export WURB_REC_SPILL_DIR=/dev/shm
+# export WURB_REC_SPILL_SIZE_MB=256
+# export WURB_REC_WRITE_BEHIND_MAX_FILES=2
+# export WURB_REC_WAVE_FILE_MODE=preallocated
+# export WURB_REC_SPARSE_PADDING_MS=50
+# export WURB_REC_RETENTION_QUOTA_MB=0
+# export WURB_REC_RETENTION_POLICY=oldest
+# export WURB_REC_ARCHIVE_FLAC=false
+# export WURB_REC_ARCHIVE_WORKERS=1
+# export WURB_REC_CLASSIFY_COMMAND=BatClassify
+# export WURB_REC_CLASSIFY_WORKERS=2
+# export WURB_REC_CLASSIFY_REC_WORKERS=1
+# export WURB_REC_CLASSIFY_MAX_LOAD=70
+# export WURB_REC_CLASSIFY_MAX_TEMP_C=75
+# export WURB_REC_CLASSIFY_BATCH_SIZE=8
+# export WURB_REC_CLASSIFY_CACHE_MB=64
+# export WURB_REC_CLASSIFY_MODEL=
 
 # Launch control by GPIO and/or computer mouse.
 # It is running in it's own process.